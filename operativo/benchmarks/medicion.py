@@ -0,0 +1,230 @@
+
+import os
+import json
+import time
+import tracemalloc
+import datetime as dt
+import numpy as np
+import xarray as xr
+
+from typing import Any, Callable, NamedTuple
+
+from calendario import CalendarioSemanas
+from etapas import calibrar
+from funciones_extra import get_fecha_publicacion, mapa_probabilidad
+from prob_funciones import get_data, calc_prob, calc_prob_corr, calc_prob_corr_extr, get_archivos_datos
+from prob_funciones import _contar_miembros, _contar_miembros_numpy, _leer_pronostico
+from setup.config import GlobalConfig
+from stores.climatology import get_climatology_window
+from stores.hindcast import open_hindcast_start
+from stores.regrid import regrid_like
+from benchmarks.referencias import regrid_interp_like, leer_hindcast, ventana_climatologia, calc_prob_replicado
+from benchmarks.referencias import calc_prob_corr_archivos, calc_prob_corr_extr_iterativo
+
+
+class Medicion(NamedTuple):
+    etapa: str
+    modelo: str
+    variable: str
+    segundos: float  # mejor tiempo de las repeticiones
+    memoria_mb: float  # pico de memoria asignada durante la etapa (tracemalloc)
+
+
+class Comparacion(NamedTuple):
+    nombre: str
+    modelo: str
+    variable: str
+    segundos_referencia: float
+    segundos_acelerado: float
+    max_diferencia: float  # máxima diferencia absoluta entre los resultados
+    distintos: int  # valores con diferencia mayor a la tolerancia, o con NaN en uno solo de los resultados
+
+
+def medir(funcion: Callable, *args, repeticiones: int = 3, **kwargs) -> tuple[Any, float, float]:
+    """
+    Ejecuta funcion una vez sin medir (se construyen los stores, se compila numba, etc.), repeticiones veces
+    midiendo el tiempo y una vez más con tracemalloc, que registra las asignaciones de numpy pero no las de las
+    bibliotecas de C (p.e. netCDF). Devuelve el resultado, el mejor tiempo (s) y el pico de memoria (MB).
+    """
+    resultado = funcion(*args, **kwargs)
+    tiempos = []
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        resultado = funcion(*args, **kwargs)
+        tiempos.append(time.perf_counter() - inicio)
+
+    tracemalloc.start()
+    try:
+        funcion(*args, **kwargs)
+        _, pico = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return resultado, min(tiempos), pico / 1024 ** 2
+
+
+def medir_etapas(nombre_modelo: str, variable: str, miercoles: dt.datetime, carpeta_figuras: str,
+                 repeticiones: int = 3) -> list[Medicion]:
+    """
+    Mide las etapas de la calibración de la categoría 50- (la más costosa de calc_prob_corr, con p1 y p2) y la
+    figura de la semana 1.
+    """
+    fecha_d = get_fecha_publicacion(nombre_modelo, miercoles)
+    _, modelo = nombre_modelo.split('-')
+    mediciones = []
+
+    def registrar(etapa, funcion, *args, **kwargs):
+        resultado, segundos, memoria = medir(funcion, *args, repeticiones=repeticiones, **kwargs)
+        mediciones.append(Medicion(etapa, nombre_modelo, variable, segundos, memoria))
+        return resultado
+
+    fcst_m, hcst_m, media_m, pctil_m, fechas_v = registrar('get_data', get_data, fecha_d, 50, miercoles, variable, modelo)
+    p1, p2 = registrar('calc_prob', calc_prob, fcst_m, hcst_m, media_m, pctil_m, 50)
+    p1, p2 = p1.sel(semanas=slice(1,3)), p2.sel(semanas=slice(1,3))
+    p1_corr, p2_corr = registrar('calc_prob_corr', calc_prob_corr, p1, p2, variable, modelo, '50')
+    p1_final, _ = registrar('calc_prob_corr_extr', calc_prob_corr_extr, p1_corr, p2_corr)
+
+    os.makedirs(carpeta_figuras, exist_ok=True)
+    registrar('mapa_probabilidad', mapa_probabilidad, variable, p1_final, '50-', 1, modelo, fechas_v[0],
+              fechas_v[0] + dt.timedelta(days=6), carpeta_figuras + '/')
+
+    return mediciones
+
+
+def diferencias(referencia: list, acelerado: list, tolerancia: float = 0.) -> tuple[float, int]:
+    """
+    Máxima diferencia absoluta entre pares de resultados y cantidad de valores que difieren en más de tolerancia
+    (un NaN en uno solo de los resultados cuenta como distinto).
+    """
+    max_diferencia, distintos = 0., 0
+    for a, b in zip(referencia, acelerado):
+        a, b = np.asarray(a, dtype=float), np.asarray(b, dtype=float)
+        nulos_a, nulos_b = np.isnan(a), np.isnan(b)
+        validos = ~nulos_a & ~nulos_b
+        dif = np.abs(a[validos] - b[validos])
+        max_diferencia = max(max_diferencia, float(dif.max(initial=0.)))
+        distintos += int((dif > tolerancia).sum() + (nulos_a != nulos_b).sum())
+    return max_diferencia, distintos
+
+
+def _tiempo(funcion: Callable, *args, **kwargs) -> tuple[Any, float]:
+    # Una ejecución previa sin medir, como en medir
+    funcion(*args, **kwargs)
+    inicio = time.perf_counter()
+    resultado = funcion(*args, **kwargs)
+    return resultado, time.perf_counter() - inicio
+
+
+def _contar(funcion: Callable, fcst_m, hcst_m, media_m, pctil_m):
+    # Conteo de miembros como en calc_prob, con la implementación indicada
+    entradas = xr.align(fcst_m, hcst_m, media_m, pctil_m, join='inner')
+    return xr.apply_ufunc(funcion, *[a.reset_coords(drop=True) for a in entradas],
+                          input_core_dims=[['M'], [], [], []], output_core_dims=[[], []])
+
+
+def comparar_implementaciones(nombre_modelo: str, variable: str, miercoles: dt.datetime, chunks: int | None = None,
+                              tolerancia: float = 1e-9) -> list[Comparacion]:
+    """
+    Compara las implementaciones aceleradas con las de referencia, con las mismas entradas (las de referencia
+    anteriores a las optimizaciones están en referencias.py):
+    - contar_miembros: numba (_contar_miembros) y numpy (_contar_miembros_numpy).
+    - calc_prob: conteo por broadcasting y con los campos fijos replicados a lo largo de M.
+    - agregacion_semanal: CalendarioSemanas.aggregate (np.add.reduceat) y groupby de xarray.
+    - regrid: pesos bilineales dispersos (regrid_like) e interp_like.
+    - hindcast: archivo indexado por mes/día (open_hindcast_start) y lectura del archivo original.
+    - climatologia: ventanas por índices (get_climatology_window) y sobre la climatología extendida con una copia de
+      enero/febrero, con una ventana que cruza el fin de año.
+    - pac: factores del archivo consolidado (calc_prob_corr) y de los archivos de cada semana y categoría.
+    - calc_prob_corr_extr: corrección en una pasada y con iteraciones.
+    - calibrar_bloques: calibrar por bloques de chunks x chunks puntos (dask) y en memoria (solo con chunks).
+    Los stores (hindcast, climatología, PAC) se construyen y se leen una vez antes de medir, como en la operación.
+    """
+    fecha_d = get_fecha_publicacion(nombre_modelo, miercoles)
+    _, modelo = nombre_modelo.split('-')
+    comparaciones = []
+
+    def registrar(nombre, referencia, acelerado):
+        (res_ref, seg_ref), (res_acel, seg_acel) = referencia, acelerado
+        # Los resultados se comparan con el mismo orden de dimensiones
+        res_ref = [r.transpose(*a.dims) if isinstance(r, xr.DataArray) and isinstance(a, xr.DataArray) else r
+                   for r, a in zip(res_ref, res_acel)]
+        comparaciones.append(Comparacion(nombre, nombre_modelo, variable, seg_ref, seg_acel,
+                                         *diferencias(res_ref, res_acel, tolerancia)))
+
+    fcst_m, hcst_m, media_m, pctil_m, _ = get_data(fecha_d, 50, miercoles, variable, modelo)
+    registrar('contar_miembros', _tiempo(_contar, _contar_miembros_numpy, fcst_m, hcst_m, media_m, pctil_m),
+              _tiempo(_contar, _contar_miembros, fcst_m, hcst_m, media_m, pctil_m))
+    registrar('calc_prob', _tiempo(calc_prob_replicado, fcst_m, hcst_m, media_m, pctil_m),
+              _tiempo(calc_prob, fcst_m, hcst_m, media_m, pctil_m, 50))
+
+    # Pronóstico diario (para CFSv2, la inicialización más reciente)
+    archivo = get_archivos_datos(fecha_d, [], miercoles, variable, modelo)['pronostico']
+    if modelo == 'CFSv2':
+        archivo = archivo + variable + '_' + modelo + '_' + fecha_d.strftime('%Y%m%d%H%M') + '_forecast.nc'
+    fcst = _leer_pronostico(archivo, variable).load()
+    calendario = CalendarioSemanas.from_data(fcst, miercoles, hcast=0)
+    semanal, seg_acel = _tiempo(calendario.aggregate, fcst, 'mean')
+    semanal_ref, seg_ref = _tiempo(lambda: calendario.assign_to(fcst).groupby('semanas').mean(dim='L'))
+    registrar('agregacion_semanal', ([semanal_ref], seg_ref), ([semanal], seg_acel))
+
+    # Percentiles de ERA5 de las semanas 1 y 2, interpolados a la retícula del modelo
+    varn = getattr(GlobalConfig.Instance().app_config.mapeo_variables, variable)
+    archivos = get_archivos_datos(fecha_d, [50], miercoles, variable, modelo)
+    with xr.open_dataset(archivos['percentiles'][50][0], engine='netcdf4') as pctil:
+        pctil = pctil[varn].isel(S=slice(0, 2)).rename({'longitude': 'X', 'latitude': 'Y'}).load()
+    registrar('regrid', _tiempo(lambda: [regrid_interp_like(pctil, hcst_m)]),
+              _tiempo(lambda: [regrid_like(pctil, hcst_m)]))
+
+    registrar('hindcast', _tiempo(lambda: [leer_hindcast(archivos['hindcast'], fecha_d)[variable]]),
+              _tiempo(lambda: [open_hindcast_start(archivos['hindcast'], fecha_d.month, fecha_d.day)[variable]]))
+
+    f1 = dt.datetime(1960, fecha_d.month, fecha_d.day)
+    ventanas = [(f1, f1 + dt.timedelta(days=45)), (dt.datetime(1960, 12, 10), dt.datetime(1961, 1, 25))]
+    registrar('climatologia', _tiempo(lambda: [ventana_climatologia(archivos['media'], varn, *v) for v in ventanas]),
+              _tiempo(lambda: [get_climatology_window(archivos['media'], varn, *v) for v in ventanas]))
+
+    # Correcciones de las semanas 1 a 3, con las probabilidades del percentil 50
+    p1, p2 = calc_prob(fcst_m, hcst_m, media_m, pctil_m, 50)
+    p1, p2 = p1.sel(semanas=slice(1,3)), p2.sel(semanas=slice(1,3))
+    registrar('pac', _tiempo(calc_prob_corr_archivos, p1, p2, variable, modelo, '50'),
+              _tiempo(calc_prob_corr, p1, p2, variable, modelo, '50'))
+    p1_corr, p2_corr = calc_prob_corr(p1, p2, variable, modelo, '50')
+    registrar('calc_prob_corr_extr', _tiempo(calc_prob_corr_extr_iterativo, p1_corr, p2_corr),
+              _tiempo(calc_prob_corr_extr, p1_corr, p2_corr))
+
+    if chunks is not None:
+        registrar('calibrar_bloques',
+                  _tiempo(lambda: list(calibrar(nombre_modelo, variable, miercoles).probabilidades.values())),
+                  _tiempo(lambda: list(calibrar(nombre_modelo, variable, miercoles, chunks).probabilidades.values())))
+
+    return comparaciones
+
+
+def leer_referencia(archivo: str) -> dict:
+    with open(archivo, 'r') as f:
+        return json.load(f)
+
+
+def guardar_referencia(mediciones: list[Medicion], archivo: str):
+    referencia = {f'{m.modelo}/{m.variable}/{m.etapa}': {'segundos': m.segundos, 'memoria_mb': m.memoria_mb}
+                  for m in mediciones}
+    with open(archivo + '.tmp', 'w') as f:
+        json.dump(referencia, f, indent=2)
+    os.replace(archivo + '.tmp', archivo)
+
+
+def buscar_regresiones(mediciones: list[Medicion], referencia: dict, tolerancia_tiempo: float = 1.3,
+                       tolerancia_memoria: float = 1.2) -> list[str]:
+    """
+    Etapas cuyo tiempo o pico de memoria supera el de la referencia multiplicado por la tolerancia.
+    """
+    regresiones = []
+    for m in mediciones:
+        previa = referencia.get(f'{m.modelo}/{m.variable}/{m.etapa}')
+        if previa is None:
+            continue
+        if m.segundos > previa['segundos'] * tolerancia_tiempo:
+            regresiones.append(f'{m.modelo}/{m.variable}/{m.etapa}: {m.segundos:.3f} s (referencia {previa["segundos"]:.3f} s)')
+        if m.memoria_mb > previa['memoria_mb'] * tolerancia_memoria:
+            regresiones.append(f'{m.modelo}/{m.variable}/{m.etapa}: {m.memoria_mb:.1f} MB (referencia {previa["memoria_mb"]:.1f} MB)')
+    return regresiones
@@ -0,0 +1,153 @@
+
+import datetime as dt
+import pandas as pd
+import xarray as xr
+
+from stores.hindcast import change_year
+from stores.pac import get_pac_source_files
+
+
+# Implementaciones anteriores a las optimizaciones, copiadas sin cambios de fondo (solo se leen los archivos con
+# las rutas actuales). Son la referencia con la que se comparan las implementaciones aceleradas (ver medicion.py).
+
+
+def regrid_interp_like(da: xr.DataArray, destino: xr.DataArray) -> xr.DataArray:
+    """ Interpolación a la retícula de SubX con interp_like (antes de Regridder). """
+    return da.interp_like(destino)
+
+
+def leer_hindcast(archivo: str, fecha: dt.datetime) -> xr.Dataset:
+    """ Fecha de inicio del hindcast leída del archivo original (antes de open_hindcast_start). """
+    hcst = xr.open_dataset(archivo, decode_timedelta=True)
+    if hcst.S.dt.year[0] != 1960:
+        hcst['S'] = xr.apply_ufunc(change_year, hcst['S'], vectorize=True)
+    return hcst.sel(S=dt.datetime(1960, int(fecha.month), int(fecha.day))).load()
+
+
+def ventana_climatologia(archivo: str, variable: str, f1, f2) -> xr.DataArray:
+    """ Días [f1, f2] de la climatología diaria, extendida con una copia de enero/febrero (antes de get_climatology_window). """
+    media0 = xr.open_dataset(archivo, engine='netcdf4', decode_timedelta=True)
+    media1 = media0.sel(S=slice('1960-01-01', '1960-02-28')).copy()
+    new_time_coords = pd.date_range(start='1961-01-01', end='1961-02-28', freq='D')
+    media1 = media1.assign_coords(time=('S', new_time_coords))
+    media1 = media1.swap_dims({'S': 'time'})
+    media1 = media1.drop_vars('S')
+    media1 = media1.rename({'time':'S'})
+    #
+    media = xr.concat([media0, media1], dim='S', coords='different', compat='equals')
+    media = media[variable].sel(S=slice(f1, f2))
+    if ({'longitude', 'latitude'}).issubset(media.dims):
+        media = media.rename({'longitude': 'X','latitude': 'Y'})
+    if ({'lon', 'lat'}).issubset(media.dims):
+        media = media.rename({'lon': 'X','lat': 'Y'})
+    return media
+
+
+def calc_prob_replicado(fcst_m, hcst_m, media_m, pctil_m):
+    """ Probabilidades bajo/sobre el umbral replicando los campos fijos a lo largo de M (antes de calc_prob). """
+    media_f = xr.concat([media_m] * fcst_m.sizes['M'], dim=fcst_m.M, coords='different', compat='equals')
+    pctil_f = xr.concat([pctil_m] * fcst_m.sizes['M'], dim=fcst_m.M, coords='different', compat='equals')
+    hcst_f = xr.concat([hcst_m] * fcst_m.sizes['M'], dim=fcst_m.M, coords='different', compat='equals')
+    new_fcst = fcst_m - hcst_f + media_f
+    with xr.set_options(keep_attrs=True):
+        p1 = 100 * (xr.where(new_fcst < pctil_f, 1., 0.).sum(dim='M') / fcst_m.sizes['M'])
+        p2 = 100 * (xr.where(new_fcst > pctil_f, 1., 0.).sum(dim='M') / fcst_m.sizes['M'])
+    return p1, p2
+
+
+def calc_prob_corr_archivos(p1, p2, variable, modelo, percentil):
+    """ Corrección PAC leyendo los archivos PAC, std_o y std_p de cada semana (antes del archivo consolidado). """
+    cp = 0.2 if str(percentil) in ['20', '80'] else 0.5
+    categorias = [(str(percentil), p1)] if str(percentil) in ['20', '80'] else [('50-', p1), ('50+', p2)]
+    salida = []
+    for categoria, p in categorias:
+        list_corr = []
+        for week in [1,2,3]:
+            f1, f2, f3 = get_pac_source_files(variable, modelo, week, categoria)
+            PAC = xr.open_dataset(f1, engine='netcdf4', decode_timedelta=True)['PAC']
+            std_o = xr.open_dataset(f2, engine='netcdf4', decode_timedelta=True)['std_o']
+            std_p = xr.open_dataset(f3, engine='netcdf4', decode_timedelta=True)['std_p']
+            with xr.set_options(keep_attrs=True):
+                corr_factor = PAC * (std_o / std_p)
+                prob = p.sel(semanas=week) * 0.01
+                p_corr = xr.where(corr_factor > 0, (cp + corr_factor * (prob - cp)), cp)
+                p_corr = 100. * p_corr
+            list_corr.append(p_corr.rename('prob_corr'))
+        p_corr = xr.concat(list_corr, dim='semanas', coords='different', compat='equals')
+        salida.append(p_corr.drop_vars('number') if 'number' in list(p_corr.coords) else p_corr)
+    return salida[0], salida[-1]
+
+
+def calc_prob_corr_extr_iterativo(p1, p2):
+    """ Corrección de extremos tal como se calculaba antes, con iteraciones. """
+    max_iter = 3
+
+    p1_o = p1.copy()
+    p2_o = p2.copy()
+
+    ##################################################
+    # Se trabaja con prob percentil 20
+    negativo = bool((p1 < 0).any().to_numpy().any())
+    i = 1
+    if negativo:
+        while i <= max_iter:
+            with xr.set_options(keep_attrs=True):
+                discrepancy = xr.where(p1 < 0, p1-1, 0)
+                # sumamos la mitad a donde corresponda
+                p2_o = p2 + 0.5 * discrepancy
+            p1_o = p1_o.where(p1 >= 0, 1)
+            i += 1
+    p1_o = p1_o.where(p1_o >= 0, 1)
+
+    ###########
+    positivo = bool((p1 > 100).any().to_numpy().any())
+    i = 1
+    if positivo:
+        while i <= max_iter:
+            with xr.set_options(keep_attrs=True):
+                discrepancy = xr.where(p1 > 100., p1-99, 0)
+                # sumamos la mitad a donde corresponda
+                p2_o = p2 + 0.5 * discrepancy
+            p1_o = p1_o.where(p1 <= 100, 99)
+            i += 1
+    positivo = bool((p1_o > 100).any().to_numpy().any())
+    if positivo:
+        p1_o = p1_o.where(p1_o <= 100, 99)
+
+    ##################################################
+    ##################################################
+    # Se trabaja con prob percentil 80
+    negativo = bool((p2 < 0).any().to_numpy().any())
+    i = 1
+    if negativo:
+        while i <= max_iter:
+            with xr.set_options(keep_attrs=True):
+                discrepancy = xr.where(p2 < 0, p2 - 1, 0)
+                # sumamos la mitad a donde corresponda
+                p1_o = p1 + 0.5 * discrepancy
+            p2_o = p2_o.where(p2 >= 0, 1)
+            i += 1
+    negativo = bool((p2_o < 0).any().to_numpy().any())
+    if negativo:
+        p2_o = p2_o.where(p2_o >= 0, 0.)
+    p2_o = p2_o.where(p2_o >= 0, 0.)
+
+    #
+    positivo = bool((p2 > 100).any().to_numpy().any())
+    i = 1
+    if positivo:
+        while i <= max_iter:
+            with xr.set_options(keep_attrs=True):
+                discrepancy = xr.where(p2 > 100., p2 - 99, 0)
+                # sumamos la mitad a donde corresponda
+                p1_o = p1 + 0.5 * discrepancy
+            p2_o = p2_o.where(p2 <= 100, 99)
+            i += 1
+    positivo = bool((p2_o > 100).any().to_numpy().any())
+    if positivo:
+        p2_o = p2_o.where(p2_o <= 100, 99)
+
+    p1_o = p1_o.where(p1_o >= 0, 1)
+    p1_o = p1_o.where(p1_o <= 100, 99)
+
+    return p1_o, p2_o
@@ -0,0 +1,112 @@
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import logging
+import tempfile
+import pandas as pd
+import matplotlib
+
+from pathlib import Path
+
+try:
+    from setup.config import  GlobalConfig
+    from funciones_extra import parse_date
+    from benchmarks.sinteticos import FORMAS_MODELOS, generar_datos
+    from benchmarks.medicion import medir_etapas, comparar_implementaciones
+    from benchmarks.medicion import leer_referencia, guardar_referencia, buscar_regresiones
+except ImportError:
+    sys.path.append(
+        os.fspath(Path(__file__).parent.parent)
+    )
+    from setup.config import  GlobalConfig
+    from funciones_extra import parse_date
+    from benchmarks.sinteticos import FORMAS_MODELOS, generar_datos
+    from benchmarks.medicion import medir_etapas, comparar_implementaciones
+    from benchmarks.medicion import leer_referencia, guardar_referencia, buscar_regresiones
+
+
+def parse_args() -> argparse.Namespace:
+
+    parser = argparse.ArgumentParser(description='Benchmarks the calibration stages on synthetic data.')
+
+    parser.add_argument('--modelos', type=str, nargs='+', choices=list(FORMAS_MODELOS), default=list(FORMAS_MODELOS),
+                        help='Models to be benchmarked (default: all)')
+    parser.add_argument('--variables', type=str, nargs='+', choices=['pr', 'tas'], default=['pr', 'tas'],
+                        help='Variables to be benchmarked (default: both)')
+    parser.add_argument('--fecha', type=parse_date, default=parse_date('2025-08-20'),
+                        help='Wednesday of the synthetic forecasts')
+    parser.add_argument('--grilla', type=int, nargs=2, default=[50, 50], metavar=('NY', 'NX'),
+                        help='Size of the synthetic forecast grid')
+    parser.add_argument('--carpeta', type=str, default=None,
+                        help='Folder for the synthetic data (default: a temporary folder, deleted at the end)')
+    parser.add_argument('--repeticiones', type=int, default=3, help='Timed repetitions of each stage')
+    parser.add_argument('--chunks', type=int, default=None,
+                        help='Also compare the calibration in blocks of CHUNKS x CHUNKS points (with dask)')
+    parser.add_argument('--referencia', type=str, default=None,
+                        help='JSON file with reference timings: stages slower (or using more memory) are reported as regressions')
+    parser.add_argument('--actualizar-referencia', dest='actualizar', action='store_true',
+                        help='Save the timings of this run as the reference')
+    parser.add_argument('--tolerancia-tiempo', type=float, default=1.3, help='Time regression threshold (ratio)')
+    parser.add_argument('--tolerancia-memoria', type=float, default=1.2, help='Memory regression threshold (ratio)')
+    parser.add_argument('--tolerancia-numerica', type=float, default=1e-9,
+                        help='Maximum difference between accelerated and reference implementations')
+    parser.add_argument('--salida', type=str, default=None, help='JSON file with the results')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    # Catch and parse command-line arguments
+    args: argparse.Namespace = parse_args()
+
+    logging.basicConfig(format='%(asctime)s -- %(levelname)4s -- %(message)s',
+                        datefmt='%Y/%m/%d %I:%M:%S %p', level=logging.WARNING)
+    matplotlib.use('Agg')
+
+    # Los datos sintéticos reemplazan a la carpeta de datos de la configuración
+    config = GlobalConfig.Instance().app_config
+    carpeta = args.carpeta or tempfile.mkdtemp(prefix='benchmarks_')
+    config.carpeta_datos = carpeta
+
+    mediciones, comparaciones = [], []
+    try:
+        for modelo in args.modelos:
+            for variable in args.variables:
+                print(f'Generando datos sintéticos: {modelo} {variable}', file=sys.stderr)
+                generar_datos(modelo, variable, args.fecha, *args.grilla)
+                mediciones += medir_etapas(modelo, variable, args.fecha, carpeta + '/figuras', args.repeticiones)
+                comparaciones += comparar_implementaciones(modelo, variable, args.fecha, args.chunks,
+                                                           args.tolerancia_numerica)
+    finally:
+        if args.carpeta is None:
+            shutil.rmtree(carpeta, ignore_errors=True)
+
+    tabla = pd.DataFrame(mediciones)
+    print(tabla.to_string(index=False, float_format='{:.3f}'.format))
+    print()
+    print(pd.DataFrame(comparaciones).to_string(index=False, float_format='{:.3g}'.format))
+
+    regresiones = []
+    if args.referencia and os.path.isfile(args.referencia):
+        regresiones = buscar_regresiones(mediciones, leer_referencia(args.referencia), args.tolerancia_tiempo,
+                                         args.tolerancia_memoria)
+    if args.referencia and args.actualizar:
+        guardar_referencia(mediciones, args.referencia)
+    diferentes = [c for c in comparaciones if c.distintos > 0]
+
+    if args.salida:
+        with open(args.salida, 'w') as f:
+            json.dump({'mediciones': [m._asdict() for m in mediciones],
+                       'comparaciones': [c._asdict() for c in comparaciones], 'regresiones': regresiones}, f, indent=2)
+
+    for regresion in regresiones:
+        print(f'REGRESIÓN: {regresion}', file=sys.stderr)
+    for c in diferentes:
+        print(f'DIFERENCIA: {c.nombre} {c.modelo} {c.variable}: {c.distintos} valores (máx. {c.max_diferencia:.3g})',
+              file=sys.stderr)
+
+    sys.exit(1 if regresiones or diferentes else 0)
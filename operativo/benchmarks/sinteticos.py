@@ -0,0 +1,185 @@
+
+import os
+import datetime as dt
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from pathlib import Path
+
+from funciones_extra import get_fecha_publicacion
+from setup.config import GlobalConfig
+from stores.pac import CATEGORIAS_PAC, SEMANAS_PAC, get_pac_source_files
+
+
+# Plazos (L) y miembros (M) de cada modelo. CFSv2 es un ensamble con las inicializaciones de los últimos 5 días.
+FORMAS_MODELOS = {
+    'EMC-GEFSv12_CPC': (34, 11),
+    'ECCC-GEPS8': (39, 21),
+    'GMAO-GEOS_V2p1': (45, 4),
+    'NCEP-CFSv2': (45, 4),
+}
+DIAS_CFSV2 = 5
+
+# Grilla de los pronósticos (la de las descargas de IRI, ver gen_url_download) y de los datos de ERA5
+EXTENSION = {'X': (-82., -33.), 'Y': (-57., -8.)}
+PASO_ERA5 = 0.5
+
+# Variables en los archivos de ERA5 (ver mapeo_variables en setup/config.yaml)
+VARIABLES_ERA5 = {'pr': 'rain', 'tas': 'tmean'}
+
+
+def get_carpeta_datos() -> str:
+    return os.fspath(Path(GlobalConfig.Instance().app_config.carpeta_datos))
+
+
+def get_grilla(ny: int, nx: int) -> dict[str, np.ndarray]:
+    return {'Y': np.linspace(*EXTENSION['Y'], ny), 'X': np.linspace(*EXTENSION['X'], nx)}
+
+
+def _campo_base(variable: str, grilla: dict[str, np.ndarray]) -> np.ndarray:
+    # Campo climatológico suave (°C o mm/día), con un gradiente norte-sur y este-oeste
+    yy, xx = np.meshgrid(grilla['Y'], grilla['X'], indexing='ij')
+    if variable == 'tas':
+        return 28. + 0.45 * yy - 0.05 * (xx + 57.)
+    return np.maximum(0.2, 4. + 0.06 * yy - 0.08 * (xx + 57.))
+
+
+def _mascara(grilla: dict[str, np.ndarray]) -> np.ndarray:
+    # Puntos sin dato (un rectángulo sobre el Atlántico), como el mar en algunos productos
+    yy, xx = np.meshgrid(grilla['Y'], grilla['X'], indexing='ij')
+    return (xx > -40.) & (yy < -40.)
+
+
+def _diarios(variable: str, base: np.ndarray, forma: tuple, rng: np.random.Generator) -> np.ndarray:
+    # Valores diarios en las unidades de los modelos: K para tas y kg m-2 s-1 para pr (con días secos)
+    if variable == 'tas':
+        return base + 273.15 + rng.normal(0., 3., forma)
+    lluvia = rng.gamma(0.6, base / 0.6, forma) * (rng.random(forma) > 0.4)
+    return lluvia / 86400.
+
+
+def generar_pronostico(nombre_modelo: str, variable: str, miercoles: dt.datetime,
+                       grilla: dict[str, np.ndarray], rng: np.random.Generator) -> list[str]:
+    """
+    Pronósticos con la estructura de las descargas de IRI (S, M, L, Y, X), en la carpeta de descargas del miércoles.
+    """
+    _, modelo = nombre_modelo.split('-')
+    n_plazos, n_miembros = FORMAS_MODELOS[nombre_modelo]
+    fecha_d = get_fecha_publicacion(nombre_modelo, miercoles)
+    inicios = [fecha_d - dt.timedelta(days=i) for i in range(DIAS_CFSV2)] if modelo == 'CFSv2' else [fecha_d]
+
+    out_folder = get_carpeta_datos() + '/operativo/forecast/' + variable + '/' + miercoles.strftime('%Y%m%d%H%M') + '/'
+    os.makedirs(out_folder, exist_ok=True)
+
+    base, mascara = _campo_base(variable, grilla), _mascara(grilla)
+    archivos = []
+    for inicio in inicios:
+        datos = _diarios(variable, base, (1, n_miembros, n_plazos) + base.shape, rng).astype('float32')
+        datos[..., mascara] = np.nan
+        fcst = xr.DataArray(datos, dims=('S', 'M', 'L', 'Y', 'X'), name=variable,
+                            coords={'S': [pd.Timestamp(inicio)], 'M': np.arange(1., n_miembros + 1),
+                                    'L': pd.to_timedelta(np.arange(n_plazos) + 0.5, unit='D'), **grilla},
+                            attrs={'units': 'K' if variable == 'tas' else 'kg m-2 s-1'})
+        archivo = out_folder + variable + '_' + modelo + '_' + inicio.strftime('%Y%m%d%H%M') + '_forecast.nc'
+        fcst.to_dataset().to_netcdf(archivo)
+        archivos.append(archivo)
+    return archivos
+
+
+def generar_hindcast(nombre_modelo: str, variable: str, grilla: dict[str, np.ndarray],
+                     rng: np.random.Generator) -> str:
+    """
+    Hindcast (media del ensamble) con una fecha de inicio por día del año 1960, como los de la carpeta hindcast.
+    """
+    _, modelo = nombre_modelo.split('-')
+    n_plazos, _ = FORMAS_MODELOS[nombre_modelo]
+    inicios = pd.date_range('1960-01-01', '1960-12-31', freq='D')
+
+    base = _campo_base(variable, grilla)
+    datos = _diarios(variable, base, (len(inicios), n_plazos) + base.shape, rng)
+    if variable == 'tas':
+        # La media del ensamble tiene menos dispersión que cada miembro
+        datos = base + 273.15 + (datos - base - 273.15) / 3.
+    hcst = xr.DataArray(datos.astype('float32'), dims=('S', 'L', 'Y', 'X'), name=variable,
+                        coords={'S': inicios, 'L': pd.to_timedelta(np.arange(n_plazos) + 0.5, unit='D'), **grilla},
+                        attrs={'units': 'K' if variable == 'tas' else 'kg m-2 s-1'})
+
+    os.makedirs(get_carpeta_datos() + '/hindcast', exist_ok=True)
+    archivo = get_carpeta_datos() + '/hindcast/' + variable + '_' + modelo + '_datos.nc'
+    hcst.to_dataset().to_netcdf(archivo)
+    return archivo
+
+
+def generar_climatologia(variable: str, rng: np.random.Generator) -> list[str]:
+    """
+    Climatología diaria suavizada (ClimSmooth) y percentiles 20, 50 y 80 de 1 y 2 semanas de ERA5, en la grilla
+    de ERA5 (latitud decreciente, más extensa que la de los pronósticos) y con fechas en el año 1960.
+    """
+    varn = VARIABLES_ERA5[variable]
+    grilla = {'latitude': np.arange(EXTENSION['Y'][1] + 2., EXTENSION['Y'][0] - 2. - PASO_ERA5 / 2, -PASO_ERA5),
+              'longitude': np.arange(EXTENSION['X'][0] - 2., EXTENSION['X'][1] + 2. + PASO_ERA5 / 2, PASO_ERA5)}
+    base = _campo_base(variable, {'Y': grilla['latitude'], 'X': grilla['longitude']})
+    fechas = pd.date_range('1960-01-01', '1960-12-31', freq='D')
+    ciclo = np.cos(2 * np.pi * (fechas.dayofyear.values - 15) / 366)[:, None, None]
+    dims = ('S', 'latitude', 'longitude')
+
+    carpeta_clim = get_carpeta_datos() + '/clim/' + varn + '/'
+    percentiles = [(pctil, desvio, nombre, dias) for pctil, desvio in [(20, -0.84), (50, 0.), (80, 0.84)]
+                   for nombre, dias in [('weeklymean', 7), ('2weeklymean', 14)]]
+    archivos = [carpeta_clim + varn + 'ClimSmooth.nc'] + \
+        [carpeta_clim + varn + '_' + nombre + '_pctile' + str(pctil) + '_smooth.nc' for pctil, _, nombre, _ in percentiles]
+    if all(os.path.isfile(archivo) for archivo in archivos):
+        # Los archivos son comunes a todos los modelos (y la climatología puede estar abierta, ver open_climatology)
+        return archivos
+
+    os.makedirs(carpeta_clim, exist_ok=True)
+    media = base + (4. if variable == 'tas' else 0.3 * base) * ciclo
+    xr.DataArray(media, dims=dims, coords={'S': fechas, **grilla}, name=varn).to_dataset().to_netcdf(archivos[0])
+
+    # Percentiles de la media (tas) o del acumulado (pr) de 1 y 2 semanas, con un poco de ruido espacial
+    for archivo, (pctil, desvio, nombre, dias) in zip(archivos[1:], percentiles):
+        if variable == 'tas':
+            valores = media + desvio * 1.5
+        else:
+            valores = np.maximum(0., media * dias * (1. + desvio * 0.5))
+        valores = valores + 0.05 * rng.standard_normal(valores.shape)
+        xr.DataArray(valores, dims=dims, coords={'S': fechas, **grilla}, name=varn).to_dataset().to_netcdf(archivo)
+    return archivos
+
+
+def generar_pac(nombre_modelo: str, variable: str, grilla: dict[str, np.ndarray], rng: np.random.Generator) -> list[str]:
+    """
+    Archivos PAC, std_o y std_p de cada semana y categoría (ver get_pac_source_files).
+    """
+    _, modelo = nombre_modelo.split('-')
+    archivos = []
+    forma = (len(grilla['Y']), len(grilla['X']))
+    for categoria in CATEGORIAS_PAC:
+        for week in SEMANAS_PAC:
+            f1, f2, f3 = get_pac_source_files(variable, modelo, week, categoria)
+            os.makedirs(os.path.dirname(f1), exist_ok=True)
+            # La correlación (PAC) disminuye con el plazo
+            for archivo, nombre, valores in [(f1, 'PAC', rng.uniform(-0.2, 0.9 - 0.2 * week, forma)),
+                                            (f2, 'std_o', rng.uniform(0.5, 2., forma)),
+                                            (f3, 'std_p', rng.uniform(0.5, 2., forma))]:
+                xr.DataArray(valores, dims=('Y', 'X'), coords=grilla, name=nombre).to_dataset().to_netcdf(archivo)
+                archivos.append(archivo)
+    return archivos
+
+
+def generar_datos(nombre_modelo: str, variable: str, miercoles: dt.datetime, ny: int = 50, nx: int = 50,
+                  semilla: int = 0) -> dict[str, list[str]]:
+    """
+    Genera en la carpeta_datos de la configuración todos los archivos que lee la calibración de un modelo
+    y una variable para el miércoles guía: pronóstico, hindcast, PAC, climatología diaria y percentiles (estos
+    dos últimos solo si no existen, porque no dependen del modelo).
+    """
+    rng = np.random.default_rng(semilla)
+    grilla = get_grilla(ny, nx)
+    return {
+        'pronostico': generar_pronostico(nombre_modelo, variable, miercoles, grilla, rng),
+        'hindcast': [generar_hindcast(nombre_modelo, variable, grilla, rng)],
+        'pac': generar_pac(nombre_modelo, variable, grilla, rng),
+        'climatologia': generar_climatologia(variable, rng),
+    }
@@ -0,0 +1,151 @@
+
+import datetime as dt
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+
+# Etiqueta de cada semana: 1, 2, 3y4 (3) y 5. Los días previos a la semana 1 quedan con etiqueta 0.
+SEMANAS = [1., 2., 3., 5.]
+
+
+class CalendarioSemanas(object):
+    """
+    Semanas 1, 2, 3y4 y 5 de un pronóstico (dimensión L), un hindcast (L, con fechas en 1960) o una
+    climatología diaria (dimensión S), a partir del miércoles guía. Los límites de las semanas se calculan
+    una sola vez, con searchsorted sobre las fechas, y las agregaciones semanales se hacen con
+    np.add.reduceat sobre los bloques contiguos de cada semana.
+    """
+
+    def __init__(self, dim: str, semanas: np.ndarray, fechas_iniciales: list):
+        self.dim: str = dim
+        self.semanas: np.ndarray = semanas
+        self.fechas_iniciales: list = fechas_iniciales
+
+        # Bloques contiguos de días con la misma semana (las semanas son crecientes a lo largo del plazo)
+        cambios = np.flatnonzero(np.diff(semanas)) + 1
+        self.inicios: np.ndarray = np.concatenate([[0], cambios])
+        self.etiquetas: np.ndarray = semanas[self.inicios]
+        self.largos: np.ndarray = np.diff(np.concatenate([self.inicios, [len(semanas)]]))
+        self.contiguo: bool = bool(np.all(np.diff(self.etiquetas) > 0))
+
+    @staticmethod
+    def _indice(fechas: np.ndarray, fecha: pd.Timestamp) -> int:
+        # Primera posición de la fecha (0 si no está, como argmax sobre una comparación sin coincidencias)
+        i = int(np.searchsorted(fechas, np.datetime64(fecha, 'ns')))
+        return i if i < len(fechas) and fechas[i] == np.datetime64(fecha, 'ns') else 0
+
+    @classmethod
+    def from_data(cls, ds: xr.DataArray | xr.Dataset, miercoles: dt.datetime, hcast: int = 0) -> 'CalendarioSemanas':
+
+        sem1_i, sem2_i, sem3_i, sem4_i = pd.NaT, pd.NaT, pd.NaT, pd.NaT
+
+        # Se utiliza para ajustar con modelos que no sean
+        # GEFS (L=34) ni GEPS8 (L=39) /GEPS7 (L=32)
+        # GEOS_V2p1 (L=45)
+        if 'L' in list(ds.dims):
+
+            N = ds.sizes['L']  # Largo de pronóstico
+            semanas = np.zeros(N)
+
+            # Fechas correspondientes al inicio de las semanas 1, 2 y 3/4 y 5
+            if hcast == 0:
+                f_model = (ds.S+ds.L).values[0]
+                if pd.Timestamp(f_model[0]).date() <= miercoles.date():
+                    # El modelo tiene datos antes del miercoles guía.
+                    # Usamos la primera semana desde el jueves para alinear con GEFS esa semana.
+                    sem1_i = pd.Timestamp(miercoles + dt.timedelta(days=1) + dt.timedelta(hours=12))
+                else:
+                    sem1_i = pd.Timestamp(f_model[0])
+                sem2_i = pd.Timestamp(miercoles + dt.timedelta(days=8) + dt.timedelta(hours=12))
+                sem3_i = pd.Timestamp(miercoles + dt.timedelta(days=15) + dt.timedelta(hours=12))
+                sem4_i = pd.Timestamp(miercoles + dt.timedelta(days=29) + dt.timedelta(hours=12))
+            else:
+                f_model = (ds.S+ds.L).values
+                if pd.Timestamp(f_model[0]).date() <= miercoles.date():
+                    # El modelo tiene datos antes del miercoles guía.
+                    # Usamos la primera semana desde el jueves para alinear con GEFS esa semana.
+                    sem1_i = pd.Timestamp(miercoles + dt.timedelta(days=1) + dt.timedelta(hours=12)).replace(year=1960)
+                else:
+                    sem1_i = pd.Timestamp(f_model[0]).replace(year=1960)
+                sem2_i = pd.Timestamp(miercoles + dt.timedelta(days=8) + dt.timedelta(hours=12)).replace(year=1960)
+                sem3_i = pd.Timestamp(miercoles + dt.timedelta(days=15) + dt.timedelta(hours=12)).replace(year=1960)
+                sem4_i = pd.Timestamp(miercoles + dt.timedelta(days=29) + dt.timedelta(hours=12)).replace(year=1960)
+
+            f_model = np.asarray(f_model, dtype='datetime64[ns]')
+            i1, i2, i3 = [cls._indice(f_model, f) for f in (sem1_i, sem2_i, sem3_i)]
+            semanas[i1:i2] = 1
+            semanas[i2:i2+7] = 2
+            semanas[i3:i3+14] = 3
+            semanas[i3+14:] = 5
+            dim = 'L'
+
+        else:
+
+            N = ds.sizes['S']  # Largo de pronóstico
+            semanas = np.ones(N)
+            f_model = np.asarray(ds.S.values, dtype='datetime64[ns]')
+
+            if pd.Timestamp(f_model[0]) <= miercoles:
+                # El modelo tiene datos antes del miercoles guía.
+                # Usamos la primera semana desde el jueves para alinear con GEFS esa semana.
+                sem1_i = pd.Timestamp(miercoles + dt.timedelta(days=1) + dt.timedelta(hours=12))
+            else:
+                sem1_i = pd.Timestamp(f_model[0])
+
+            sem2_i = pd.Timestamp(miercoles.replace(year=1960) + dt.timedelta(days=8))
+            sem3_i = pd.Timestamp(miercoles.replace(year=1960) + dt.timedelta(days=15))
+            sem4_i = pd.Timestamp(miercoles.replace(year=1960) + dt.timedelta(days=29))
+
+            # Indice correspondiente a inicio semana 2 y 3
+            i2, i3 = [cls._indice(f_model, f) for f in (sem2_i, sem3_i)]
+            semanas[i2:i2+7] = 2
+            semanas[i3:i3+14] = 3
+            semanas[i3+14:] = 5
+            dim = 'S'
+
+        fechas_iniciales = [a.date() for a in [sem1_i, sem2_i, sem3_i, sem4_i]]
+
+        return cls(dim, semanas, fechas_iniciales)
+
+    def assign_to(self, ds: xr.DataArray | xr.Dataset) -> xr.DataArray | xr.Dataset:
+        return ds.assign_coords(semanas=(self.dim, self.semanas))
+
+    def _reducir(self, datos: np.ndarray, agregacion: str) -> np.ndarray:
+        # La dimensión de las semanas está en el último eje
+        nulos = np.isnan(datos)
+        if nulos.any():
+            # Como groupby: se ignoran los faltantes (una suma sin datos es 0, una media sin datos es NaN)
+            suma = np.add.reduceat(np.where(nulos, 0, datos), self.inicios, axis=-1)
+            if agregacion == 'sum':
+                return suma
+            n = np.add.reduceat(~nulos, self.inicios, axis=-1).astype(datos.dtype)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return suma / n
+        suma = np.add.reduceat(datos, self.inicios, axis=-1)
+        if agregacion == 'sum':
+            return suma
+        return suma / self.largos.astype(datos.dtype)
+
+    def aggregate(self, da: xr.DataArray, agregacion: str = 'mean') -> xr.DataArray:
+        """
+        Media ('mean') o suma ('sum') semanal de da a lo largo de la dimensión del calendario. Equivale a
+        da.assign_coords(semanas=...).groupby('semanas').mean/sum(dim=...), con la dimensión semanas en lugar
+        de la dimensión agregada.
+        """
+        if not self.contiguo:
+            agrupado = self.assign_to(da).groupby('semanas')
+            return agrupado.mean(dim=self.dim) if agregacion == 'mean' else agrupado.sum(dim=self.dim)
+
+        dims = [d if d != self.dim else 'semanas' for d in da.dims]
+        if da.chunks is not None:
+            # Datos por bloques: cada bloque debe tener todos los días
+            da = da.chunk({self.dim: -1})
+        semanal = xr.apply_ufunc(self._reducir, da, kwargs={'agregacion': agregacion},
+                                 input_core_dims=[[self.dim]], output_core_dims=[['semanas']],
+                                 exclude_dims={self.dim}, keep_attrs=True,
+                                 dask='parallelized', output_dtypes=[da.dtype],
+                                 dask_gufunc_kwargs={'output_sizes': {'semanas': len(self.etiquetas)}})
+        semanal = semanal.assign_coords(semanas=('semanas', self.etiquetas))
+
+        return semanal.transpose(*dims)
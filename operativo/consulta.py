@@ -0,0 +1,234 @@
+
+import os
+import logging
+import datetime as dt
+import numpy as np
+import pandas as pd
+import shapely
+import shapely.affinity
+import xarray as xr
+
+from pathlib import Path
+
+from etapas import Calibracion, PERCENTILES_SALIDA, calibrar
+from funciones_extra import get_fecha_publicacion
+from prob_funciones import DIM_CELDA
+from stores.historico import DIM_INICIO, abrir_historico, seleccionar_inicios
+from stores.productos import get_producto_path, abrir_producto, separar_categorias
+
+from setup.config import  GlobalConfig
+
+
+# Nombre y duración (días) de las semanas de las probabilidades
+NOMBRES_SEMANAS = {1.: '1', 2.: '2', 3.: '3y4'}
+DURACION_SEMANAS = {1.: 7, 2.: 7, 3.: 14}
+
+
+def get_grilla(nombre_modelo: str, variable: str) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Coordenadas X e Y de la grilla del modelo (las del hindcast, que son las del pronóstico). Solo se leen las coordenadas.
+    """
+    config = GlobalConfig.Instance().app_config
+    _, modelo = nombre_modelo.split('-')
+    archivo = os.fspath(Path(f'{config.carpeta_datos}/hindcast/{variable}_{modelo}_datos.nc'))
+    with xr.open_dataset(archivo, decode_times=False) as hcst:
+        return hcst.X.values, hcst.Y.values
+
+
+def _bordes(centros: np.ndarray) -> np.ndarray:
+    # Bordes de las celdas: puntos medios entre centros, y medio paso más allá de los extremos
+    medios = (centros[1:] + centros[:-1]) / 2
+    return np.concatenate([[2 * centros[0] - medios[0]], medios, [2 * centros[-1] - medios[-1]]])
+
+
+def _indexadores(x: np.ndarray, y: np.ndarray) -> dict[str, xr.DataArray]:
+    return {'X': xr.DataArray(x, dims=DIM_CELDA), 'Y': xr.DataArray(y, dims=DIM_CELDA)}
+
+
+def celdas_puntos(X: np.ndarray, Y: np.ndarray, lons, lats) -> tuple[dict[str, xr.DataArray], np.ndarray]:
+    """
+    Celdas de la grilla (X, Y) que contienen a cada punto. Devuelve los indexadores de las celdas (sin repetir),
+    para calibrar(celdas=...), y el índice de la celda de cada punto.
+    """
+    lons, lats = np.asarray(lons, dtype=float), np.asarray(lats, dtype=float)
+    if X.max() > 180:
+        # Grilla con longitudes 0-360
+        lons = np.mod(lons, 360)
+
+    bordes_x, bordes_y = _bordes(X), _bordes(Y)
+    fuera = (lons < bordes_x.min()) | (lons > bordes_x.max()) | (lats < bordes_y.min()) | (lats > bordes_y.max())
+    if fuera.any():
+        raise ValueError(f'Hay puntos fuera de la grilla del modelo (posiciones {np.flatnonzero(fuera).tolist()})')
+
+    ix = np.abs(X[None, :] - lons[:, None]).argmin(axis=1)
+    iy = np.abs(Y[None, :] - lats[:, None]).argmin(axis=1)
+    pares, indice = np.unique(np.stack([iy, ix], axis=1), axis=0, return_inverse=True)
+
+    return _indexadores(X[pares[:, 1]], Y[pares[:, 0]]), indice.ravel()
+
+
+def celdas_poligono(X: np.ndarray, Y: np.ndarray, poligono: shapely.Geometry) -> tuple[dict[str, xr.DataArray], np.ndarray]:
+    """
+    Celdas de la grilla (X, Y) que intersecan al polígono. Devuelve los indexadores de las celdas, para
+    calibrar(celdas=...), y la fracción de cada celda cubierta por el polígono.
+    """
+    if X.max() > 180 and poligono.bounds[0] < 0:
+        # Grilla con longitudes 0-360
+        poligono = shapely.affinity.translate(poligono, xoff=360)
+
+    bordes_x, bordes_y = _bordes(X), _bordes(Y)
+    iy, ix = [i.ravel() for i in np.meshgrid(np.arange(len(Y)), np.arange(len(X)), indexing='ij')]
+    cajas = shapely.box(np.minimum(bordes_x[ix], bordes_x[ix+1]), np.minimum(bordes_y[iy], bordes_y[iy+1]),
+                        np.maximum(bordes_x[ix], bordes_x[ix+1]), np.maximum(bordes_y[iy], bordes_y[iy+1]))
+
+    shapely.prepare(poligono)
+    seleccion = shapely.intersects(cajas, poligono) & ~shapely.touches(cajas, poligono)
+    if not seleccion.any():
+        raise ValueError('El polígono no cubre ninguna celda de la grilla del modelo')
+    fracciones = shapely.area(shapely.intersection(cajas[seleccion], poligono)) / shapely.area(cajas[seleccion])
+
+    return _indexadores(X[ix[seleccion]], Y[iy[seleccion]]), fracciones
+
+
+def tabla_probabilidades(calibracion: Calibracion) -> pd.DataFrame:
+    """
+    Probabilidades de una calibración por celdas en formato largo: una fila por celda, semana y categoría.
+    """
+    filas = []
+    for categoria in PERCENTILES_SALIDA:
+        prob = calibracion.probabilidades[categoria].transpose(DIM_CELDA, 'semanas')
+        n_celdas, n_semanas = prob.shape
+        semanas = prob.semanas.values
+        inicios = [pd.Timestamp(calibracion.fechas_v[int(s) - 1]) for s in semanas]
+        filas.append(pd.DataFrame({
+            'celda': np.repeat(np.arange(n_celdas), n_semanas),
+            'X': np.repeat(prob.X.values, n_semanas),
+            'Y': np.repeat(prob.Y.values, n_semanas),
+            'semana': np.tile([NOMBRES_SEMANAS[s] for s in semanas], n_celdas),
+            'fecha_inicio': np.tile(inicios, n_celdas),
+            'fecha_fin': np.tile([f + dt.timedelta(days=DURACION_SEMANAS[s] - 1) for f, s in zip(inicios, semanas)], n_celdas),
+            'categoria': categoria,
+            'probabilidad': prob.values.ravel(),
+        }))
+
+    return pd.concat(filas, ignore_index=True)
+
+
+def calibrar_celdas(nombre_modelo: str, variable: str, miercoles: dt.datetime,
+                    celdas: dict[str, xr.DataArray]) -> Calibracion:
+    """
+    Probabilidades de un conjunto de celdas. Si ya existe el producto del pronóstico (ver stores/productos.py), se
+    leen de él, así que coinciden con las publicadas. Si no, se calibran solo esas celdas: la corrección de extremos
+    (calc_prob_corr_extr) se decide con los valores fuera de rango de las celdas consultadas y no con los de toda la
+    grilla, así que en las celdas fuera de rango puede diferir de la del producto que se publique.
+    """
+    fecha_d = get_fecha_publicacion(nombre_modelo, miercoles)
+    _, modelo = nombre_modelo.split('-')
+    archivo = get_producto_path(variable, modelo, miercoles, fecha_d)
+    if os.path.isfile(archivo):
+        producto = abrir_producto(archivo).sel(celdas)
+        return Calibracion(fecha_d, list(pd.DatetimeIndex(producto['S'].values)), separar_categorias(producto))
+
+    logging.warning(f'No existe el producto {archivo}: se calibran solo las celdas consultadas')
+    return calibrar(nombre_modelo, variable, miercoles, celdas=celdas)
+
+
+def consultar_puntos(nombre_modelo: str, variable: str, miercoles: dt.datetime, puntos: pd.DataFrame) -> pd.DataFrame:
+    """
+    Probabilidades calibradas en un conjunto de puntos (columnas nombre, lon y lat), en las celdas de la grilla que
+    contienen a los puntos (ver calibrar_celdas). Devuelve una fila por punto, semana y categoría.
+    """
+    X, Y = get_grilla(nombre_modelo, variable)
+    celdas, indice = celdas_puntos(X, Y, puntos['lon'], puntos['lat'])
+    tabla = tabla_probabilidades(calibrar_celdas(nombre_modelo, variable, miercoles, celdas))
+
+    puntos = puntos[['nombre', 'lon', 'lat']].reset_index(drop=True).assign(celda=indice)
+    return puntos.merge(tabla, on='celda', how='left').drop(columns='celda')
+
+
+def consultar_poligono(nombre_modelo: str, variable: str, miercoles: dt.datetime, poligono: shapely.Geometry,
+                       agregar: bool = True) -> pd.DataFrame:
+    """
+    Probabilidades calibradas en un polígono (p.e. una cuenca), en las celdas de la grilla que intersecan al polígono
+    (ver calibrar_celdas). Con agregar, devuelve el promedio de las celdas pesado por la superficie cubierta
+    (fracción de la celda y coseno de la latitud), una fila por semana y categoría; si no, una fila por celda.
+    """
+    X, Y = get_grilla(nombre_modelo, variable)
+    celdas, fracciones = celdas_poligono(X, Y, poligono)
+    tabla = tabla_probabilidades(calibrar_celdas(nombre_modelo, variable, miercoles, celdas))
+    tabla['fraccion'] = fracciones[tabla['celda']]
+    if not agregar:
+        return tabla.drop(columns='celda')
+
+    # Las celdas sin dato (p.e. sobre el mar en precipitación) no se consideran
+    peso = (tabla['fraccion'] * np.cos(np.deg2rad(tabla['Y']))).where(tabla['probabilidad'].notna(), 0.)
+    tabla = tabla.assign(peso=peso, ponderada=tabla['probabilidad'].fillna(0.) * peso)
+    resumen = tabla.groupby(['semana', 'fecha_inicio', 'fecha_fin', 'categoria'], sort=False) \
+        .agg(ponderada=('ponderada', 'sum'), peso=('peso', 'sum'), celdas=('probabilidad', 'count')).reset_index()
+    resumen['probabilidad'] = resumen['ponderada'] / resumen['peso'].where(resumen['peso'] > 0)
+
+    return resumen.drop(columns=['ponderada', 'peso'])
+
+
+def leer_historia(nombre_modelo: str, variable: str, celdas: dict[str, xr.DataArray], categorias: list[str] | None = None,
+                  desde: dt.datetime | None = None, hasta: dt.datetime | None = None) -> xr.DataArray:
+    """
+    Probabilidades del histórico (ver stores/historico.py) en un conjunto de celdas, con una sola lectura del
+    archivo: dimensiones inicio (ordenada), categoria, semanas y celda.
+    """
+    _, modelo = nombre_modelo.split('-')
+    with abrir_historico(variable, modelo) as historico:
+        prob = historico['prob'].isel({DIM_INICIO: seleccionar_inicios(historico, desde, hasta)})
+        if categorias is not None:
+            prob = prob.sel(categoria=categorias)
+        return prob.sel(celdas).load()
+
+
+def tabla_historia(prob: xr.DataArray) -> pd.DataFrame:
+    """
+    Probabilidades del histórico por celdas en formato largo: una fila por celda, pronóstico, semana y categoría.
+    """
+    tabla = prob.drop_vars('miercoles').to_dataframe(name='probabilidad').reset_index()
+    tabla = tabla.rename(columns={'semanas': 'semana', 'S': 'fecha_inicio'})
+    tabla['fecha_fin'] = tabla['fecha_inicio'] + pd.to_timedelta(tabla['semana'].map(DURACION_SEMANAS) - 1, unit='D')
+    tabla['semana'] = tabla['semana'].map(NOMBRES_SEMANAS)
+    return tabla[['celda', 'X', 'Y', DIM_INICIO, 'semana', 'fecha_inicio', 'fecha_fin', 'categoria', 'probabilidad']]
+
+
+def historia_puntos(nombre_modelo: str, variable: str, puntos: pd.DataFrame, categorias: list[str] | None = None,
+                    desde: dt.datetime | None = None, hasta: dt.datetime | None = None) -> pd.DataFrame:
+    """
+    Evolución de las probabilidades en un conjunto de puntos (columnas nombre, lon y lat) a lo largo de los
+    pronósticos guardados en el histórico. Devuelve una fila por punto, pronóstico, semana y categoría.
+    """
+    _, modelo = nombre_modelo.split('-')
+    with abrir_historico(variable, modelo) as historico:
+        X, Y = historico.X.values, historico.Y.values
+    celdas, indice = celdas_puntos(X, Y, puntos['lon'], puntos['lat'])
+    tabla = tabla_historia(leer_historia(nombre_modelo, variable, celdas, categorias, desde, hasta))
+
+    puntos = puntos[['nombre', 'lon', 'lat']].reset_index(drop=True).assign(celda=indice)
+    return puntos.merge(tabla, on='celda', how='left').drop(columns='celda')
+
+
+def historia_poligono(nombre_modelo: str, variable: str, poligono: shapely.Geometry, categorias: list[str] | None = None,
+                      desde: dt.datetime | None = None, hasta: dt.datetime | None = None) -> pd.DataFrame:
+    """
+    Evolución de las probabilidades en un polígono a lo largo de los pronósticos guardados en el histórico: el
+    promedio de las celdas pesado como en consultar_poligono. Devuelve una fila por pronóstico, semana y categoría.
+    """
+    _, modelo = nombre_modelo.split('-')
+    with abrir_historico(variable, modelo) as historico:
+        X, Y = historico.X.values, historico.Y.values
+    celdas, fracciones = celdas_poligono(X, Y, poligono)
+    prob = leer_historia(nombre_modelo, variable, celdas, categorias, desde, hasta)
+
+    # Las celdas sin dato no se consideran
+    peso = xr.DataArray(fracciones, dims=DIM_CELDA) * np.cos(np.deg2rad(prob.Y))
+    peso = peso.where(prob.notnull(), 0.)
+    promedio = (prob.fillna(0.) * peso).sum(DIM_CELDA) / peso.sum(DIM_CELDA).where(peso.sum(DIM_CELDA) > 0)
+    celdas_validas = prob.notnull().sum(DIM_CELDA)
+
+    tabla = tabla_historia(promedio.expand_dims(DIM_CELDA).assign_coords(X=np.nan, Y=np.nan))
+    tabla['celdas'] = celdas_validas.transpose(*promedio.dims).values.ravel()
+    return tabla.drop(columns=['celda', 'X', 'Y'])
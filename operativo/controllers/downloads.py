@@ -0,0 +1,202 @@
+
+import os
+import json
+import hashlib
+import time
+import logging
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from controllers.metricas import contar
+from decorators.singleton import Singleton
+from errors.downloads import RemoteFileNotFound, InvalidRemoteFile
+from setup.config import GlobalConfig
+from stores.archivos import escritura_atomica
+
+
+# Cabeceras de netCDF clásico (CDF1, CDF2, CDF5) y de netCDF4/HDF5
+NETCDF_SIGNATURES = (b'CDF\x01', b'CDF\x02', b'CDF\x05', b'\x89HDF\r\n\x1a\n')
+
+
+class DownloadResult(NamedTuple):
+    path: str
+    refreshed: bool  # True when the file content changed (or the file is new)
+
+
+@Singleton
+class DownloadManager:
+    """
+    Downloads files over a single HTTP session, so connections to the server are reused,
+    and fetches several files concurrently with a bounded thread pool.
+    """
+
+    def __init__(self):
+        config = GlobalConfig.Instance().app_config
+        self.max_workers: int = int(config.descargas.max_concurrentes)
+        self.timeout: float = float(config.descargas.timeout)
+        self.chunk_size: int = 1024 * 1024
+        self.max_resumes: int = int(config.descargas.reintentos)
+
+        retries = Retry(total=int(config.descargas.reintentos), backoff_factor=2,
+                        status_forcelist=[429, 500, 502, 503, 504], allowed_methods=['GET', 'HEAD'])
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_workers, max_retries=retries)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    @staticmethod
+    def meta_path(out_file: str) -> str:
+        return out_file + '.meta.json'
+
+    def read_meta(self, out_file: str) -> dict | None:
+        meta_file = self.meta_path(out_file)
+        if not os.path.isfile(out_file) or not os.path.isfile(meta_file):
+            return None
+        with open(meta_file, 'r') as f:
+            return json.load(f)
+
+    def write_meta(self, out_file: str, meta: dict):
+        # Temporal único: dos procesos pueden escribir los metadatos del mismo archivo a la vez
+        with escritura_atomica(self.meta_path(out_file)) as temporal, open(temporal, 'w') as f:
+            json.dump(meta, f, indent=2)
+
+    def file_sha256(self, out_file: str) -> str:
+        sha256 = hashlib.sha256()
+        with open(out_file, 'rb') as file_obj:
+            while chunk := file_obj.read(self.chunk_size):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    @staticmethod
+    def is_netcdf(file_path: str) -> bool:
+        with open(file_path, 'rb') as file_obj:
+            return file_obj.read(8).startswith(NETCDF_SIGNATURES)
+
+    def exists(self, url: str) -> bool:
+        """
+        Checks with a HEAD request (no content is transferred) whether url is available on the server.
+        """
+        r = self.session.head(url, timeout=self.timeout, allow_redirects=True)
+        if r.status_code == 404 or r.headers.get('Content-Type', '').startswith('text/html'):
+            return False
+        r.raise_for_status()
+        return True
+
+    def transfer(self, url: str, part_file: str, headers: dict) -> dict | None:
+        """
+        Streams url into part_file, appending to it (HTTP Range) if a previous transfer of the same
+        remote version was interrupted. Returns the metadata of the remote file, or None if the server
+        answered 304 (not modified).
+        """
+        part_meta = self.read_meta(part_file)
+        offset = os.path.getsize(part_file) if part_meta is not None and part_meta['url'] == url else 0
+        headers = dict(headers)
+        if offset:
+            # If-Range: si el archivo cambió en el servidor, se recibe completo (200) y no la parte faltante
+            headers.pop('If-None-Match', None)
+            headers.pop('If-Modified-Since', None)
+            headers['Range'] = f'bytes={offset}-'
+            if part_meta.get('etag') or part_meta.get('last_modified'):
+                headers['If-Range'] = part_meta.get('etag') or part_meta['last_modified']
+
+        with self.session.get(url, stream=True, timeout=self.timeout, headers=headers) as r:
+            # Primero los códigos de estado: las respuestas 404 y 416 del servidor son páginas HTML
+            if r.status_code == 304:
+                return None
+            if r.status_code == 404:
+                raise RemoteFileNotFound(url)
+            if r.status_code == 416 and offset:
+                # La parte descargada previamente ya estaba completa
+                return part_meta
+            r.raise_for_status()
+            if r.headers.get('Content-Type', '').startswith('text/html'):
+                # Las páginas de error son pequeñas, se pueden leer completas
+                if '<title>Error 404 Not Found</title>' in r.text:
+                    raise RemoteFileNotFound(url)
+                raise InvalidRemoteFile(url, f'unexpected Content-Type {r.headers["Content-Type"]}')
+
+            if r.status_code == 206 and not r.headers.get('Content-Range', '').startswith(f'bytes {offset}-'):
+                raise InvalidRemoteFile(url, f'unexpected Content-Range {r.headers.get("Content-Range")}')
+            if r.status_code == 206:
+                logging.info(f'######## - Reanudando descarga desde el byte {offset}: {part_file}')
+                meta, mode = part_meta, 'ab'
+            else:
+                meta, mode = {'url': url, 'etag': r.headers.get('ETag'),
+                              'last_modified': r.headers.get('Last-Modified')}, 'wb'
+                self.write_meta(part_file, meta)
+            recibidos, inicio = 0, time.perf_counter()
+            try:
+                with open(part_file, mode) as file_obj:
+                    for chunk in r.iter_content(chunk_size=self.chunk_size):
+                        file_obj.write(chunk)
+                        recibidos += len(chunk)
+            finally:
+                # Los bytes de una transferencia interrumpida también cuentan (ver controllers.metricas)
+                contar('bytes_descargados', recibidos)
+            segundos = time.perf_counter() - inicio
+            logging.info(f'######## - {recibidos / 1024 ** 2:.1f} MB en {segundos:.1f} s '
+                         f'({recibidos / 1024 ** 2 / max(segundos, 1e-6):.1f} MB/s): {part_file}')
+
+        return meta
+
+    def download(self, url: str, out_file: str) -> DownloadResult:
+        """
+        Downloads url into out_file. The content is streamed into a temporary .part file, which is
+        resumed after a failure and only renamed into place once it is complete and looks like a
+        netCDF file. If out_file was already downloaded, the request is conditional (ETag /
+        Last-Modified stored in the metadata file next to it) and the transfer is skipped when the
+        server reports no changes. Otherwise, the content hash tells whether it changed.
+        """
+        meta = self.read_meta(out_file)
+        headers = {}
+        if meta is not None:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        previous_sha256 = meta['sha256'] if meta is not None \
+            else self.file_sha256(out_file) if os.path.isfile(out_file) else None
+
+        part_file = out_file + '.part'
+        logging.info(f'######## - Guardando archivo en: {out_file}')
+        for attempt in range(self.max_resumes + 1):
+            try:
+                new_meta = self.transfer(url, part_file, headers)
+                break
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                if attempt == self.max_resumes:
+                    raise
+                logging.warning(f'######## - Descarga interrumpida ({e}), reintentando: {out_file}')
+
+        if new_meta is None:
+            logging.info(f'######## - Sin cambios en el servidor: {out_file}')
+            return DownloadResult(out_file, False)
+
+        if not self.is_netcdf(part_file):
+            os.remove(part_file)
+            os.remove(self.meta_path(part_file))
+            raise InvalidRemoteFile(url, 'missing netCDF/HDF5 signature')
+        new_meta = {**new_meta, 'sha256': self.file_sha256(part_file), 'size': os.path.getsize(part_file)}
+        os.replace(part_file, out_file)
+        self.write_meta(out_file, new_meta)
+        os.remove(self.meta_path(part_file))
+
+        refreshed = new_meta['sha256'] != previous_sha256
+        if not refreshed:
+            logging.info(f'######## - El archivo descargado no cambió: {out_file}')
+        return DownloadResult(out_file, refreshed)
+
+    def download_many(self, downloads: list[tuple[str, str]]) -> list[DownloadResult]:
+        """
+        Downloads every (url, out_file) pair concurrently. All downloads are allowed to finish,
+        then the first error (in the given order), if any, is raised.
+        """
+        if not downloads:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(downloads))) as pool:
+            futures = [pool.submit(self.download, url, out_file) for url, out_file in downloads]
+        return [f.result() for f in futures]
@@ -0,0 +1,260 @@
+
+import os
+import json
+import time
+import resource
+import threading
+import datetime as dt
+
+from contextlib import contextmanager
+
+from stores.archivos import escritura_atomica
+
+
+# Archivos de Linux con la memoria y las lecturas/escrituras del proceso
+PROC_STATUS = '/proc/self/status'
+PROC_IO = '/proc/self/io'
+PROC_CLEAR_REFS = '/proc/self/clear_refs'
+
+# Campos de /proc/self/io: rchar/wchar son todos los bytes leídos/escritos con read/write (también los del caché
+# de páginas), read_bytes/write_bytes solo los que llegaron al disco
+CAMPOS_IO = {
+    'bytes_leidos': 'rchar',
+    'bytes_escritos': 'wchar',
+    'bytes_leidos_disco': 'read_bytes',
+    'bytes_escritos_disco': 'write_bytes',
+}
+
+# Métricas de cada etapa en el archivo de Prometheus: (campo del registro, nombre, descripción)
+METRICAS_PROMETHEUS = [
+    ('segundos', 'operativo_etapa_segundos', 'Wall time of the stage'),
+    ('cpu_segundos', 'operativo_etapa_cpu_segundos', 'CPU time of the stage, including finished child processes'),
+    ('rss_max_bytes', 'operativo_etapa_rss_max_bytes', 'Peak resident memory of the process during the stage'),
+    ('rss_max_hijos_bytes', 'operativo_etapa_rss_max_hijos_bytes', 'Peak resident memory of the child processes'),
+    ('bytes_leidos', 'operativo_etapa_bytes_leidos', 'Bytes read during the stage'),
+    ('bytes_escritos', 'operativo_etapa_bytes_escritos', 'Bytes written during the stage'),
+    ('bytes_descargados', 'operativo_etapa_bytes_descargados', 'Bytes downloaded during the stage'),
+    ('descarga_bytes_por_segundo', 'operativo_etapa_descarga_bytes_por_segundo', 'Download throughput of the stage'),
+    ('llamadas', 'operativo_etapa_llamadas', 'Times the stage was run'),
+]
+
+
+def leer_rss_max() -> int:
+    """ Pico de memoria residente del proceso (VmHWM), en bytes. """
+    try:
+        with open(PROC_STATUS, 'r') as f:
+            for linea in f:
+                if linea.startswith('VmHWM:'):
+                    return int(linea.split()[1]) * 1024
+    except OSError:
+        pass
+    # Sin /proc: el pico desde el inicio del proceso (ru_maxrss está en kB en Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def reiniciar_rss_max() -> bool:
+    # Desde Linux 4.0, escribir 5 en clear_refs lleva VmHWM a la memoria residente actual
+    try:
+        with open(PROC_CLEAR_REFS, 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def leer_io() -> dict[str, int]:
+    try:
+        with open(PROC_IO, 'r') as f:
+            valores = dict(linea.split(':') for linea in f if ':' in linea)
+    except OSError:
+        return {}
+    return {clave: int(valores[campo]) for clave, campo in CAMPOS_IO.items() if campo in valores}
+
+
+class Metricas(object):
+    """
+    Tiempo real, tiempo de CPU, pico de memoria residente y bytes leídos/escritos de cada etapa de un script
+    (ver etapa), más los contadores que registren las etapas (p.e. los bytes descargados, ver contar). Las etapas
+    pueden anidarse (p.e. lectura dentro de calibracion) y las que se repiten se acumulan en un único registro.
+    El pico de memoria se reinicia al comenzar cada etapa, así que es el de la etapa y no el del proceso.
+    """
+
+    def __init__(self, script_name: str):
+        self.script_name: str = script_name
+        self.inicio: dt.datetime | None = None
+        self.reloj: float = time.perf_counter()
+        self.rss_max: int = 0
+        self.etapas: dict[str, dict] = {}  # registros por nombre de etapa, en el orden en que comenzaron
+        self.abiertas: list[dict] = []
+        self.lock = threading.Lock()
+
+    def iniciar(self):
+        global _activas
+        self.inicio = dt.datetime.now(dt.timezone.utc)
+        self.reloj = time.perf_counter()
+        _activas = self
+
+    def detener(self):
+        global _activas
+        if _activas is self:
+            _activas = None
+
+    @staticmethod
+    def _estado() -> dict:
+        hijos = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return {'reloj': time.perf_counter(), 'cpu_hijos': hijos.ru_utime + hijos.ru_stime,
+                'cpu': time.process_time(), 'rss_hijos': hijos.ru_maxrss * 1024, 'io': leer_io()}
+
+    def _actualizar_rss(self):
+        # El pico leído corresponde a todas las etapas abiertas (se reinicia al comenzar cada una)
+        rss = leer_rss_max()
+        with self.lock:
+            self.rss_max = max(self.rss_max, rss)
+            for abierta in self.abiertas:
+                abierta['rss_max'] = max(abierta['rss_max'], rss)
+
+    @contextmanager
+    def etapa(self, nombre: str):
+        self._actualizar_rss()
+        reiniciar_rss_max()
+        with self.lock:
+            padre = self.abiertas[-1]['nombre'] if self.abiertas else None
+            self.etapas.setdefault(nombre, {'padre': padre, 'llamadas': 0, 'segundos': 0., 'cpu_segundos': 0.,
+                                            'rss_max_bytes': 0, 'rss_max_hijos_bytes': 0})
+            abierta = {'nombre': nombre, 'inicial': self._estado(), 'rss_max': 0, 'contadores': {}}
+            self.abiertas.append(abierta)
+        try:
+            yield abierta['contadores']
+        finally:
+            self._actualizar_rss()
+            with self.lock:
+                self.abiertas.remove(abierta)
+            self._registrar(abierta, self._estado())
+
+    def contar(self, contador: str, valor: int | float):
+        # Se suma en todas las etapas abiertas (puede llamarse desde varios hilos, p.e. las descargas)
+        with self.lock:
+            for abierta in self.abiertas:
+                abierta['contadores'][contador] = abierta['contadores'].get(contador, 0) + valor
+
+    def _registrar(self, abierta: dict, final: dict):
+        inicial = abierta['inicial']
+        registro = self.etapas[abierta['nombre']]
+        cpu_hijos = final['cpu_hijos'] - inicial['cpu_hijos']
+        registro['llamadas'] += 1
+        registro['segundos'] += final['reloj'] - inicial['reloj']
+        registro['cpu_segundos'] += final['cpu'] - inicial['cpu'] + cpu_hijos
+        registro['rss_max_bytes'] = max(registro['rss_max_bytes'], abierta['rss_max'])
+        if cpu_hijos > 0:
+            # Pico de los procesos hijos terminados hasta el fin de la etapa (la etapa usó procesos hijos)
+            registro['rss_max_hijos_bytes'] = max(registro['rss_max_hijos_bytes'], final['rss_hijos'])
+        for clave, valor in final['io'].items():
+            registro[clave] = registro.get(clave, 0) + valor - inicial['io'].get(clave, valor)
+        for contador, valor in abierta['contadores'].items():
+            registro[contador] = registro.get(contador, 0) + valor
+
+    def resumen(self) -> dict:
+        """
+        Registro de la ejecución: duración, CPU y pico de memoria del script y el registro de cada etapa.
+        """
+        self._actualizar_rss()
+        hijos = resource.getrusage(resource.RUSAGE_CHILDREN)
+        etapas = []
+        for nombre, registro in self.etapas.items():
+            registro = {'nombre': nombre, **registro}
+            if registro.get('bytes_descargados') and registro['segundos'] > 0:
+                registro['descarga_bytes_por_segundo'] = registro['bytes_descargados'] / registro['segundos']
+            etapas.append(registro)
+        return {
+            'script': self.script_name,
+            'pid': os.getpid(),
+            'inicio': self.inicio.isoformat() if self.inicio is not None else None,
+            'fin': dt.datetime.now(dt.timezone.utc).isoformat(),
+            'segundos': time.perf_counter() - self.reloj,
+            'cpu_segundos': time.process_time() + hijos.ru_utime + hijos.ru_stime,
+            'rss_max_bytes': self.rss_max,
+            'etapas': etapas,
+        }
+
+
+# Métricas del script en ejecución (ver ScriptControl.start_script)
+_activas: Metricas | None = None
+
+
+@contextmanager
+def etapa(nombre: str):
+    """
+    Mide una etapa del script en ejecución; también puede usarse como decorador (@etapa('regrid')). Si no hay
+    métricas activas (p.e. en los tests o en los procesos de un pool), no se mide nada.
+    """
+    metricas = _activas
+    if metricas is None:
+        yield {}
+        return
+    with metricas.etapa(nombre) as contadores:
+        yield contadores
+
+
+def contar(contador: str, valor: int | float):
+    """ Suma valor al contador de las etapas abiertas del script en ejecución, si hay métricas activas. """
+    if _activas is not None:
+        _activas.contar(contador, valor)
+
+
+def desactivar():
+    """
+    Desactiva las métricas del script en ejecución. Se usa al iniciar los procesos de un pool: con fork heredan las
+    métricas del proceso principal, y las etapas que midieran nunca se guardarían.
+    """
+    global _activas
+    _activas = None
+
+
+def guardar_registro(resumen: dict, archivo: str):
+    # Un registro JSON por línea (una línea por ejecución)
+    with open(archivo, 'a') as f:
+        f.write(json.dumps(resumen, default=str) + '\n')
+
+
+def _etiqueta(valor: str) -> str:
+    return valor.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def formato_prometheus(resumen: dict) -> str:
+    """
+    Métricas de la ejecución en el formato de texto de Prometheus (para el textfile collector de node_exporter).
+    """
+    script = _etiqueta(resumen['script'])
+    lineas = []
+    for campo, nombre, descripcion in METRICAS_PROMETHEUS:
+        valores = [(e['nombre'], e[campo]) for e in resumen['etapas'] if campo in e]
+        if not valores:
+            continue
+        lineas += [f'# HELP {nombre} {descripcion}', f'# TYPE {nombre} gauge']
+        lineas += [f'{nombre}{{script="{script}",etapa="{_etiqueta(etapa)}"}} {valor}' for etapa, valor in valores]
+    for campo, nombre, descripcion in [('segundos', 'operativo_script_segundos', 'Wall time of the run'),
+                                       ('cpu_segundos', 'operativo_script_cpu_segundos', 'CPU time of the run'),
+                                       ('rss_max_bytes', 'operativo_script_rss_max_bytes', 'Peak resident memory')]:
+        lineas += [f'# HELP {nombre} {descripcion}', f'# TYPE {nombre} gauge',
+                   f'{nombre}{{script="{script}"}} {resumen[campo]}']
+    fin = dt.datetime.fromisoformat(resumen['fin']).timestamp()
+    lineas += ['# HELP operativo_script_fin_timestamp_segundos End of the run (Unix time)',
+               '# TYPE operativo_script_fin_timestamp_segundos gauge',
+               f'operativo_script_fin_timestamp_segundos{{script="{script}"}} {fin}']
+    return '\n'.join(lineas) + '\n'
+
+
+def guardar_prometheus(resumen: dict, archivo: str):
+    # node_exporter puede leer el archivo en cualquier momento: se escribe un temporal y se renombra
+    with escritura_atomica(archivo) as temporal, open(temporal, 'w') as f:
+        f.write(formato_prometheus(resumen))
+
+
+def resumen_breve(resumen: dict) -> dict:
+    """ Duración y pico de memoria del script y duración de cada etapa (el resumen que se guarda en Redis). """
+    breve = {clave: resumen[clave] for clave in ['inicio', 'fin', 'segundos', 'rss_max_bytes']}
+    breve['etapas'] = {e['nombre']: round(e['segundos'], 3) for e in resumen['etapas']}
+    descargas = [e['descarga_bytes_por_segundo'] for e in resumen['etapas'] if 'descarga_bytes_por_segundo' in e]
+    if descargas:
+        breve['descarga_bytes_por_segundo'] = max(descargas)
+    return breve
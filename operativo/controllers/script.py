@@ -1,5 +1,7 @@
 
 import os
+import atexit
+import json
 import logging
 import warnings
 
@@ -11,6 +13,7 @@ from typing import Union
 from cartopy.io import DownloadWarning
 
 from setup.config import GlobalConfig
+from controllers.metricas import Metricas, guardar_registro, guardar_prometheus, resumen_breve
 
 
 class PidDB(ABC):
@@ -106,6 +109,7 @@ class ScriptControl(object):
         self.pid: int = -1  # PID -1 is a temporal invalid PID
         self.pid_db: PidDB = RedisDB() if RedisDB.available() else FileDB()
         self.single_instance: bool = single_instance
+        self.metricas: Metricas = Metricas(script_name)
         # Setup logger
         self.setup_logger()
 
@@ -136,6 +140,10 @@ class ScriptControl(object):
         # Get and save PID
         self.pid = os.getpid()
         self.pid_db.set(self.script_name, self.pid)
+        # Start measuring the script stages (see controllers.metricas.etapa)
+        self.metricas.iniciar()
+        # Save the metrics at exit too, so runs that raise or call sys.exit (e.g. FcstNotYetPublished) are recorded
+        atexit.register(self.report_metrics)
         # Report start
         logging.info(f'Starting script {self.script_name} (w/PID: {self.pid})')
 
@@ -151,5 +159,30 @@ class ScriptControl(object):
     def end_script_execution(self):
         # Remove saved PID
         self.pid_db.delete(self.script_name)
+        # Save the stage metrics
+        self.report_metrics()
         # Report execution end
         logging.info(f'Ending script {self.script_name} (w/PID: {self.pid})')
+
+    def report_metrics(self):
+        """
+        Appends the run record to {script_name}.jsonl and rewrites {script_name}.prom (Prometheus textfile) in the
+        metrics folder, and saves a summary in Redis (key {script_name}--metricas) when it is available.
+        Errors are only logged: metrics must not stop the script. Runs once per start_script: it is called by
+        end_script_execution or, if the script ends in another way, at exit.
+        """
+        atexit.unregister(self.report_metrics)
+        self.metricas.detener()
+        resumen = self.metricas.resumen()
+        config = GlobalConfig.Instance().app_config
+        try:
+            os.makedirs(config.metricas.carpeta, exist_ok=True)
+            guardar_registro(resumen, os.path.join(config.metricas.carpeta, f'{self.script_name}.jsonl'))
+            guardar_prometheus(resumen, os.path.join(config.metricas.carpeta, f'{self.script_name}.prom'))
+        except OSError as e:
+            logging.warning(f'The metrics of {self.script_name} could not be saved: {e}')
+        if isinstance(self.pid_db, RedisDB):
+            self.pid_db.set(f'{self.script_name}--metricas', json.dumps(resumen_breve(resumen)))
+        for e in resumen['etapas']:
+            logging.info(f'Stage {e["nombre"]}: {e["segundos"]:.1f} s, CPU {e["cpu_segundos"]:.1f} s, '
+                         f'peak RSS {e["rss_max_bytes"] / 1024 ** 2:.0f} MB')
@@ -0,0 +1,15 @@
+
+class RemoteFileNotFound(Exception):
+    """Raised when the requested file does not exist on the remote server."""
+    def __init__(self, url: str):
+        self.url = url
+        message = f"The file {url} was not found on the server."
+        super().__init__(message) # Call the base class constructor
+
+
+class InvalidRemoteFile(Exception):
+    """Raised when the downloaded content is not a valid netCDF file."""
+    def __init__(self, url: str, reason: str):
+        self.url = url
+        message = f"The file {url} is not a valid netCDF file ({reason})."
+        super().__init__(message) # Call the base class constructor
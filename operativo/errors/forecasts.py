@@ -8,6 +8,9 @@ class FcstNotFound(Exception):
 
 class FcstNotYetPublished(Exception):
     """Raised when the age is outside the valid range (0-120)."""
+    # Exit code of run_operativo.py in this case (EX_TEMPFAIL): the calibration must be retried later
+    exit_code: int = 75
+
     def __init__(self, model: str, trgt_date: str):
         message = f"The forecast for model {model} for {trgt_date} has not yet been published."
         super().__init__(message) # Call the base class constructor
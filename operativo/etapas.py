@@ -0,0 +1,258 @@
+
+import os
+import datetime as dt
+import pandas as pd
+import xarray as xr
+import dask
+import logging
+import matplotlib
+
+from pathlib import Path
+from typing import NamedTuple
+
+from funciones_extra import descarga_pronostico, descarga_pronostico_CFSv2
+from funciones_extra import get_fecha_publicacion, get_nombre_figura, PlantillaMapa
+from prob_funciones import get_data_percentiles, get_archivos_datos, calc_prob, calc_prob_corr, calc_prob_corr_extr
+
+from setup.config import  GlobalConfig
+from controllers.downloads import DownloadResult
+from controllers.metricas import etapa, desactivar
+from stores.climatology import open_climatology
+from stores.geometrias import get_geometrias_mapa, get_geometrias_path
+from stores.productos import CATEGORIAS_PRODUCTO, get_producto_path, guardar_producto, guardar_legado
+from stores.historico import agregar_al_historico
+from stores.pac import CATEGORIAS_PAC, SEMANAS_PAC, get_pac_source_files
+
+
+# Categorías de probabilidad que se guardan y grafican
+PERCENTILES_SALIDA = CATEGORIAS_PRODUCTO
+
+# Módulos cuyo código determina el resultado de la calibración (ver entradas_calibracion)
+MODULOS_CALIBRACION = ['etapas.py', 'prob_funciones.py', 'calendario.py', 'stores/hindcast.py',
+                       'stores/climatology.py', 'stores/pac.py', 'stores/regrid.py']
+
+
+class Calibracion(NamedTuple):
+    fecha_d: dt.datetime  # fecha de inicialización del pronóstico
+    fechas_v: list  # fecha de inicio de cada semana
+    probabilidades: dict[str, xr.DataArray]  # probabilidad final de cada categoría de PERCENTILES_SALIDA
+
+
+def get_carpeta_operativo() -> str:
+    config = GlobalConfig.Instance().app_config
+    return os.fspath(Path(f'{config.carpeta_datos}/operativo/'))
+
+
+def descargar(nombre_modelo: str, variable: str, miercoles: dt.datetime, redownload: bool = False) -> list[DownloadResult]:
+
+    # La fecha de publicación varía según el modelo
+    fecha_d = get_fecha_publicacion(nombre_modelo, miercoles)
+
+    tipo = 'forecast'
+    conj, modelo = nombre_modelo.split('-')
+
+    out_folder = get_carpeta_operativo() + '/forecast/' + variable + '/' + miercoles.strftime('%Y%m%d%H%M') + '/'
+    os.makedirs(out_folder, exist_ok=True)
+
+    match nombre_modelo:
+        case 'NCEP-CFSv2':
+            descargas = descarga_pronostico_CFSv2(fecha_d, variable, tipo, conj, modelo, out_folder, redownload)
+        case _:  # Default case
+            descargas = [descarga_pronostico(fecha_d, variable, tipo, conj, modelo, out_folder, redownload)]
+
+    return descargas
+
+
+def entradas_calibracion(nombre_modelo: str, variable: str, miercoles: dt.datetime,
+                         descargas: list[DownloadResult]) -> dict[str, list[str]]:
+    """
+    Archivos de los que depende la calibración, por grupo (ver RunCache): el pronóstico descargado, el hindcast, la
+    climatología y los percentiles, los factores PAC y el código del cálculo. No se incluyen los archivos que se
+    derivan de estos (p.e. el hindcast por fecha de inicio o los factores PAC consolidados).
+    """
+    fecha_d = get_fecha_publicacion(nombre_modelo, miercoles)
+    _, modelo = nombre_modelo.split('-')
+
+    archivos = get_archivos_datos(fecha_d, [20, 50, 80], miercoles, variable, modelo)
+    carpeta_codigo = Path(__file__).parent
+
+    return {
+        'pronostico': sorted(d.path for d in descargas),
+        'hindcast': [archivos['hindcast']],
+        'climatologia': [archivos['media']] + [a for par in archivos['percentiles'].values() for a in par],
+        'pac': [f for categoria in CATEGORIAS_PAC for week in SEMANAS_PAC
+                for f in get_pac_source_files(variable, modelo, week, categoria)],
+        'codigo': [os.fspath(carpeta_codigo / modulo) for modulo in MODULOS_CALIBRACION],
+    }
+
+
+def calibrar(nombre_modelo: str, variable: str, miercoles: dt.datetime, chunks: int | None = None,
+             celdas: dict | None = None) -> Calibracion:
+    """
+    Lectura de datos, cálculo de probabilidades y corrección (PAC y extremos).
+    Con chunks, el pronóstico y el hindcast se procesan en bloques de chunks x chunks puntos de grilla (con
+    dask): solo se cargan en memoria los bloques en uso, y las cuatro probabilidades corregidas se calculan juntas,
+    leyendo los datos una sola vez. Con celdas (ver consulta.py) solo se calibran esas celdas de la grilla.
+    """
+    bloques = {'X': chunks, 'Y': chunks} if chunks is not None else None
+
+    fecha_d = get_fecha_publicacion(nombre_modelo, miercoles)
+    _, modelo = nombre_modelo.split('-')
+
+    # Se leen una sola vez los datos del modelo y se obtienen los umbrales de los tres percentiles
+    # (con chunks, la lectura del pronóstico y del hindcast se mide en la etapa de corrección, donde se calcula)
+    with etapa('lectura'):
+        fcst_m, hcst_m, media_m, pctiles_m, fechas_v = get_data_percentiles(fecha_d, [20, 50, 80], miercoles, variable,
+                                                                            modelo, bloques, celdas)
+
+    with etapa('probabilidades'):
+        # Percentil 20
+        p1_20, _ = calc_prob(fcst_m, hcst_m, media_m, pctiles_m[20], int(20))
+        p1_dn20 = p1_20.sel(semanas=slice(1,3))
+
+        # Percentil 50
+        p1_50, p2_50 = calc_prob(fcst_m, hcst_m, media_m, pctiles_m[50], int(50))
+        p1_dn50, p2_up50 = p1_50.sel(semanas=slice(1,3)), p2_50.sel(semanas=slice(1,3))
+
+        # Percentil 80
+        p1_80, _ = calc_prob(fcst_m, hcst_m, media_m, pctiles_m[80], int(80))
+        p1_up80 = p1_80.sel(semanas=slice(1,3))
+
+    with etapa('correccion'):
+        # Corrección de probabilidad por PAC
+        p1_dn20_corr, _ = calc_prob_corr(p1_dn20, [], variable, modelo, '20')
+        p1_dn50_corr, p2_up50_corr = calc_prob_corr(p1_dn50, p2_up50, variable, modelo, '50')
+        p1_up80_corr, _ = calc_prob_corr(p1_up80, [], variable, modelo, '80')
+
+        if bloques is not None:
+            # Se calcula el grafo completo de una vez: cada bloque del pronóstico se lee una sola vez para las cuatro
+            # probabilidades, y el resultado (sin las dimensiones M y L) es chico
+            p1_dn20_corr, p1_dn50_corr, p2_up50_corr, p1_up80_corr = dask.compute(p1_dn20_corr, p1_dn50_corr,
+                                                                                  p2_up50_corr, p1_up80_corr)
+
+        # Corrección de probabilidad negativas/positivas
+        p1_dn20_final, p1_up80_final = calc_prob_corr_extr(p1_dn20_corr, p1_up80_corr)
+        p1_dn50_final, p2_up50_final = calc_prob_corr_extr(p1_dn50_corr, p2_up50_corr)
+
+    # Ajustar el resultado final
+    probabilidades = {}
+    for percentil, p_final in zip(PERCENTILES_SALIDA, [p1_dn20_final, p1_dn50_final, p2_up50_final, p1_up80_final]):
+        probabilidades[percentil] = p_final.assign_coords(S=('semanas', pd.DatetimeIndex(p_final['S'].values)))
+
+    return Calibracion(fecha_d, fechas_v, probabilidades)
+
+
+def guardar_probabilidades(nombre_modelo: str, variable: str, miercoles: dt.datetime, calibracion: Calibracion) -> list[str]:
+    """
+    Guarda las probabilidades de todas las categorías en un único archivo comprimido (ver stores/productos.py) y,
+    si config.salidas.legado, también un archivo por categoría en las rutas anteriores. Con config.salidas.historico,
+    las probabilidades se agregan además al histórico del modelo/variable (ver stores/historico.py).
+    """
+    config = GlobalConfig.Instance().app_config
+    _, modelo = nombre_modelo.split('-')
+
+    archivo = get_producto_path(variable, modelo, miercoles, calibracion.fecha_d)
+    logging.info(f'######## Guardando los datos en: {archivo} ###')
+    attrs = {'modelo': nombre_modelo, 'variable': variable,
+             'fecha_inicializacion': calibracion.fecha_d.strftime('%Y-%m-%d %H:%M'),
+             'miercoles': miercoles.strftime('%Y-%m-%d')}
+    archivos = [guardar_producto(calibracion.probabilidades, archivo, attrs)]
+
+    if config.salidas.legado:
+        archivos += guardar_legado(calibracion.probabilidades, variable, modelo, miercoles, calibracion.fecha_d)
+
+    if config.salidas.historico:
+        # El histórico es una salida secundaria: si no se puede agregar el pronóstico (p.e. otra grilla), se informa
+        # y se sigue (el pronóstico se puede agregar después con build_stores.py historico)
+        try:
+            archivos.append(agregar_al_historico(variable, modelo, calibracion.probabilidades, calibracion.fecha_d,
+                                                 miercoles))
+        except Exception as e:
+            logging.error(f'No se pudo agregar el pronóstico al histórico de {nombre_modelo} ({variable}): {e}')
+
+    return archivos
+
+
+def graficar_categoria(variable: str, modelo: str, percentil: str, prob: xr.DataArray, fechas_v: list, c_out_f: str,
+                       corr: bool) -> list[str]:
+    """
+    Figuras de las semanas 1, 2 y 3y4 de una categoría: se usa una sola figura (ver PlantillaMapa).
+    """
+    os.makedirs(c_out_f, exist_ok=True)
+    logging.info(f'######## Guardando las figuras en: {c_out_f} ###')
+
+    # Fechas
+    f1s = fechas_v
+    f2s = [fechas_v[0]+dt.timedelta(days=6), fechas_v[1]+dt.timedelta(days=6), fechas_v[2]+dt.timedelta(days=13)]
+
+    archivos = []
+    plantilla = PlantillaMapa(variable, percentil, prob.X.to_numpy(), prob.Y.to_numpy(), corr=corr)
+    for week, f1, f2 in zip([1,2,3], f1s, f2s):
+        logging.info(f'######## - Figura semana: {week} ({percentil})')
+        archivos.append(get_nombre_figura(c_out_f, week, modelo, corr=corr))
+        plantilla.graficar(prob.sel(semanas=week).to_numpy(), week, f1, f2, archivos[-1])
+    plantilla.cerrar()
+
+    return archivos
+
+
+def tareas_figuras(nombre_modelo: str, variable: str, miercoles: dt.datetime, calibracion: Calibracion) -> list[tuple]:
+    """
+    Argumentos de graficar_categoria para cada categoría de PERCENTILES_SALIDA (trabajos independientes).
+    """
+    config = GlobalConfig.Instance().app_config
+    carpeta_figuras = os.fspath(Path(f'{config.carpeta_figuras}/{variable}/'))
+    _, modelo = nombre_modelo.split('-')
+    fecha_mie = miercoles.strftime('%Y%m%d%H%M')
+
+    return [(variable, modelo, percentil, calibracion.probabilidades[percentil], calibracion.fechas_v,
+             carpeta_figuras + '/' + fecha_mie + '/' + percentil + '/', config.corregir)
+            for percentil in PERCENTILES_SALIDA]
+
+
+def graficar_probabilidades(nombre_modelo: str, variable: str, miercoles: dt.datetime, calibracion: Calibracion) -> list[str]:
+
+    archivos = []
+    for tarea in tareas_figuras(nombre_modelo, variable, miercoles, calibracion):
+        archivos += graficar_categoria(*tarea)
+
+    return archivos
+
+
+def inicializar_figuras():
+    """
+    Inicialización de los procesos que generan figuras: se configura el log, se usa un backend sin pantalla,
+    se desactivan las métricas heredadas del proceso principal y se cargan las geometrías del mapa base, que se
+    reutilizan en todas las figuras que genere el proceso.
+    """
+    logging.basicConfig(format='%(asctime)s -- %(levelname)4s -- %(message)s',
+                        datefmt='%Y/%m/%d %I:%M:%S %p', level=logging.INFO)
+    matplotlib.use('Agg')
+    # Con fork, el proceso hereda las métricas activas del proceso principal, que se guardan solo allí
+    desactivar()
+    # Si no existe el archivo de geometrías, se genera antes de iniciar los procesos (ver preparar_figuras)
+    if os.path.isfile(get_geometrias_path()):
+        get_geometrias_mapa()
+
+
+def preparar_figuras():
+    """
+    Se cargan (y, si no existen, se generan) las geometrías del mapa base en el proceso principal, antes de iniciar
+    los procesos que generan figuras: así el archivo se genera una sola vez y no en cada proceso.
+    """
+    get_geometrias_mapa()
+
+
+def inicializar_proceso(variables: list[str]):
+    """
+    Inicialización de los procesos del orquestador: se configura el log, se preparan las figuras y se desactivan
+    las métricas heredadas (ver inicializar_figuras), y se carga en memoria la climatología diaria de cada
+    variable, que se reutiliza en todas las etapas que corra el proceso.
+    """
+    inicializar_figuras()
+    config = GlobalConfig.Instance().app_config
+    varn = vars(config.mapeo_variables)
+    for variable in variables:
+        archivo = f'{config.carpeta_datos}/clim/{varn[variable]}/{varn[variable]}ClimSmooth.nc'
+        if os.path.isfile(archivo):
+            open_climatology(archivo).load()
@@ -0,0 +1,82 @@
+
+import os
+import sys
+import glob
+import argparse
+import logging
+
+from pathlib import Path
+
+try:
+    from setup.config import  GlobalConfig
+    from stores.pac import build_pac_store
+    from stores.hindcast import build_hindcast_store
+    from stores.geometrias import build_geometrias_mapa
+    from stores.historico import importar_prob
+except ImportError:
+    sys.path.append(
+        os.fspath(Path(__file__).parent.parent)
+    )
+    from setup.config import  GlobalConfig
+    from stores.pac import build_pac_store
+    from stores.hindcast import build_hindcast_store
+    from stores.geometrias import build_geometrias_mapa
+    from stores.historico import importar_prob
+
+
+def parse_args() -> argparse.Namespace:
+
+    parser = argparse.ArgumentParser(description='Builds the prepared data stores used by the calibration.')
+    subparsers = parser.add_subparsers(dest='store', required=True)
+
+    pac = subparsers.add_parser('pac', help='Consolidated PAC correction factors')
+    pac.add_argument('--variable', type=str, choices=['pr', 'tas'], nargs='+', default=['pr', 'tas'],
+                     help='Variables to be processed')
+    pac.add_argument('--modelo', type=str, nargs='+', default=None,
+                     help='Models to be processed (default: every model folder found)')
+
+    hindcast = subparsers.add_parser('hindcast', help='Hindcasts indexed by start month/day')
+    hindcast.add_argument('--variable', type=str, choices=['pr', 'tas'], nargs='+', default=['pr', 'tas'],
+                          help='Variables to be processed')
+
+    subparsers.add_parser('geometrias', help='Clipped and simplified Natural Earth layers for the base map')
+
+    historico = subparsers.add_parser('historico', help='Forecast archive, imported from the files already in prob/')
+    historico.add_argument('--variable', type=str, choices=['pr', 'tas'], nargs='+', default=['pr', 'tas'],
+                           help='Variables to be processed')
+    historico.add_argument('--modelo', type=str, nargs='+', default=None,
+                           help='Models to be imported (e.g. GEPS8; default: every model found)')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    # Catch and parse command-line arguments
+    args: argparse.Namespace = parse_args()
+
+    logging.basicConfig(format='%(asctime)s -- %(levelname)4s -- %(message)s',
+                        datefmt='%Y/%m/%d %I:%M:%S %p', level=logging.INFO)
+
+    # Leer archivo de configuración
+    config = GlobalConfig.Instance().app_config
+    carpeta_datos = os.fspath(Path(config.carpeta_datos))
+
+    if args.store == 'pac':
+        for variable in args.variable:
+            carpeta_pac = Path(f'{carpeta_datos}/PAC/{variable}')
+            modelos = args.modelo or sorted(p.name for p in carpeta_pac.iterdir() if p.is_dir())
+            for modelo in modelos:
+                build_pac_store(variable, modelo)
+
+    if args.store == 'hindcast':
+        for variable in args.variable:
+            for archivo in sorted(glob.glob(f'{carpeta_datos}/hindcast/{variable}_*_datos.nc')):
+                build_hindcast_store(archivo)
+
+    if args.store == 'geometrias':
+        logging.info(f'Geometrías del mapa base guardadas en: {build_geometrias_mapa()}')
+
+    if args.store == 'historico':
+        for variable in args.variable:
+            logging.info(f'Histórico de {variable}: {importar_prob(variable, args.modelo)} pronósticos importados')
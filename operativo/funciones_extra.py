@@ -1,8 +1,5 @@
 
 import os
-import glob
-import requests
-import shutil
 import validators
 import numpy as np
 import pandas as pd
@@ -10,21 +7,25 @@ import datetime as dt
 import logging
 
 import cartopy.crs as ccrs
-import cartopy.feature as cpf
 import matplotlib.pyplot as plt
 
-from cartopy.io import shapereader
 from matplotlib import colors as c
 from cartopy.mpl.geoaxes import GeoAxes
 from typing import cast
 from calendar import Day
 
 from setup.config import GlobalConfig
+from calendario import CalendarioSemanas
+from stores.geometrias import get_geometrias_mapa
+from controllers.downloads import DownloadManager, DownloadResult
+from errors.downloads import RemoteFileNotFound
 from errors.forecasts import FcstNotFound, FcstNotYetPublished
 
 
 VALID_DATE_FORMATS = ['%Y%m%d', '%Y-%m-%d', '%Y/%m/%d']
 
+VALID_MODELS = ['RSMAS-CCSM4', 'NCEP-CFSv2', 'EMC-GEFSv12_CPC', 'GMAO-GEOS_V2p1', 'ECCC-GEPS8']
+
 
 def parse_date(date_str: str) -> dt.datetime:
     for i, date_format in enumerate(VALID_DATE_FORMATS, start=1):
@@ -73,6 +74,30 @@ def get_date_for_weekday(start_date: dt.date | dt.datetime, target_weekday: Day)
     return previous_date
 
 
+def get_fecha_publicacion(modelo: str, miercoles: dt.datetime) -> dt.datetime:
+    """
+    Fecha de inicialización del pronóstico de cada modelo a utilizar para el miércoles guía
+    (la fecha de publicación varía según el modelo).
+    """
+    match modelo:
+        case 'RSMAS-CCSM4':
+            # CCSM4 se publica los domingos, asi que se busca el domingo previo al miércoles.
+            fecha_d = get_date_for_weekday(start_date=miercoles, target_weekday=Day.SUNDAY)  # --> domingo previo
+        case 'NCEP-CFSv2':
+            fecha_d = miercoles
+        case 'EMC-GEFSv12_CPC':
+            fecha_d = miercoles
+        case 'GMAO-GEOS_V2p1':
+            fecha_d = get_nearest_gmao_date(miercoles)  # ---> fecha GMAO más cercana
+        case 'ECCC-GEPS8':
+            # GEPS8 se publica los jueves, asi que se busca el jueves inmediatamente posterior al miércoles guía.
+            fecha_d = miercoles + dt.timedelta(days=1)  # --> jueves posterior a fecha guía
+        case _:  # Default case
+            raise ValueError('Se solicitó la calibración de un modelo desconocido!')
+
+    return fecha_d
+
+
 def gen_url_download(fecha, variable='tas', tipo='forecast', conj='ECCC', modelo='GEPS8'):
     """
     Este es el tipo de links hay que generar:
@@ -96,55 +121,65 @@ def gen_url_download(fecha, variable='tas', tipo='forecast', conj='ECCC', modelo
     return url_out
 
 
-def descarga_pronostico(fecha, variable, tipo, conj, modelo, out_folder, redownload: bool = False):
-    url_out = gen_url_download(fecha, variable, tipo, conj, modelo)
-    out_file = out_folder + variable + '_' + modelo + '_' + fecha.strftime('%Y%m%d%H%M') + '_forecast.nc'
-    if os.path.isfile(out_file) and not redownload:
-        logging.info(f'######## El archivo {modelo} para la fecha: {fecha} ya esta descargado y disponible')
-    else:
-        logging.info(f'######## Descargando archivo {modelo} para la fecha: {fecha}')
-        if validators.url(url_out):
-            logging.info(f'######## - Guardando archivo en: {out_file}')
-            with requests.get(url_out, stream=True) as r:
-                if '<title>Error 404 Not Found</title>' in r.text:
-                    config = GlobalConfig.Instance().app_config
-                    diff_dates = abs(dt.date.today() - fecha.date())
-                    if diff_dates.days < config.dias_tolerancia_pub:
-                        raise FcstNotYetPublished(f'{conj}-{modelo}', fecha.strftime('%Y-%m-%d'))
-                    else:
-                        raise FcstNotFound(f'{conj}-{modelo}', fecha.strftime('%Y-%m-%d'))
-                with open(out_file, 'wb') as file_obj:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        file_obj.write(chunk)
+def descarga_pronosticos(fechas, variable, tipo, conj, modelo, out_folder, redownload: bool = False):
+    """
+    Descarga, de forma concurrente, los pronósticos de las fechas indicadas que aún no estén disponibles
+    (o todos, si redownload, en cuyo caso solo se transfieren los que cambiaron en el servidor).
+    Devuelve, en el mismo orden que las fechas, los archivos e indica si su contenido se actualizó.
+    """
+    resultados, descargas = {}, []
+    for fecha in fechas:
+        url_out = gen_url_download(fecha, variable, tipo, conj, modelo)
+        out_file = out_folder + variable + '_' + modelo + '_' + fecha.strftime('%Y%m%d%H%M') + '_forecast.nc'
+        resultados[fecha] = DownloadResult(out_file, False)
+        if os.path.isfile(out_file) and not redownload:
+            logging.info(f'######## El archivo {modelo} para la fecha: {fecha} ya esta descargado y disponible')
+        elif validators.url(url_out):
+            logging.info(f'######## Descargando archivo {modelo} para la fecha: {fecha}')
+            descargas.append((fecha, url_out, out_file))
         else:
             logging.error('######## - URL inválida!!')
+
+    try:
+        descargados = DownloadManager.Instance().download_many([(url_out, out_file) for _, url_out, out_file in descargas])
+        resultados.update({fecha: resultado for (fecha, _, _), resultado in zip(descargas, descargados)})
+    except RemoteFileNotFound as e:
+        fecha = next(f for f, url_out, _ in descargas if url_out == e.url)
+        config = GlobalConfig.Instance().app_config
+        diff_dates = abs(dt.date.today() - fecha.date())
+        if diff_dates.days < config.dias_tolerancia_pub:
+            raise FcstNotYetPublished(f'{conj}-{modelo}', fecha.strftime('%Y-%m-%d'))
+        else:
+            raise FcstNotFound(f'{conj}-{modelo}', fecha.strftime('%Y-%m-%d'))
     logging.info('#####################################################')
-    
-    return out_file
+
+    return [resultados[fecha] for fecha in fechas]
+
+
+def descarga_pronostico(fecha, variable, tipo, conj, modelo, out_folder, redownload: bool = False):
+
+    descarga = descarga_pronosticos([fecha], variable, tipo, conj, modelo, out_folder, redownload)[0]
+
+    return descarga
+
+
+def get_fechas_ensamble(nombre_modelo: str, fecha: dt.datetime) -> list[dt.datetime]:
+    """
+    Inicializaciones que se descargan para el pronóstico publicado en fecha: para NCEP-CFSv2, un ensamble
+    con las inicializaciones de los últimos 5 días, y para los demás modelos solo la de fecha.
+    """
+    if nombre_modelo == 'NCEP-CFSv2':
+        return [fecha-dt.timedelta(days=int(i)) for i in np.arange(0,5)]
+    return [fecha]
 
 
 def descarga_pronostico_CFSv2(fecha, variable, tipo, conj, modelo, out_folder, redownload: bool = False):
 
-    for fechai in [fecha-dt.timedelta(days=int(i)) for i in np.arange(0,5)]:
-        url_out = gen_url_download(fechai, variable, tipo, conj, modelo)
-        out_file = out_folder + variable + '_' + modelo + '_' + fechai.strftime('%Y%m%d%H%M') + '_forecast.nc'
-        if os.path.isfile(out_file) and not redownload:
-            logging.info(f'######## El archivo {modelo} para la fecha: {fechai} ya esta descargado y disponible')
-            continue
-        else:
-            logging.info(f'######## Descargando archivo {modelo} para la fecha: {fechai}')
-            if validators.url(url_out):
-                logging.info(f'######## - Guardando archivo en: {out_file}')
-                with requests.get(url_out, stream=True) as r:
-                    with open(out_file, 'wb') as file_obj:
-                        shutil.copyfileobj(r.raw, file_obj)
-            else:
-                logging.error('######## - URL inválida!!')
-    logging.info('#####################################################')
+    # Ensamble con las inicializaciones de los últimos 5 días, descargadas en simultáneo
+    fechas = get_fechas_ensamble(f'{conj}-{modelo}', fecha)
+    descargas = descarga_pronosticos(fechas, variable, tipo, conj, modelo, out_folder, redownload)
 
-    out_files = sorted(glob.glob(out_folder + '*' + modelo + '*.nc'), reverse=True)
-    
-    return out_files
+    return descargas
 
 
 def grouping_coord(ds):
@@ -168,91 +203,13 @@ def grouping_coord(ds):
 
 
 def grouping_coord_fecha(ds, miercoles, hcast=0):
+    """
+    Asigna a ds la coordenada semanas (1, 2, 3y4 y 5) y devuelve las fechas de inicio de cada semana.
+    Ver calendario.CalendarioSemanas.
+    """
+    calendario = CalendarioSemanas.from_data(ds, miercoles, hcast)
 
-    f_model = []
-    sem1_i, sem2_i, sem3_i, sem4_i = pd.NaT, pd.NaT, pd.NaT, pd.NaT
-
-    # Se utiliza para ajustar con modelos que no sean
-    # GEFS (L=34) ni GEPS8 (L=39) /GEPS7 (L=32)
-    # GEOS_V2p1 (L=45)
-    if 'L' in list(ds.dims):
-
-        N = ds.sizes['L']  # Largo de pronóstico
-        semanas = np.zeros(N)
-
-        # Fechas correspondientes al inicio de las semanas 1, 2 y 3/4 y 5
-        if hcast == 0:
-            f_model = (ds.S+ds.L).values[0]
-            if pd.Timestamp(f_model[0]).date() <= miercoles.date():
-                # El modelo tiene datos antes del miercoles guía.
-                # Usamos la primera semana desde el jueves para alinear con GEFS esa semana.
-                sem1_i = pd.Timestamp(miercoles + dt.timedelta(days=1) + dt.timedelta(hours=12))
-            else:
-                sem1_i = pd.Timestamp(f_model[0])
-            sem2_i = pd.Timestamp(miercoles + dt.timedelta(days=8) + dt.timedelta(hours=12))
-            sem3_i = pd.Timestamp(miercoles + dt.timedelta(days=15) + dt.timedelta(hours=12))
-            sem4_i = pd.Timestamp(miercoles + dt.timedelta(days=29) + dt.timedelta(hours=12))
-        elif hcast == 1:
-            f_model = (ds.S+ds.L).values
-            if pd.Timestamp(f_model[0]).date() <= miercoles.date():
-                # El modelo tiene datos antes del miercoles guía.
-                # Usamos la primera semana desde el jueves para alinear con GEFS esa semana.
-                sem1_i = pd.Timestamp(miercoles + dt.timedelta(days=1) + dt.timedelta(hours=12)).replace(year=1960)
-            else:
-                sem1_i = pd.Timestamp(f_model[0]).replace(year=1960)
-            sem2_i = pd.Timestamp(miercoles + dt.timedelta(days=8) + dt.timedelta(hours=12)).replace(year=1960)
-            sem3_i = pd.Timestamp(miercoles + dt.timedelta(days=15) + dt.timedelta(hours=12)).replace(year=1960)
-            sem4_i = pd.Timestamp(miercoles + dt.timedelta(days=29) + dt.timedelta(hours=12)).replace(year=1960)
-        #
-        fechas_m = np.array([pd.Timestamp(a)==sem1_i for a in f_model])
-        i1 = fechas_m.argmax()
-        #
-        fechas_m = np.array([pd.Timestamp(a)==sem2_i for a in f_model])
-        i2 = fechas_m.argmax()
-        #
-        fechas_m = np.array([pd.Timestamp(a)==sem3_i for a in f_model])
-        i3 = fechas_m.argmax()
-        #
-        semanas[i1:i2] = 1
-        semanas[i2:i2+7] = 2
-        semanas[i3:i3+14] = 3
-        semanas[i3+14:] = 5
-        ds = ds.assign_coords(semanas=('L', semanas))
-
-    else:
-
-        N = ds.sizes['S']  # Largo de pronóstico
-        semanas = np.ones(N)
-        f_model = (ds.S).values
-
-        if pd.Timestamp(f_model[0]) <= miercoles:
-            # El modelo tiene datos antes del miercoles guía.
-            # Usamos la primera semana desde el jueves para alinear con GEFS esa semana.
-            sem1_i = pd.Timestamp(miercoles + dt.timedelta(days=1) + dt.timedelta(hours=12))
-        else:
-            sem1_i = pd.Timestamp(f_model[0])
-
-        sem2_i = pd.Timestamp(miercoles.replace(year=1960) + dt.timedelta(days=8))
-        sem3_i = pd.Timestamp(miercoles.replace(year=1960) + dt.timedelta(days=15))
-        sem4_i = pd.Timestamp(miercoles.replace(year=1960) + dt.timedelta(days=29))
-
-        # Indice correspondiente a inicio semana 2 y 3
-        fechas_m = np.array([pd.Timestamp(a)==sem2_i for a in f_model])
-        i2 = fechas_m.argmax()
-        #
-        fechas_m = np.array([pd.Timestamp(a)==sem3_i for a in f_model])
-        i3 = fechas_m.argmax()
-        #
-        semanas[i2:i2+7] = 2
-        semanas[i3:i3+14] = 3
-        semanas[i3+14:] = 5
-        #
-        ds = ds.assign_coords(semanas=('S', semanas))
-
-    fechas_iniciales = [sem1_i, sem2_i, sem3_i, sem4_i]
-    f_out = [a.date() for a in fechas_iniciales]
-
-    return ds, f_out
+    return calendario.assign_to(ds), calendario.fechas_iniciales
 
 
 def mapa_base(llat, llon, figure_size=(6,8)):
@@ -270,18 +227,15 @@ def mapa_base(llat, llon, figure_size=(6,8)):
     # ax.coastlines, ax.add_feature, ax.add_geometries. ax. set_extent
     ax = cast(GeoAxes, ax)
 
-    # Agregar límites de paises
-    ax.coastlines(resolution='10m')  # type: ignore
-    ax.add_feature(cpf.BORDERS, linestyle='-')  # type: ignore
+    # Geometrías de Natural Earth ya recortadas y simplificadas (se leen una sola vez por proceso)
+    geometrias = get_geometrias_mapa()
+
+    # Agregar costas y límites de paises
+    ax.add_geometries(geometrias['costas'], proj_lcc, edgecolor='black', facecolor='none')
+    ax.add_geometries(geometrias['paises'], proj_lcc, edgecolor='black', facecolor='none', linestyle='-')
 
     # Agregar límites administrativos de nivel 1
-    shp_name = shapereader.natural_earth(
-        resolution='10m', category='cultural', name='admin_1_states_provinces_lines')
-    geoms, paises = [], ["Argentina", "Bolivia", "Brazil", "Chile", "Paraguay", "Peru", "Uruguay"]
-    for country in shapereader.Reader(shp_name).records():
-        if country.attributes['ADM0_NAME'] in paises:
-            geoms.append(country.geometry)
-    ax.add_geometries(geoms, proj_lcc, edgecolor='grey', facecolor='none', linewidth=0.5)
+    ax.add_geometries(geometrias['provincias'], proj_lcc, edgecolor='grey', facecolor='none', linewidth=0.5)
 
     # Extensión del mapa
     l_lat, l_lon = llat, np.array(llon) % 360  # Pasamos lon de [-180, 180] a [0, 360]
@@ -295,18 +249,14 @@ def mapa_base(llat, llon, figure_size=(6,8)):
     return fig, ax
 
 
-def mapa_probabilidad(variable, prob, percentil, week, modelo, f1, f2, c_out, corr=True):
-
-    # Extension del mapa
-    llat = [-57, -8]
-    llon = [-82, -33]
+def get_estilo_mapa(variable, percentil, corr=True):
+    """
+    Título, paleta y normalización de los mapas de probabilidad de una variable y categoría
+    """
 
     # Definir valores por defecto
     titulo = ''
     c_pp = ['#fff']
-    
-    # Titulo fechas:
-    titulof = 'Inicio: ' + f1.strftime('%HH %d/%m/%Y') + '\n ' + f2.strftime('%d/%m/%Y')
 
     # Paleta colores
     if ((percentil == '20-') or (percentil == '50-')) & (variable=='tas'):
@@ -343,36 +293,75 @@ def mapa_probabilidad(variable, prob, percentil, week, modelo, f1, f2, c_out, co
     bounds = np.array([0, 10.01, 20.01, 30.01, 40.01, 50.01, 60.01, 70.01, 80.01, 90.01, 100.01])
     norm = c.BoundaryNorm(boundaries=bounds, ncolors=len(c_pp))
 
-    # Datos para el mapa
-    datap = prob.sel(semanas=week).to_numpy()
-    x = prob.X.to_numpy()
-    y = prob.Y.to_numpy()
-    data = datap.copy()
-    data[datap < 0] = np.nan
-    data[datap > 100] = np.nan
+    return titulo, c_map, norm
 
-    fig, ax = mapa_base(llat, llon)
 
-    ax.pcolormesh(x, y, data, cmap=c_map, norm=norm, transform=ccrs.PlateCarree(), alpha=0.8)
+def get_titulo_semana(week, f1, f2):
 
-    ax.set_title(titulo, loc='left', fontsize=7)
+    # Titulo fechas:
+    titulof = 'Inicio: ' + f1.strftime('%HH %d/%m/%Y') + '\n ' + f2.strftime('%d/%m/%Y')
 
     if week == 3:
-        ax.set_title('Semanas 3 y 4; ' + titulof, loc='right', fontsize=7)
-        if corr:
-            nome_fig = c_out + 'pronostico_corregido_semana_3y4_' + modelo + '.jpg'
-        else:
-            nome_fig = c_out + 'pronostico_semana_3y4_' + modelo + '.jpg'
-        plt.savefig(nome_fig, dpi=150, bbox_inches='tight')
-    else:
-        ax.set_title('Semana ' + str(week) + '; ' + titulof, loc='right', fontsize=7)
-        if corr:
-            nome_fig = c_out + 'pronostico_corregido_semana_' + str(week) + '_' + modelo +'.jpg'
-        else:
-            nome_fig = c_out + 'pronostico_semana_' + str(week) + '_' + modelo + '.jpg'
-        plt.savefig(nome_fig, dpi=150, bbox_inches='tight')
+        return 'Semanas 3 y 4; ' + titulof
+    return 'Semana ' + str(week) + '; ' + titulof
+
+
+def get_nombre_figura(c_out, week, modelo, corr=True):
+
+    semana = '3y4' if week == 3 else str(week)
+    if corr:
+        return c_out + 'pronostico_corregido_semana_' + semana + '_' + modelo + '.jpg'
+    return c_out + 'pronostico_semana_' + semana + '_' + modelo + '.jpg'
+
+
+class PlantillaMapa(object):
+    """
+    Figura de los mapas de probabilidad de una variable y categoría. El mapa base, la paleta y la malla de datos
+    (QuadMesh) se crean una sola vez; para cada semana solo se actualizan los valores de la malla y el título.
+    El recorte de la figura se calcula una sola vez, con el título más largo, en lugar de usar bbox_inches='tight'
+    (que vuelve a dibujar la figura en cada savefig).
+    """
+
+    # Extension del mapa
+    llat = [-57, -8]
+    llon = [-82, -33]
+
+    # Resolución de las figuras
+    dpi = 150
+
+    def __init__(self, variable, percentil, x, y, corr=True):
+        titulo, c_map, norm = get_estilo_mapa(variable, percentil, corr)
+
+        self.fig, self.ax = mapa_base(self.llat, self.llon)
+        self.malla = self.ax.pcolormesh(x, y, np.full((len(y), len(x)), np.nan), cmap=c_map, norm=norm,
+                                        transform=ccrs.PlateCarree(), alpha=0.8)
+        self.ax.set_title(titulo, loc='left', fontsize=7)
+        self.titulo_semana = self.ax.set_title(get_titulo_semana(3, dt.datetime(2000, 12, 31), dt.datetime(2000, 12, 31)),
+                                               loc='right', fontsize=7)
+
+        # Recorte fijo: el de bbox_inches='tight' (con el margen por defecto de savefig), medido con la resolución de salida
+        self.fig.set_dpi(self.dpi)
+        self.fig.draw_without_rendering()
+        self.recorte = self.fig.get_tightbbox(self.fig.canvas.get_renderer()).padded(plt.rcParams['savefig.pad_inches'])
+
+    def graficar(self, datap, week, f1, f2, nome_fig):
+
+        # Los valores fuera de rango se muestran como faltantes
+        data = np.where((datap < 0) | (datap > 100), np.nan, datap)
+        self.malla.set_array(np.ma.masked_invalid(data))
+        self.titulo_semana.set_text(get_titulo_semana(week, f1, f2))
+
+        self.fig.savefig(nome_fig, dpi=self.dpi, bbox_inches=self.recorte)
+
+    def cerrar(self):
+        plt.close(self.fig)
+
+
+def mapa_probabilidad(variable, prob, percentil, week, modelo, f1, f2, c_out, corr=True):
 
-    plt.close(fig)
+    plantilla = PlantillaMapa(variable, percentil, prob.X.to_numpy(), prob.Y.to_numpy(), corr)
+    plantilla.graficar(prob.sel(semanas=week).to_numpy(), week, f1, f2, get_nombre_figura(c_out, week, modelo, corr))
+    plantilla.cerrar()
 
 
 def mapa_chequeo(chequeo, f1, f2, nome_fig):
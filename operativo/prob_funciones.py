@@ -9,133 +9,142 @@ import logging
 
 from pathlib import Path
 
-from funciones_extra import grouping_coord_fecha
+from calendario import CalendarioSemanas
 from setup.config import GlobalConfig
+from stores.climatology import get_climatology_weekly
+from stores.hindcast import open_hindcast_start
+from stores.pac import get_pac_factors
+from stores.regrid import regrid_like
 
+try:
+    import numba
+except ImportError:
+    numba = None
 
-def change_year(date):
-    return pd.Timestamp(date).replace(year=1960).to_datetime64()
 
+# Dimensión de las celdas de grilla seleccionadas en una consulta por puntos o polígonos (ver consulta.py)
+DIM_CELDA = 'celda'
 
-def get_prono_data(archivo, variable, miercoles):
 
-    fcst = xr.open_dataset(archivo, engine='netcdf4', decode_timedelta=True)
+def _squeeze(da):
+    """ Como squeeze(), pero sin descartar la dimensión de las celdas (una consulta puede tener una sola celda). """
+    return da.squeeze([d for d, n in da.sizes.items() if n == 1 and d != DIM_CELDA])
 
+
+def _leer_pronostico(archivo, variable, chunks=None, celdas=None):
+    """
+    Lee la variable del pronóstico (temperatura en °C). Con chunks, la lectura es diferida (dask).
+    Con celdas (indexadores de X e Y a lo largo de DIM_CELDA) solo se leen esas celdas de la grilla.
+    """
+    fcst = xr.open_dataset(archivo, engine='netcdf4', decode_timedelta=True, chunks=chunks)
+    if celdas is not None:
+        fcst = fcst.sel(celdas)
     if 'tas' in list(fcst.variables):
         fcst = fcst.tas - 273.15
     else:
         fcst = fcst[variable]
+    return fcst
+
+
+def get_prono_data(archivo, variable, miercoles, chunks=None, celdas=None):
 
-    fcst, fechas = grouping_coord_fecha(fcst, miercoles, hcast=0)
+    fcst = _leer_pronostico(archivo, variable, chunks, celdas)
+
+    calendario = CalendarioSemanas.from_data(fcst, miercoles, hcast=0)
+    fechas = calendario.fechas_iniciales
     fechas_o = [dt.datetime(a.year, a.month, a.day ).replace(year=1960).replace(hour=0) for a in fechas]
     fechas_v = [a for a in fechas]
 
     # cálculo de media semanal 1, 2, 3y4, 5
     fcst_m = xr.DataArray()
     if variable == 'tas':
-        fcst_m = fcst.groupby('semanas').mean(dim='L').squeeze()
+        fcst_m = _squeeze(calendario.aggregate(fcst, 'mean'))
     elif variable == 'pr':
         fcst = fcst*86400  # kg m-2 s-1 to mm day-1
-        fcst_m = fcst.groupby('semanas').sum(dim='L').squeeze()
+        fcst_m = _squeeze(calendario.aggregate(fcst, 'sum'))
     fcst_m = fcst_m.sel(semanas=slice(1,5))
 
     return fcst_m, fechas_o, fechas_v
 
 
-def get_prono_data_CFS(a0, variable, miercoles):
+def get_prono_data_CFS(a0, variable, miercoles, n_plazos=30, chunks=None, celdas=None):
+    """
+    Ensamble de CFSv2 con las inicializaciones de los últimos días (la más reciente primero): de cada archivo
+    se toman los n_plazos días a partir del miércoles guía y sus miembros se numeran a continuación de los
+    del archivo anterior. Todos los archivos pasan a tener S = miércoles y los plazos L del más reciente.
+    """
 
     archivos = sorted(glob.glob(a0 + '*CFSv2*.nc'), reverse=True)
+    pronosticos = [_leer_pronostico(archivo, variable, chunks, celdas) for archivo in archivos]
+    primero = pronosticos[0]
 
-    o1 = np.arange(1,len(archivos)*4,4)
-    o2 = np.arange(4, len(archivos)*4+4,4)
-
-    S_old = []
-    lista_ds = []
-    time_delta = []
-
-    for i, archivo in enumerate(archivos):
-        fcst = xr.open_dataset(archivo, engine='netcdf4', decode_timedelta=True)
-        if 'tas' in list(fcst.variables):
-            fcst = fcst.tas - 273.15
-        else:
-            fcst = fcst[variable]
-        target_date_pd = pd.to_datetime(miercoles)
+    target_date = np.datetime64(pd.to_datetime(miercoles), 'D')
+    S_old, datos = [], []
+    for archivo, fcst in zip(archivos, pronosticos):
         if fcst.isnull().all():
             logging.warning('Son todos nulos')
-        start_date = pd.to_datetime(fcst.S.values[0])
-        S_old.append(start_date)
-        dates = [(start_date + td).replace(hour=0) for td in fcst.L.values]
-        if i==0:
-            time_delta = fcst.L.values[0:30]
-        target_index = dates.index(target_date_pd)
-        fcst_selected = fcst.isel({'L': slice(target_index, target_index+30)})
-        new_timedelta_coord = xr.DataArray(time_delta[0:30], dims=('L',), name='L_new')
-        new_timedelta_coord.attrs = fcst['L'].attrs  # Preserve attributes if any
-        new_M = np.arange(o1[i], o2[i]+1)
-        fcst_selected = fcst_selected.assign_coords({'S_new': ('S', [target_date_pd]),
-                                                     'L_new': new_timedelta_coord,
-                                                     'M_new': ('M', new_M)})
-        # Colocamos las nuevas dimensiones
-        fcst_selected = fcst_selected.swap_dims({'M': 'M_new'})
-        fcst_selected = fcst_selected.drop_vars('M')
-        fcst_selected = fcst_selected.rename({'M_new':'M'})
-        #
-        fcst_selected = fcst_selected.swap_dims({'S': 'S_new'})
-        fcst_selected = fcst_selected.drop_vars('S')
-        fcst_selected = fcst_selected.rename({'S_new':'S'})
-        #
-        fcst_selected = fcst_selected.swap_dims({'L': 'L_new'})
-        fcst_selected = fcst_selected.drop_vars('L')
-        fcst_selected = fcst_selected.rename({'L_new':'L'})
-        # Agregamos a la lista para luego concatenar
-        lista_ds.append(fcst_selected)
-
-    ds = xr.concat(lista_ds, dim='M', coords='different', compat='equals')
+        # El ensamble usa la grilla y las coordenadas auxiliares del primer archivo: deben ser las mismas en todos
+        if fcst.dims != primero.dims:
+            raise ValueError(f'Las dimensiones de {archivo} no coinciden con las de {archivos[0]}')
+        for nombre, coord in primero.coords.items():
+            if nombre not in ('S', 'M', 'L') and (nombre not in fcst.coords or not fcst[nombre].equals(coord)):
+                raise ValueError(f'La coordenada {nombre} de {archivo} no coincide con la de {archivos[0]}')
+        S_old.append(pd.to_datetime(fcst.S.values[0]))
+        # Día de cada plazo y posición del miércoles guía (los días son crecientes)
+        dias = (fcst.S.values[0] + fcst.L.values).astype('datetime64[D]')
+        target_index = int(np.searchsorted(dias, target_date))
+        if target_index == len(dias) or dias[target_index] != target_date:
+            raise ValueError(f'{target_date} is not in list')
+        datos.append(fcst.isel({'L': slice(target_index, target_index+n_plazos)}).data)
+
+    # Coordenadas del ensamble: se construyen una sola vez
+    n_miembros = [fcst.sizes['M'] for fcst in pronosticos]
+    coords = {'S': ('S', [pd.to_datetime(miercoles)]),
+              'M': ('M', np.arange(1, sum(n_miembros)+1)),
+              'L': ('L', primero.L.values[0:n_plazos], primero['L'].attrs)}
+    coords.update({nombre: coord for nombre, coord in primero.coords.items() if nombre not in ('S', 'M', 'L')})
+    ds = xr.DataArray(np.concatenate(datos, axis=primero.get_axis_num('M')), dims=primero.dims, coords=coords,
+                      name=primero.name, attrs=dict(primero.attrs))
     ds.attrs['old_start_date'] = S_old
-    fcst_new, fechas = grouping_coord_fecha(ds, miercoles, hcast=0)
+    calendario = CalendarioSemanas.from_data(ds, miercoles, hcast=0)
+    fechas = calendario.fechas_iniciales
+    fcst_new = ds
     fechas_o = [dt.datetime(a.year, a.month, a.day ).replace(year=1960).replace(hour=0) for a in fechas]
     fechas_v = [a for a in fechas]
 
     # Calculo de valores semanales 1, 2, 3y4, 5
     fcst_m = xr.DataArray()
     if variable == 'tas':
-        fcst_m = fcst_new.groupby('semanas').mean(dim='L').squeeze()
+        fcst_m = _squeeze(calendario.aggregate(fcst_new, 'mean'))
     elif variable == 'pr':
         fcst_new = fcst_new*86400  # kg m-2 s-1 to mm day-1
-        fcst_m = fcst_new.groupby('semanas').sum(dim='L').squeeze()
+        fcst_m = _squeeze(calendario.aggregate(fcst_new, 'sum'))
     fcst_m = fcst_m.sel(semanas=slice(1,5))
 
     return fcst_m, fechas_o, fechas_v
 
 
-def get_hindcast_data(archivo, variable, fecha, miercoles):
-
-    hcst = xr.open_dataset(archivo, decode_timedelta=True)
+def get_hindcast_data(archivo, variable, fecha, miercoles, chunks=None):
 
     # seleccionar los datos a partir de inicio de pronóstico
-    if hcst.S.dt.year[0] != 1960:
-        logging.warning('######## fechas distintas a 1960')
-        hcst['S'] = xr.apply_ufunc(change_year, hcst['S'], vectorize=True)  # Ensures the function is applied element-wise
-
-    mes = fecha.month
-    dia = fecha.day
-    f1 = dt.datetime(1960, int(mes), int(dia))
+    hcst = open_hindcast_start(archivo, fecha.month, fecha.day, chunks)
 
     if 'tas' in list(hcst.variables):
-        hcst = hcst.tas.sel(S=f1) - 273.15
+        hcst = hcst.tas - 273.15
     else:
-        hcst = hcst[variable].sel(S=f1)
+        hcst = hcst[variable]
 
-    hcst1, fechas = grouping_coord_fecha(hcst, miercoles, hcast=1)
+    calendario = CalendarioSemanas.from_data(hcst, miercoles, hcast=1)
+    hcst1 = hcst
 
     #### Ojo aca que depende de la variable. Como se trabaja con temperatura, se queda la media.
     hcst_m = xr.DataArray()
     if variable == 'tas':
-        hcst_m = hcst1.groupby('semanas').mean(dim='L').squeeze()
+        hcst_m = calendario.aggregate(hcst1, 'mean').squeeze()
     elif variable == 'pr':
         if hcst1.units == 'kg m-2 s-1':
             hcst1 = hcst1*86400  # kg m-2 s-1 to mm day-1
-        hcst_m = hcst1.groupby('semanas').sum(dim='L').squeeze()
+        hcst_m = calendario.aggregate(hcst1, 'sum').squeeze()
     
     return hcst_m
 
@@ -146,32 +155,14 @@ def get_media_data(archivo, variable, f1, f2, dato_o, miercoles):
     config = GlobalConfig.Instance().app_config
 
     ##### Media diaria ERA5 (la de CPC andaba mal)
-    # se extraen los datos de la semana
-    # se extiende el año hasta el 28 de febrero.
-    media0 = xr.open_dataset(archivo, engine='netcdf4', decode_timedelta=True)
-    media1 = media0.sel(S=slice('1960-01-01', '1960-02-28')).copy()
-    new_time_coords = pd.date_range(start='1961-01-01', end='1961-02-28', freq='D')
-    media1 = media1.assign_coords(time=('S', new_time_coords))
-    media1 = media1.swap_dims({'S': 'time'})
-    media1 = media1.drop_vars('S')
-    media1 = media1.rename({'time':'S'})
-    #
-    media = xr.concat([media0, media1], dim='S', coords='different', compat='equals')
-    media = media[variable].sel(S=slice(f1, f2))
-    if ({'longitude', 'latitude'}).issubset(media.dims):
-        media = media.rename({'longitude': 'X','latitude': 'Y'})
-    if ({'lon', 'lat'}).issubset(media.dims):
-        media = media.rename({'lon': 'X','lat': 'Y'})
-    #    
-    media1, fechas = grouping_coord_fecha(media, miercoles, hcast=1)
-    #
+    # se extraen los datos de la semana, las ventanas que cruzan el fin de año continúan en enero/febrero.
     media_m = xr.DataArray()
     if variable == config.mapeo_variables.tas:
-        media_m = media1.groupby('semanas').mean(dim='S').squeeze()
+        media_m = get_climatology_weekly(archivo, variable, f1, f2, miercoles, agregacion='mean')
     elif variable == config.mapeo_variables.pr:
-        media_m = media1.groupby('semanas').sum(dim='S').squeeze()
+        media_m = get_climatology_weekly(archivo, variable, f1, f2, miercoles, agregacion='sum')
     # Interpolamos a la reticula de subX
-    media_m_i = media_m.interp_like(dato_o)
+    media_m_i = regrid_like(media_m, dato_o)
     #
     return media_m_i
 
@@ -189,7 +180,7 @@ def get_pctil_data(archivo0, archivo1, variable, fechas_o, fechas_v, dato_o):
         pctil1 = pctil1.rename({'lon': 'X','lat': 'Y'})
     pctil1 = pctil1.sel(S=fechas_o[0:2])
     # Interpolamos a la reticula de subX
-    pctil1_i = pctil1.interp_like(dato_o)
+    pctil1_i = regrid_like(pctil1, dato_o)
     pctil1_i = pctil1_i.assign_coords(S=('S',fechas_v[0:2]))
     pctil1_i['S'] = pd.DatetimeIndex(pctil1_i['S'].values)
     pctil1_i = pctil1_i.assign_coords(semanas=('S', np.array([1.,2.]))).swap_dims({'S':'semanas'})
@@ -203,7 +194,7 @@ def get_pctil_data(archivo0, archivo1, variable, fechas_o, fechas_v, dato_o):
         pctil2 = pctil2.rename({'lon': 'X','lat': 'Y'})
     pctil2 = pctil2.sel(S=fechas_o[2:4])
     # Interpolamos a la reticula de subX
-    pctil2_i = pctil2.interp_like(dato_o)
+    pctil2_i = regrid_like(pctil2, dato_o)
     pctil2_i = pctil2_i.assign_coords(S=('S',fechas_v[2:4]))
     pctil2_i['S'] = pd.DatetimeIndex(pctil2_i['S'].values)
     pctil2_i = pctil2_i.assign_coords(semanas=('S', np.array([3.,5.]))).swap_dims({'S':'semanas'})
@@ -214,8 +205,11 @@ def get_pctil_data(archivo0, archivo1, variable, fechas_o, fechas_v, dato_o):
     return pctil_i
 
 
-def get_data(fecha, pctil, miercoles, variable='tas', modelo='GEOS_V2p1'):
-
+def get_archivos_datos(fecha, pctiles, miercoles, variable='tas', modelo='GEOS_V2p1'):
+    """
+    Archivos que lee get_data_percentiles: pronóstico (para CFSv2, la carpeta con los pronósticos de los 5 días),
+    hindcast, media diaria histórica y, para cada percentil, los percentiles de 1 y 2 semanas.
+    """
     # Acceder a la configuración global
     config = GlobalConfig.Instance().app_config
 
@@ -229,74 +223,180 @@ def get_data(fecha, pctil, miercoles, variable='tas', modelo='GEOS_V2p1'):
 
     nf1 = variable +'_' + modelo + '_' + fecha_str + '_forecast.nc'
 
+    if modelo == 'CFSv2':
+        a0 = carpeta + '/operativo/forecast/' + variable + '/' + mierc_str + '/'
+    else:
+        a0 = carpeta + '/operativo/forecast/' + variable + '/' + mierc_str + '/' + nf1
+    a1 = carpeta + '/hindcast/' + variable +'_' + modelo + '_datos.nc'
+    a2 = carpeta + '/clim/' + varn[variable] + '/' + varn[variable] + 'ClimSmooth.nc'
+
+    # Solo los archivos de percentiles dependen del percentil
+    percentiles = {}
+    for pctil in pctiles:
+        a3 = carpeta + '/clim/' + varn[variable] + '/' + varn[variable] + '_weeklymean_pctile' + str(pctil) + '_smooth.nc'
+        a4 = carpeta + '/clim/' + varn[variable] + '/' + varn[variable] + '_2weeklymean_pctile' + str(pctil) + '_smooth.nc'
+        percentiles[pctil] = (a3, a4)
+
+    return {'pronostico': a0, 'hindcast': a1, 'media': a2, 'percentiles': percentiles}
+
+
+def get_data_percentiles(fecha, pctiles, miercoles, variable='tas', modelo='GEOS_V2p1', chunks=None, celdas=None):
+    """
+    Se leen una sola vez el pronóstico, el hindcast y la media diaria del modelo para la fecha,
+    y se obtienen los umbrales para todos los percentiles solicitados.
+    Devuelve un diccionario con el umbral de cada percentil (clave: percentil).
+    Con chunks (p.e. {'X': 50, 'Y': 50}) el pronóstico y el hindcast se leen de forma diferida, por bloques
+    (con dask), y los resultados de calc_prob y calc_prob_corr quedan sin calcular hasta que se piden.
+    Con celdas (indexadores de X e Y a lo largo de DIM_CELDA) solo se leen esas celdas del pronóstico; el hindcast,
+    la media y los percentiles (campos chicos, sin miembros) se obtienen en la grilla completa y luego se seleccionan.
+    """
+    # Acceder a la configuración global
+    config = GlobalConfig.Instance().app_config
+
+    varn = vars(config.mapeo_variables)  # para convertir SimpleNamespace a dict
+
+    archivos = get_archivos_datos(fecha, pctiles, miercoles, variable, modelo)
+    a0, a1, a2 = archivos['pronostico'], archivos['hindcast'], archivos['media']
+
     ################################
     logging.info('$$$$$$$$$$$$$$ DATOS UTILIZADOS $$$$$$$$$$$$$$$$$$$$$')
     if modelo == 'CFSv2':
-        a0 = carpeta + '/operativo/forecast/' + variable + '/' + mierc_str + '/'
         logging.info(f'$$$$ Archivos pronósticos en: {a0}')
         fcst_len = xr.open_dataset(glob.glob(a0+'*.nc')[0], engine='netcdf4', decode_timedelta=True).sizes['L']-1
     else:
-        a0 = carpeta + '/operativo/forecast/' + variable + '/' + mierc_str + '/' + nf1
         logging.info(f'$$$$ Archivo pronóstico: {a0}')
         fcst_len = xr.open_dataset(a0, engine='netcdf4', decode_timedelta=True).sizes['L']-1
-    a1 = carpeta + '/hindcast/' + variable +'_' + modelo + '_datos.nc'
-    a2 = carpeta + '/clim/' + varn[variable] + '/' + varn[variable] + 'ClimSmooth.nc'
-    a3 = carpeta + '/clim/' + varn[variable] + '/' + varn[variable] + '_weeklymean_pctile' + str(pctil) + '_smooth.nc'
-    a4 = carpeta + '/clim/' + varn[variable] + '/' + varn[variable] + '_2weeklymean_pctile' + str(pctil) + '_smooth.nc'
 
     ################################    
     logging.info(f'$$$$ Archivo hindcast: {a1}')
     logging.info(f'$$$$ Archivo diario histórico: {a2}')
-    logging.info(f'$$$$ Archivo percentil 1 semana: {a3}')
-    logging.info(f'$$$$ Archivo percentil 2 semana: {a4}')
-    logging.info('$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$')
 
     if modelo == 'CFSv2':
-        fcst_m, fechas_o, fechas_v = get_prono_data_CFS(a0, variable, miercoles)
+        fcst_m, fechas_o, fechas_v = get_prono_data_CFS(a0, variable, miercoles, chunks=chunks, celdas=celdas)
     else:
-        fcst_m, fechas_o, fechas_v = get_prono_data(a0, variable, miercoles)
+        fcst_m, fechas_o, fechas_v = get_prono_data(a0, variable, miercoles, chunks, celdas)
     
     f1 = fechas_o[0]
     f2 = f1 + dt.timedelta(days=fcst_len)
     
-    hcst_m = get_hindcast_data(a1, variable, fechas_o[0], miercoles)
+    hcst_m = get_hindcast_data(a1, variable, fechas_o[0], miercoles, chunks)
     media_m_i = get_media_data(a2, varn[variable], f1, f2, hcst_m, miercoles)
-    pctil_i = get_pctil_data(a3, a4, varn[variable], fechas_o, fechas_v, hcst_m)
-   
-    aux_hcst = []
-    aux_media = []
-    aux_pctil = []
-    for i in range(fcst_m.sizes['M']):
-        aux_hcst.append(hcst_m)
-        aux_media.append(media_m_i)
-        aux_pctil.append(pctil_i)
-    media_f = xr.concat(aux_media, dim=fcst_m.M, coords='different', compat='equals')
-    pctil_f = xr.concat(aux_pctil, dim=fcst_m.M, coords='different', compat='equals')
-    hcst_f = xr.concat(aux_hcst, dim=fcst_m.M, coords='different', compat='equals')
-
-    return fcst_m, hcst_f, media_f, pctil_f, fechas_v
-
-
-def calc_prob(fcst_m, hcst_f, media_f, pctil_f, pctil):
-
-    new_fcst = fcst_m - hcst_f + media_f
-   
+
+    # Solo los archivos de percentiles dependen del percentil
+    pctiles_i = {}
+    for pctil, (a3, a4) in archivos['percentiles'].items():
+        logging.info(f'$$$$ Archivo percentil {pctil} 1 semana: {a3}')
+        logging.info(f'$$$$ Archivo percentil {pctil} 2 semana: {a4}')
+        pctiles_i[pctil] = get_pctil_data(a3, a4, varn[variable], fechas_o, fechas_v, hcst_m)
+    logging.info('$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$')
+
+    if celdas is not None:
+        hcst_m, media_m_i = hcst_m.sel(celdas), media_m_i.sel(celdas)
+        pctiles_i = {pctil: pctil_i.sel(celdas) for pctil, pctil_i in pctiles_i.items()}
+
+    # El hindcast, la media y los percentiles son iguales para todos los miembros del ensamble,
+    # por lo que no se replican a lo largo de M: calc_prob los combina con fcst_m por broadcasting.
+    return fcst_m, hcst_m, media_m_i, pctiles_i, fechas_v
+
+
+def get_data(fecha, pctil, miercoles, variable='tas', modelo='GEOS_V2p1', chunks=None):
+
+    fcst_m, hcst_m, media_m, pctiles_m, fechas_v = get_data_percentiles(fecha, [pctil], miercoles, variable, modelo, chunks)
+
+    return fcst_m, hcst_m, media_m, pctiles_m[pctil], fechas_v
+
+
+def _contar_miembros(fcst, hcst, media, pctil):
+    """
+    Cuenta los miembros por debajo y por encima del percentil en cada punto, sin construir
+    el pronóstico corregido (fcst - hcst + media) para todo el ensamble.
+    fcst tiene los miembros en el último eje; hcst, media y pctil se combinan por broadcasting.
+    """
+    forma = np.broadcast_shapes(fcst.shape[:-1], np.shape(hcst), np.shape(media), np.shape(pctil))
+    miembros = np.moveaxis(fcst, -1, 0)
+
+    if numba is not None and miembros.shape[1:] == forma and miembros.flags.c_contiguous:
+        n = int(np.prod(forma))
+        campos = [np.broadcast_to(a, forma).reshape(n) for a in (hcst, media, pctil)]
+        n_bajo, n_sobre = _contar_miembros_numba(miembros.reshape(miembros.shape[0], n), *campos)
+        return n_bajo.reshape(forma), n_sobre.reshape(forma)
+
+    return _contar_miembros_numpy(fcst, hcst, media, pctil)
+
+
+def _contar_miembros_numpy(fcst, hcst, media, pctil):
+    # Implementación de referencia de _contar_miembros, sin numba (ver benchmarks/)
+    forma = np.broadcast_shapes(fcst.shape[:-1], np.shape(hcst), np.shape(media), np.shape(pctil))
+    n_bajo = np.zeros(forma, dtype=np.int64)
+    n_sobre = np.zeros(forma, dtype=np.int64)
+    for miembro in np.moveaxis(fcst, -1, 0):
+        new_fcst = miembro - hcst + media
+        n_bajo += new_fcst < pctil
+        n_sobre += new_fcst > pctil
+    return n_bajo, n_sobre
+
+
+if numba is not None:
+    @numba.njit(cache=True)
+    def _contar_miembros_numba(miembros, hcst, media, pctil):
+        n_bajo = np.zeros(miembros.shape[1], dtype=np.int64)
+        n_sobre = np.zeros(miembros.shape[1], dtype=np.int64)
+        for m in range(miembros.shape[0]):
+            for i in range(miembros.shape[1]):
+                new_fcst = miembros[m, i] - hcst[i] + media[i]
+                if new_fcst < pctil[i]:
+                    n_bajo[i] += 1
+                elif new_fcst > pctil[i]:
+                    n_sobre[i] += 1
+        return n_bajo, n_sobre
+
+
+def _coords_aritmetica(*arrays):
+    """
+    Coordenadas no índice que conserva xarray al operar los arrays en secuencia: cuando una
+    coordenada difiere entre el resultado acumulado y el siguiente array, se descarta.
+    """
+    coords = {}
+    for a in arrays:
+        for nombre, coord in a.coords.items():
+            if nombre in a.indexes:
+                continue
+            if nombre not in coords:
+                coords[nombre] = coord.variable
+            elif not coords[nombre].equals(coord.variable):
+                del coords[nombre]
+    return coords
+
+
+def calc_prob(fcst_m, hcst_m, media_m, pctil_m, pctil):
+    """
+    hcst_m, media_m y pctil_m no tienen la dimensión M, se extienden a los miembros por broadcasting.
+    """
+
+    entradas = xr.align(fcst_m, hcst_m, media_m, pctil_m, join='inner')
+    if entradas[0].chunks is not None:
+        # Datos por bloques: cada bloque debe tener todos los miembros (el ensamble de CFSv2 tiene un bloque por archivo)
+        entradas = (entradas[0].chunk({'M': -1}),) + entradas[1:]
+    n_bajo, n_sobre = xr.apply_ufunc(_contar_miembros, *[a.reset_coords(drop=True) for a in entradas],
+                                     input_core_dims=[['M'], [], [], []], output_core_dims=[[], []],
+                                     keep_attrs=False, dask='parallelized', output_dtypes=['int64', 'int64'])
+    coords = {nombre: coord for nombre, coord in _coords_aritmetica(*entradas).items()
+              if set(coord.dims).issubset(n_bajo.dims)}
+    n_bajo, n_sobre = n_bajo.assign_coords(coords), n_sobre.assign_coords(coords)
+
     if pctil == 20:
-        with xr.set_options(keep_attrs=True):
-            p1 = 100 * (xr.where(new_fcst < pctil_f, 1., 0. ).sum(dim='M') / fcst_m.sizes['M'])
+        p1 = 100 * (n_bajo / fcst_m.sizes['M'])
         p1 = p1.rename('prob')
         p1 = p1.assign_attrs(standard_name='Probabilidad bajo percentil 20')
         p2 = []
     elif pctil == 80:
-        with xr.set_options(keep_attrs=True):
-            p1 = 100 * (xr.where(new_fcst > pctil_f, 1., 0. ).sum(dim='M') / fcst_m.sizes['M'])
+        p1 = 100 * (n_sobre / fcst_m.sizes['M'])
         p1 = p1.rename('prob')
         p1 = p1.assign_attrs(standard_name='Probabilidad sobre percentil 80')
         p2 = []
     else: # pctil = 50
-        with xr.set_options(keep_attrs=True):
-            p1 = 100 * (xr.where(new_fcst < pctil_f, 1., 0. ).sum(dim='M') / fcst_m.sizes['M'])
-            p2 = 100 * (xr.where(new_fcst > pctil_f, 1., 0. ).sum(dim='M') / fcst_m.sizes['M'])
+        p1 = 100 * (n_bajo / fcst_m.sizes['M'])
+        p2 = 100 * (n_sobre / fcst_m.sizes['M'])
         p1 = p1.rename('prob')
         p2 = p2.rename('prob')
         p1 = p1.assign_attrs(standard_name='Probabilidad bajo percentil 50')
@@ -308,6 +408,7 @@ def calc_prob(fcst_m, hcst_f, media_f, pctil_f, pctil):
 def calc_prob_corr(p1, p2, variable, modelo, percentil):
     """
     Se corrige la probabilidad obtenida según el trabajo de Van de Dool et al 2017
+    Los factores de corrección PAC * (std_o / std_p) se leen del archivo consolidado del modelo.
     """
     if str(percentil) == '20':
         cp = 0.2
@@ -315,21 +416,17 @@ def calc_prob_corr(p1, p2, variable, modelo, percentil):
         cp = 0.2
     else:
         cp = 0.5
-    # Obtener carpeta de datos
-    carpeta = os.fspath(Path(GlobalConfig.Instance().app_config.carpeta_datos))
-    c_PAC = carpeta + '/PAC/' + variable + '/'
+    # Factores de corrección de todas las semanas y categorías (una lectura por proceso)
+    factores = get_pac_factors(variable, modelo)
+    if DIM_CELDA in p1.dims:
+        # Probabilidades de una selección de celdas: se toman los factores de esas mismas celdas
+        factores = factores.sel(X=xr.DataArray(p1.X.values, dims=DIM_CELDA), Y=xr.DataArray(p1.Y.values, dims=DIM_CELDA))
     if (percentil == '20') or (percentil == '80'):
         " Lista vacia para p2, ie el percentil es 20 o 80"
         list_corr = []
         for week in [1,2,3]:
-            f1 = c_PAC + '/' + modelo + '/' + variable + '_PAC_semana' + str(week) + '_pctil' + str(percentil) + '.nc'
-            f2 = c_PAC + '/' + modelo + '/' + variable + '_stdo_semana' + str(week) + '_pctil' + str(percentil) + '.nc'
-            f3 = c_PAC + '/' + modelo + '/' + variable + '_stdp_semana' + str(week) + '_pctil' + str(percentil) + '.nc'
-            PAC = xr.open_dataset(f1, engine='netcdf4', decode_timedelta=True)['PAC']
-            std_o = xr.open_dataset(f2, engine='netcdf4', decode_timedelta=True)['std_o']
-            std_p = xr.open_dataset(f3, engine='netcdf4', decode_timedelta=True)['std_p']
+            corr_factor = factores.sel(categoria=str(percentil), semanas=week, drop=True)
             with xr.set_options(keep_attrs=True):
-                corr_factor = PAC * (std_o / std_p)
                 prob = p1.sel(semanas=week) * 0.01
                 p_corr = xr.where(corr_factor > 0, (cp + corr_factor * (prob - cp)), cp)
                 p_corr = 100. * p_corr
@@ -343,33 +440,18 @@ def calc_prob_corr(p1, p2, variable, modelo, percentil):
         list_corr1 = []
         list_corr2 = []
         for week in [1,2,3]:
-            # Archivos para corregir 50-
-            f1 = c_PAC + '/' + modelo + '/' + variable + '_PAC_semana' + str(week) + '_pctil50-.nc'
-            f2 = c_PAC + '/' + modelo + '/' + variable + '_stdo_semana' + str(week) + '_pctil50-.nc'
-            f3 = c_PAC + '/' + modelo + '/' + variable + '_stdp_semana' + str(week) + '_pctil50-.nc'
             # ################
             # para 50-
-            PAC = xr.open_dataset(f1, engine='netcdf4', decode_timedelta=True)['PAC']
-            std_o = xr.open_dataset(f2, engine='netcdf4', decode_timedelta=True)['std_o']
-            std_p = xr.open_dataset(f3, engine='netcdf4', decode_timedelta=True)['std_p']
+            corr_factor = factores.sel(categoria='50-', semanas=week, drop=True)
             with xr.set_options(keep_attrs=True):
-                corr_factor = PAC * (std_o / std_p)
                 prob = p1.sel(semanas=week) * 0.01
                 p_corr1 = xr.where(corr_factor > 0, (cp + corr_factor * (prob - cp)), cp)
                 p_corr1 = 100. * p_corr1
             p_corr1 = p_corr1.rename('prob_corr')
-            ############################################
-            # Archivos para corregir 50+
-            f1 = c_PAC + '/' + modelo + '/' + variable + '_PAC_semana' + str(week) + '_pctil50+.nc'
-            f2 = c_PAC + '/' + modelo + '/' + variable + '_stdo_semana' + str(week) + '_pctil50+.nc'
-            f3 = c_PAC + '/' + modelo + '/' + variable + '_stdp_semana' + str(week) + '_pctil50+.nc'
             # ################
             # para 50+
-            PAC = xr.open_dataset(f1, engine='netcdf4', decode_timedelta=True)['PAC']
-            std_o = xr.open_dataset(f2, engine='netcdf4', decode_timedelta=True)['std_o']
-            std_p = xr.open_dataset(f3, engine='netcdf4', decode_timedelta=True)['std_p']
+            corr_factor = factores.sel(categoria='50+', semanas=week, drop=True)
             with xr.set_options(keep_attrs=True):
-                corr_factor = PAC * (std_o / std_p)
                 prob = p2.sel(semanas=week) * 0.01
                 p_corr2 = xr.where(corr_factor > 0, (cp + corr_factor * (prob - cp)), cp)
                 p_corr2 = 100. * p_corr2
@@ -383,7 +465,14 @@ def calc_prob_corr(p1, p2, variable, modelo, percentil):
         return p1_corr, p2_corr
 
 
-def calc_prob_corr_extr(p1, p2):
+def valores_fuera_de_rango(p1, p2) -> tuple[bool, bool, bool, bool]:
+    """
+    Si hay valores < 0 o > 100 en p1 y en p2 (en ese orden): determinan qué corrección de extremos se aplica.
+    """
+    return bool((p1 < 0).any()), bool((p1 > 100).any()), bool((p2 < 0).any()), bool((p2 > 100).any())
+
+
+def calc_prob_corr_extr(p1, p2, fuera_rango=None):
     """
     Se corrige la probabilidad obtenida según el trabajo de Van de Dool et al 2017
         p1 --> percentil 20
@@ -393,72 +482,43 @@ def calc_prob_corr_extr(p1, p2):
         p_no -> Probabilidad entre percentil 20 y 80
         p2-> Probabilidad sobre percentil 80
     En este caso, el valor de p_no no se considera.
+    La mitad del exceso de una probabilidad fuera de rango se traslada a la otra. Si ambas tienen
+    valores fuera de rango, prevalece la corrección de p2 sobre p1 y, para cada una, la de valores > 100.
+    Qué corrección se aplica depende de si hay valores fuera de rango en todo p1 y p2 (ver valores_fuera_de_rango):
+    para corregir una selección de celdas igual que la grilla completa, se pasan los de la grilla en fuera_rango.
     """
-    max_iter = 3
-
-    p1_o = p1.copy()
-    p2_o = p2.copy()
-
-    ##################################################
-    # Se trabaja con prob percentil 20
-    negativo = bool((p1 < 0).any().to_numpy().any())
-    i = 1
-    if negativo:
-        while i <= max_iter:
-            with xr.set_options(keep_attrs=True):
-                discrepancy = xr.where(p1 < 0, p1-1, 0)
-                # sumamos la mitad a donde corresponda
-                p2_o = p2 + 0.5 * discrepancy
-            p1_o = p1_o.where(p1 >= 0, 1)
-            i += 1
-    p1_o = p1_o.where(p1_o >= 0, 1)
 
-    ###########
-    positivo = bool((p1 > 100).any().to_numpy().any())
-    i = 1
-    if positivo:
-        while i <= max_iter:
-            with xr.set_options(keep_attrs=True):
-                discrepancy = xr.where(p1 > 100., p1-99, 0)
-                # sumamos la mitad a donde corresponda
-                p2_o = p2 + 0.5 * discrepancy
+    # Puntos fuera de rango de cada probabilidad
+    p1_neg, p1_pos = p1 < 0, p1 > 100
+    p2_neg, p2_pos = p2 < 0, p2 > 100
+    if fuera_rango is None:
+        fuera_rango = valores_fuera_de_rango(p1, p2)
+    hay_p1_neg, hay_p1_pos, hay_p2_neg, hay_p2_pos = fuera_rango
+
+    with xr.set_options(keep_attrs=True):
+        ##################################################
+        # Se trabaja con prob percentil 20
+        if hay_p1_pos:
+            p2_o = p2 + 0.5 * xr.where(p1_pos, p1 - 99, 0)
+        elif hay_p1_neg:
+            p2_o = p2 + 0.5 * xr.where(p1_neg, p1 - 1, 0)
+        else:
+            p2_o = p2.copy()
+        p1_o = p1.where(p1 >= 0, 1)
+        if hay_p1_pos:
             p1_o = p1_o.where(p1 <= 100, 99)
-            i += 1
-    positivo = bool((p1_o > 100).any().to_numpy().any())
-    if positivo:
-        p1_o = p1_o.where(p1_o <= 100, 99)
-
-    ##################################################
-    ##################################################
-    # Se trabaja con prob percentil 80
-    negativo = bool((p2 < 0).any().to_numpy().any())
-    i = 1
-    if negativo:
-        while i <= max_iter:
-            with xr.set_options(keep_attrs=True):
-                discrepancy = xr.where(p2 < 0, p2 - 1, 0)
-                # sumamos la mitad a donde corresponda
-                p1_o = p1 + 0.5 * discrepancy
+
+        ##################################################
+        # Se trabaja con prob percentil 80
+        if hay_p2_pos:
+            p1_o = p1 + 0.5 * xr.where(p2_pos, p2 - 99, 0)
+        elif hay_p2_neg:
+            p1_o = p1 + 0.5 * xr.where(p2_neg, p2 - 1, 0)
+        if hay_p2_neg:
             p2_o = p2_o.where(p2 >= 0, 1)
-            i += 1
-    negativo = bool((p2_o < 0).any().to_numpy().any())
-    if negativo:
         p2_o = p2_o.where(p2_o >= 0, 0.)
-    p2_o = p2_o.where(p2_o >= 0, 0.)
-
-    #
-    positivo = bool((p2 > 100).any().to_numpy().any())
-    i = 1
-    if positivo:
-        while i <= max_iter:
-            with xr.set_options(keep_attrs=True):
-                discrepancy = xr.where(p2 > 100., p2 - 99, 0)
-                # sumamos la mitad a donde corresponda
-                p1_o = p1 + 0.5 * discrepancy
+        if hay_p2_pos:
             p2_o = p2_o.where(p2 <= 100, 99)
-            i += 1
-    positivo = bool((p2_o > 100).any().to_numpy().any())
-    if positivo:
         p2_o = p2_o.where(p2_o <= 100, 99)
 
     p1_o = p1_o.where(p1_o >= 0, 1)
@@ -0,0 +1,112 @@
+
+import sys
+import argparse
+import logging
+
+import pandas as pd
+import shapely
+
+from calendar import Day
+
+from funciones_extra import get_date_for_weekday, parse_date, VALID_MODELS
+from etapas import descargar, PERCENTILES_SALIDA
+from consulta import consultar_puntos, consultar_poligono, historia_puntos, historia_poligono
+
+from controllers.script import ScriptControl
+
+
+def parse_args() -> argparse.Namespace:
+
+    comunes = argparse.ArgumentParser(add_help=False)
+    comunes.add_argument('modelo', type=str, choices=VALID_MODELS, help='Model to be calibrated')
+    comunes.add_argument('fecha', type=parse_date, help='Date to be calibrated (the previous Wednesday is used)')
+    comunes.add_argument('variable', type=str, choices=['pr', 'tas'], help='Variable to be calibrated (pr or tas)')
+    comunes.add_argument('--salida', type=str, default=None, help='Output CSV file (default: standard output)')
+    comunes.add_argument('--descargar', action='store_true',
+                         help='Download (or revalidate) the forecast before the query, instead of using the files already downloaded')
+
+    parser = argparse.ArgumentParser(description='Computes calibrated probabilities for a set of points or a polygon.')
+    subparsers = parser.add_subparsers(dest='consulta', required=True)
+
+    puntos = subparsers.add_parser('puntos', parents=[comunes], help='Probabilities at points (e.g. stations)')
+    puntos.add_argument('--punto', nargs=3, action='append', default=[], metavar=('NOMBRE', 'LON', 'LAT'),
+                        help='Point to be queried (can be repeated)')
+    puntos.add_argument('--archivo', type=str, default=None, help='CSV file with columns nombre, lon and lat')
+
+    poligono = subparsers.add_parser('poligono', parents=[comunes], help='Probabilities in a polygon (e.g. a basin)')
+    poligono.add_argument('archivo', type=str, help='Polygon file (GeoJSON, or WKT if the extension is not .json/.geojson)')
+    poligono.add_argument('--celdas', dest='agregar', action='store_false',
+                          help='One row per grid cell, instead of the polygon average')
+
+    historia = subparsers.add_parser('historia', help='Probabilities of the archived forecasts at points or in a polygon')
+    historia.add_argument('modelo', type=str, choices=VALID_MODELS, help='Model to be queried')
+    historia.add_argument('variable', type=str, choices=['pr', 'tas'], help='Variable to be queried (pr or tas)')
+    historia.add_argument('--punto', nargs=3, action='append', default=[], metavar=('NOMBRE', 'LON', 'LAT'),
+                          help='Point to be queried (can be repeated)')
+    historia.add_argument('--archivo', type=str, default=None, help='CSV file with columns nombre, lon and lat')
+    historia.add_argument('--poligono', type=str, default=None,
+                          help='Polygon file (GeoJSON or WKT), instead of points: the polygon average is returned')
+    historia.add_argument('--categoria', type=str, nargs='+', choices=PERCENTILES_SALIDA, default=None,
+                          help='Categories to be queried (default: all)')
+    historia.add_argument('--desde', type=parse_date, default=None, help='First forecast initialization date')
+    historia.add_argument('--hasta', type=parse_date, default=None, help='Last forecast initialization date')
+    historia.add_argument('--salida', type=str, default=None, help='Output CSV file (default: standard output)')
+
+    return parser.parse_args()
+
+
+def leer_puntos(args: argparse.Namespace) -> pd.DataFrame:
+    tablas = [pd.DataFrame(args.punto, columns=['nombre', 'lon', 'lat'])]
+    if args.archivo:
+        tablas.append(pd.read_csv(args.archivo)[['nombre', 'lon', 'lat']])
+    puntos = pd.concat(tablas, ignore_index=True).astype({'lon': float, 'lat': float})
+    if puntos.empty:
+        raise SystemExit('Se debe indicar al menos un punto (--punto o --archivo)')
+    return puntos
+
+
+def leer_poligono(archivo: str) -> shapely.Geometry:
+    with open(archivo, 'r') as f:
+        texto = f.read()
+    geometria = shapely.from_geojson(texto) if archivo.endswith(('.json', '.geojson')) else shapely.from_wkt(texto)
+    # Las colecciones (p.e. un FeatureCollection) se unen en un único polígono
+    return shapely.union_all(shapely.get_parts(geometria))
+
+
+if __name__ == '__main__':
+
+    # Catch and parse command-line arguments
+    args: argparse.Namespace = parse_args()
+
+    # Create script control (se permiten varias consultas simultáneas)
+    script = ScriptControl(f'query--{args.modelo}', single_instance=False)
+
+    # Start script execution
+    script.start_script()
+
+    if args.consulta == 'historia':
+        # Pronósticos ya calibrados, guardados en el histórico (ver stores/historico.py)
+        periodo = {'categorias': args.categoria, 'desde': args.desde, 'hasta': args.hasta}
+        if args.poligono:
+            tabla = historia_poligono(args.modelo, args.variable, leer_poligono(args.poligono), **periodo)
+        else:
+            tabla = historia_puntos(args.modelo, args.variable, leer_puntos(args), **periodo)
+
+    else:
+        # Fecha 0 siempre es el miércoles guía.
+        miercoles = get_date_for_weekday(start_date=args.fecha, target_weekday=Day.WEDNESDAY)  # ---> miércoles previo
+
+        if args.descargar:
+            descargar(args.modelo, args.variable, miercoles)
+
+        if args.consulta == 'puntos':
+            tabla = consultar_puntos(args.modelo, args.variable, miercoles, leer_puntos(args))
+        else:
+            tabla = consultar_poligono(args.modelo, args.variable, miercoles, leer_poligono(args.archivo), args.agregar)
+
+    tabla.to_csv(args.salida or sys.stdout, index=False)
+    if args.salida:
+        logging.info(f'Resultado guardado en: {args.salida}')
+
+    # End script execution
+    script.end_script_execution()
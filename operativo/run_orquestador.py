@@ -0,0 +1,163 @@
+
+import sys
+import argparse
+import datetime as dt
+import logging
+
+from calendar import Day
+from concurrent.futures import Future, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Callable
+
+from funciones_extra import get_date_for_weekday, parse_date, is_date_dayofweek, VALID_MODELS
+from etapas import descargar, calibrar, guardar_probabilidades, graficar_probabilidades, inicializar_proceso
+from etapas import preparar_figuras
+
+from setup.config import  GlobalConfig
+from controllers.script import ScriptControl
+
+
+def parse_args() -> argparse.Namespace:
+
+    parser = argparse.ArgumentParser(description='Calibrates several models and variables in a single process pool.')
+
+    parser.add_argument('fecha', type=parse_date, help='Date to be calibrated')
+    parser.add_argument('--modelos', type=str, choices=VALID_MODELS, nargs='+', default=VALID_MODELS,
+                        help='Models to be calibrated')
+    parser.add_argument('--variables', type=str, choices=['pr', 'tas'], nargs='+', default=['pr', 'tas'],
+                        help='Variables to be calibrated')
+    parser.add_argument('--procesos', type=int, default=None, help='Number of worker processes')
+    parser.add_argument('--memoria', type=float, default=None, help='Memory budget (GB) for the running stages')
+    parser.add_argument('--no-plot', dest= 'plot_maps', action='store_false', help='Don\'t generate built-in plots')
+    parser.add_argument('--re-download', dest= 'redownload', action='store_true', help='Redownload input files for calibration')
+    parser.add_argument('--chunks', type=int, default=None,
+                        help='Process the grid lazily in blocks of CHUNKS x CHUNKS points (with dask)')
+
+    return parser.parse_args()
+
+
+class Nodo(object):
+    """
+    Etapa del grafo de ejecución. La etapa comienza cuando terminaron las etapas de las que depende: las de
+    dependencias solo deben terminar antes, y los resultados de las de entradas se pasan a la función a
+    continuación de sus argumentos. La memoria es la estimación (GB) usada para limitar la concurrencia.
+    """
+
+    def __init__(self, clave: str, funcion: Callable, args: tuple, dependencias: list['Nodo'] = (),
+                 memoria: float = 0., entradas: list['Nodo'] = ()):
+        self.clave: str = clave
+        self.funcion: Callable = funcion
+        self.args: tuple = args
+        self.entradas: list[Nodo] = list(entradas)
+        self.dependencias: list[Nodo] = list(dependencias) + [n for n in entradas if n not in dependencias]
+        self.memoria: float = memoria
+
+
+def construir_grafo(modelos: list[str], variables: list[str], miercoles: dt.datetime,
+                    redownload: bool, plot_maps: bool, chunks: int | None = None) -> list[Nodo]:
+    """
+    Para cada modelo y variable: descarga -> calibración (lectura, probabilidades y correcciones) -> archivos y figuras.
+    Con chunks, la calibración se hace por bloques y su memoria estimada es la de memoria_etapas.calibracion_bloques.
+    """
+    config = GlobalConfig.Instance().app_config
+    memoria = config.orquestador.memoria_etapas
+
+    nodos = []
+    for modelo in modelos:
+        for variable in variables:
+            clave = f'{modelo}/{variable}'
+            args = (modelo, variable, miercoles)
+            descarga = Nodo(f'{clave}/descarga', descargar, args + (redownload,), memoria=memoria.descarga)
+            memoria_calibracion = memoria.calibracion_bloques if chunks is not None else \
+                getattr(config.orquestador.memoria_calibracion, modelo)
+            # La calibración usa los archivos descargados, no el resultado de la descarga
+            calibracion = Nodo(f'{clave}/calibracion', calibrar, args + (chunks,), [descarga], memoria=memoria_calibracion)
+            nodos += [descarga, calibracion,
+                      Nodo(f'{clave}/escritura', guardar_probabilidades, args, memoria=memoria.escritura,
+                           entradas=[calibracion])]
+            if plot_maps:
+                nodos.append(Nodo(f'{clave}/figuras', graficar_probabilidades, args, memoria=memoria.figuras,
+                                  entradas=[calibracion]))
+
+    return nodos
+
+
+def ejecutar_grafo(nodos: list[Nodo], procesos: int, memoria: float, variables: list[str]) -> tuple[dict[str, Any], set[str]]:
+    """
+    Ejecuta en un pool de procesos cada etapa cuyas dependencias ya terminaron, siempre que la memoria
+    estimada de las etapas en curso no supere el presupuesto (una etapa mayor al presupuesto corre sola).
+    Si una etapa falla, no se ejecutan las que dependen de ella. Devuelve los resultados y las etapas fallidas.
+    """
+    pendientes = list(nodos)
+    resultados: dict[str, Any] = {}
+    fallidas: set[str] = set()
+    en_curso: dict[Future, Nodo] = {}
+
+    with ProcessPoolExecutor(max_workers=procesos, initializer=inicializar_proceso, initargs=(variables,)) as pool:
+        while pendientes or en_curso:
+            # Se descartan las etapas que dependen de una etapa fallida
+            for nodo in [n for n in pendientes if any(d.clave in fallidas for d in n.dependencias)]:
+                logging.error(f'Se omite la etapa {nodo.clave} porque falló una etapa previa')
+                fallidas.add(nodo.clave)
+                pendientes.remove(nodo)
+
+            memoria_en_uso = sum(n.memoria for n in en_curso.values())
+            for nodo in [n for n in pendientes if all(d.clave in resultados for d in n.dependencias)]:
+                if len(en_curso) >= procesos or (en_curso and memoria_en_uso + nodo.memoria > memoria):
+                    continue
+                logging.info(f'Iniciando etapa {nodo.clave}')
+                futuro = pool.submit(nodo.funcion, *nodo.args, *[resultados[e.clave] for e in nodo.entradas])
+                en_curso[futuro] = nodo
+                memoria_en_uso += nodo.memoria
+                pendientes.remove(nodo)
+
+            if not en_curso:
+                break
+            terminados, _ = wait(en_curso, return_when=FIRST_COMPLETED)
+            for futuro in terminados:
+                nodo = en_curso.pop(futuro)
+                try:
+                    resultados[nodo.clave] = futuro.result()
+                    logging.info(f'Etapa {nodo.clave} finalizada')
+                except Exception as e:
+                    logging.error(f'La etapa {nodo.clave} falló: {e}')
+                    fallidas.add(nodo.clave)
+
+    return resultados, fallidas
+
+
+if __name__ == '__main__':
+
+    # Catch and parse command-line arguments
+    args: argparse.Namespace = parse_args()
+
+    # Create script control
+    script = ScriptControl('operational--orchestrator')
+
+    # Start script execution
+    script.start_script()
+
+    # Como la fecha guía es miércoles, pero el modelo ECCC-GEPS8 se publica los jueves, por lo tanto,
+    # el script solo puede ejecutarse los viernes. A continuación se verifica que esto se cumpla:
+    if not is_date_dayofweek(args.fecha, Day.FRIDAY):
+        logging.error('El script se ejecutó un día diferente al viernes.')
+        script.end_script_execution()
+        raise SystemExit(0)
+
+    # Leer archivo de configuración
+    config = GlobalConfig.Instance().app_config
+
+    # Fecha 0 siempre es el miércoles guía.
+    miercoles = get_date_for_weekday(start_date=args.fecha, target_weekday=Day.WEDNESDAY)  # ---> miércoles previo
+
+    nodos = construir_grafo(args.modelos, args.variables, miercoles, args.redownload, args.plot_maps, args.chunks)
+    if args.plot_maps:
+        preparar_figuras()
+    _, fallidas = ejecutar_grafo(nodos, args.procesos or config.orquestador.procesos,
+                                 args.memoria or config.orquestador.memoria, args.variables)
+
+    # End script execution
+    script.end_script_execution()
+
+    if fallidas:
+        logging.error(f'Etapas fallidas: {", ".join(sorted(fallidas))}')
+        sys.exit(1)
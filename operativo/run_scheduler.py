@@ -0,0 +1,148 @@
+
+import os
+import sys
+import json
+import time
+import argparse
+import datetime as dt
+import requests
+import subprocess
+import threading
+import logging
+
+from calendar import Day
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from pathlib import Path
+
+from funciones_extra import gen_url_download, get_date_for_weekday, get_fecha_publicacion, parse_date, VALID_MODELS
+from funciones_extra import get_fechas_ensamble
+
+from setup.config import  GlobalConfig
+from controllers.downloads import DownloadManager
+from controllers.script import ScriptControl
+from errors.forecasts import FcstNotYetPublished
+
+
+def parse_args() -> argparse.Namespace:
+
+    parser = argparse.ArgumentParser(description='Calibrates each model as soon as its forecast is published.')
+
+    parser.add_argument('--modelos', type=str, choices=VALID_MODELS, nargs='+', default=VALID_MODELS,
+                        help='Models to be calibrated')
+    parser.add_argument('--variables', type=str, choices=['pr', 'tas'], nargs='+', default=['pr', 'tas'],
+                        help='Variables to be calibrated')
+    parser.add_argument('--fecha', type=parse_date, default=None,
+                        help='A date in the week to be calibrated (default: the current week)')
+    parser.add_argument('--once', action='store_true',
+                        help='Check once, wait for the launched calibrations and exit')
+
+    return parser.parse_args()
+
+
+class EstadoSemanal(object):
+    """
+    Calibraciones (modelo/variable) ya realizadas para cada miércoles guía. Se guarda en un archivo,
+    de modo que un reinicio del planificador no repite las calibraciones.
+    """
+
+    def __init__(self, archivo: str):
+        self.archivo = archivo
+        self.lock = threading.Lock()
+        self.estado: dict[str, list[str]] = {}
+        if os.path.isfile(archivo):
+            with open(archivo, 'r') as f:
+                self.estado = json.load(f)
+
+    def realizadas(self, semana: str) -> set[str]:
+        with self.lock:
+            return set(self.estado.get(semana, []))
+
+    def registrar(self, semana: str, modelo: str, variable: str):
+        with self.lock:
+            # Solo se conserva la última semana
+            self.estado = {semana: sorted(set(self.estado.get(semana, [])) | {f'{modelo}/{variable}'})}
+            with open(self.archivo + '.tmp', 'w') as f:
+                json.dump(self.estado, f, indent=2)
+            os.replace(self.archivo + '.tmp', self.archivo)
+
+
+def pronostico_publicado(modelo: str, variable: str, miercoles: dt.datetime) -> bool:
+    # Deben estar publicadas todas las inicializaciones que descarga run_operativo (p.e. los 5 días de CFSv2)
+    conj, nombre = modelo.split('-')
+    fecha_d = get_fecha_publicacion(modelo, miercoles)
+    try:
+        return all(DownloadManager.Instance().exists(gen_url_download(fecha, variable, 'forecast', conj, nombre))
+                   for fecha in get_fechas_ensamble(modelo, fecha_d))
+    except requests.RequestException as e:
+        logging.warning(f'No se pudo consultar la disponibilidad de {modelo} ({variable}): {e}')
+        return False
+
+
+def calibrar_modelo(modelo: str, variables: list[str], miercoles: dt.datetime, estado: EstadoSemanal):
+    # Las variables de un mismo modelo se calibran en serie (run_operativo no admite dos instancias por modelo)
+    viernes = miercoles + dt.timedelta(days=2)
+    for variable in variables:
+        logging.info(f'Iniciando calibración de {modelo} ({variable}) para el miércoles {miercoles:%Y-%m-%d}')
+        comando = [sys.executable, 'run_operativo.py', modelo, viernes.strftime('%Y-%m-%d'), variable]
+        resultado = subprocess.run(comando, cwd=Path(__file__).parent)
+        if resultado.returncode == 0:
+            estado.registrar(miercoles.strftime('%Y-%m-%d'), modelo, variable)
+        elif resultado.returncode == FcstNotYetPublished.exit_code:
+            # No se registra: la variable sigue pendiente y se vuelve a consultar en el próximo intervalo
+            logging.warning(f'El pronóstico {modelo} ({variable}) aún no está completo, se reintentará')
+        else:
+            logging.error(f'La calibración de {modelo} ({variable}) terminó con código {resultado.returncode}')
+
+
+if __name__ == '__main__':
+
+    # Catch and parse command-line arguments
+    args: argparse.Namespace = parse_args()
+
+    # Create script control
+    script = ScriptControl('scheduler')
+
+    # Start script execution
+    script.start_script()
+
+    # Leer archivo de configuración
+    config = GlobalConfig.Instance().app_config
+    carpeta_datos = os.fspath(Path(f'{config.carpeta_datos}/operativo/'))
+    os.makedirs(carpeta_datos, exist_ok=True)
+
+    estado = EstadoSemanal(f'{carpeta_datos}/planificador.json')
+    intentos: Counter = Counter()
+    en_curso: dict[str, Future] = {}
+
+    with ThreadPoolExecutor(max_workers=len(args.modelos)) as pool:
+        while True:
+            # Fecha 0 siempre es el miércoles guía; los productos de la semana se identifican con el viernes posterior
+            hoy = args.fecha or dt.datetime.combine(dt.date.today(), dt.time())
+            miercoles = get_date_for_weekday(start_date=hoy, target_weekday=Day.WEDNESDAY)
+            semana = miercoles.strftime('%Y-%m-%d')
+            realizadas = estado.realizadas(semana)
+
+            en_curso = {modelo: futuro for modelo, futuro in en_curso.items() if not futuro.done()}
+            pendientes = {modelo: [v for v in args.variables if f'{modelo}/{v}' not in realizadas]
+                          for modelo in args.modelos if modelo not in en_curso}
+            pendientes = {modelo: variables for modelo, variables in pendientes.items()
+                          if variables and intentos[(semana, modelo)] < config.planificador.max_intentos}
+
+            # Se consulta (HEAD) la disponibilidad de cada variable pendiente y se lanza la calibración de las
+            # variables ya publicadas; las demás se vuelven a consultar en el próximo intervalo
+            for modelo, variables in pendientes.items():
+                publicadas = [variable for variable in variables if pronostico_publicado(modelo, variable, miercoles)]
+                if publicadas:
+                    intentos[(semana, modelo)] += 1
+                    en_curso[modelo] = pool.submit(calibrar_modelo, modelo, publicadas, miercoles, estado)
+                for variable in [v for v in variables if v not in publicadas]:
+                    logging.info(f'El pronóstico {modelo} ({variable}) para el miércoles {semana} aún no fue publicado')
+
+            if args.once:
+                wait(en_curso.values())
+                break
+            time.sleep(60 * config.planificador.intervalo)
+
+    # Finalizar el script borrando PID
+    script.end_script_execution()
@@ -0,0 +1,27 @@
+
+import os
+import tempfile
+
+from contextlib import contextmanager
+
+
+@contextmanager
+def escritura_atomica(archivo: str):
+    """
+    Devuelve un archivo temporal único en la carpeta de archivo (con la misma extensión), que al salir del bloque
+    se renombra como archivo. Así no quedan archivos incompletos, y dos procesos que escriben el mismo archivo
+    (p.e. los pesos de interpolación, comunes a todos los modelos) no escriben en el mismo temporal.
+    Si el bloque falla, se elimina el temporal.
+    """
+    carpeta, nombre = os.path.split(archivo)
+    descriptor, temporal = tempfile.mkstemp(dir=carpeta or '.', prefix=nombre + '.', suffix=os.path.splitext(nombre)[1])
+    os.close(descriptor)
+    # mkstemp crea el archivo solo con permisos para el usuario
+    os.chmod(temporal, 0o644)
+    try:
+        yield temporal
+        os.replace(temporal, archivo)
+    except BaseException:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+        raise
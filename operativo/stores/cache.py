@@ -0,0 +1,143 @@
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+import datetime as dt
+import xarray as xr
+
+from pathlib import Path
+
+from setup.config import GlobalConfig
+
+
+# Se incrementa si cambia el formato de las entradas de la caché
+VERSION_CACHE = 1
+
+
+class RunCache(object):
+    """
+    Caché de calibraciones indexada por el contenido de sus entradas: la clave es un hash de las huellas de los
+    archivos de entrada (el sha256 de la descarga, si existe su .meta.json, o el tamaño y la fecha de modificación)
+    y de los parámetros de la ejecución. Una ejecución con las mismas entradas reutiliza las probabilidades y, si
+    siguen existiendo, las figuras. Cuando la caché supera max_bytes se eliminan las entradas usadas hace más tiempo.
+    """
+
+    def __init__(self, carpeta: str | None = None, max_bytes: int | None = None):
+        config = GlobalConfig.Instance().app_config
+        self.carpeta: str = carpeta or os.fspath(Path(config.carpeta_datos) / 'cache' / 'calibraciones')
+        self.max_bytes: int = max_bytes if max_bytes is not None else int(config.cache.max_gb * 1024 ** 3)
+
+    @staticmethod
+    def huella(archivo: str, contenido: bool = False) -> dict | None:
+        if not os.path.isfile(archivo):
+            return None
+        # Las descargas guardan el sha256 del archivo en su .meta.json (ver DownloadManager.write_meta)
+        meta_file = archivo + '.meta.json'
+        if os.path.isfile(meta_file):
+            with open(meta_file, 'r') as f:
+                return {'sha256': json.load(f)['sha256']}
+        if contenido:
+            with open(archivo, 'rb') as f:
+                return {'sha256': hashlib.sha256(f.read()).hexdigest()}
+        estado = os.stat(archivo)
+        return {'size': estado.st_size, 'mtime_ns': estado.st_mtime_ns}
+
+    def clave(self, entradas: dict[str, list[str]], parametros: dict, contenido: tuple[str, ...] = ('codigo',)) -> str:
+        """
+        Clave de una ejecución: entradas son los archivos de entrada por grupo (en los grupos de contenido, p.e. el
+        código, se usa el sha256 del archivo) y parametros los valores de configuración que afectan al resultado.
+        """
+        huellas = {grupo: {archivo: self.huella(archivo, grupo in contenido) for archivo in archivos}
+                   for grupo, archivos in entradas.items()}
+        texto = json.dumps({'version': VERSION_CACHE, 'entradas': huellas, 'parametros': parametros},
+                           sort_keys=True, default=str)
+        return hashlib.sha256(texto.encode()).hexdigest()
+
+    def _carpeta_entrada(self, clave: str) -> str:
+        return os.path.join(self.carpeta, clave)
+
+    def _leer_meta(self, clave: str) -> dict | None:
+        meta_file = os.path.join(self._carpeta_entrada(clave), 'meta.json')
+        if not os.path.isfile(meta_file):
+            return None
+        with open(meta_file, 'r') as f:
+            return json.load(f)
+
+    def _escribir_meta(self, clave: str, meta: dict, carpeta: str | None = None):
+        meta_file = os.path.join(carpeta or self._carpeta_entrada(clave), 'meta.json')
+        with open(meta_file + '.tmp', 'w') as f:
+            json.dump(meta, f, indent=2)
+        os.replace(meta_file + '.tmp', meta_file)
+
+    def get(self, clave: str) -> tuple[dt.datetime, list, dict[str, xr.DataArray]] | None:
+        """
+        Fecha de inicialización, fechas de inicio de las semanas y probabilidades de cada categoría guardadas con
+        la clave (los campos de Calibracion), o None si no están en la caché.
+        """
+        meta = self._leer_meta(clave)
+        if meta is None:
+            return None
+        carpeta = self._carpeta_entrada(clave)
+        probabilidades = {}
+        for i, categoria in enumerate(meta['categorias']):
+            with xr.open_dataarray(os.path.join(carpeta, f'probabilidad_{i}.nc')) as prob:
+                probabilidades[categoria] = prob.load().drop_encoding()
+        # La fecha de modificación de la carpeta indica el último uso (ver evict)
+        os.utime(carpeta)
+        return dt.datetime.fromisoformat(meta['fecha_d']), [dt.date.fromisoformat(f) for f in meta['fechas_v']], \
+            probabilidades
+
+    def put(self, clave: str, fecha_d: dt.datetime, fechas_v: list, probabilidades: dict[str, xr.DataArray]):
+        # Se escribe en una carpeta temporal y se renombra, para no dejar entradas incompletas
+        carpeta = self._carpeta_entrada(clave)
+        temporal = carpeta + '.tmp'
+        shutil.rmtree(temporal, ignore_errors=True)
+        os.makedirs(temporal)
+        for i, prob in enumerate(probabilidades.values()):
+            prob.to_netcdf(os.path.join(temporal, f'probabilidad_{i}.nc'))
+        self._escribir_meta(clave, {'fecha_d': fecha_d.isoformat(), 'fechas_v': [f.isoformat() for f in fechas_v],
+                                    'categorias': list(probabilidades), 'figuras': None}, temporal)
+        shutil.rmtree(carpeta, ignore_errors=True)
+        os.replace(temporal, carpeta)
+        self.evict()
+
+    def get_figuras(self, clave: str) -> list[str] | None:
+        """
+        Figuras generadas con la clave, si todas siguen existiendo.
+        """
+        meta = self._leer_meta(clave)
+        if meta is None or meta['figuras'] is None or not all(os.path.isfile(f) for f in meta['figuras']):
+            return None
+        return meta['figuras']
+
+    def put_figuras(self, clave: str, figuras: list[str]):
+        meta = self._leer_meta(clave)
+        if meta is not None:
+            self._escribir_meta(clave, {**meta, 'figuras': figuras})
+
+    def _tamanio(self, carpeta: str) -> int:
+        return sum(f.stat().st_size for f in Path(carpeta).iterdir() if f.is_file())
+
+    def evict(self) -> list[str]:
+        """
+        Elimina las entradas usadas hace más tiempo hasta que la caché ocupe a lo sumo max_bytes.
+        """
+        if not os.path.isdir(self.carpeta):
+            return []
+        entradas = [e for e in Path(self.carpeta).iterdir() if e.is_dir() and not e.name.endswith('.tmp')]
+        entradas.sort(key=lambda e: e.stat().st_mtime)
+        tamanios = [self._tamanio(e) for e in entradas]
+        total = sum(tamanios)
+
+        eliminadas = []
+        for entrada, tamanio in zip(entradas, tamanios):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entrada, ignore_errors=True)
+            total -= tamanio
+            eliminadas.append(entrada.name)
+        if eliminadas:
+            logging.info(f'######## Caché de calibraciones: {len(eliminadas)} entradas eliminadas')
+        return eliminadas
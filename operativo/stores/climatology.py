@@ -0,0 +1,63 @@
+
+import os
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from functools import lru_cache
+
+from calendario import CalendarioSemanas
+
+
+# El año de la climatología diaria se extiende con enero y febrero (hasta el 28 de febrero),
+# para poder seleccionar ventanas que cruzan el fin de año.
+INICIO_EXTENSION, FIN_EXTENSION = '1960-01-01', '1960-02-28'
+INICIO_EXTENSION_NUEVA, FIN_EXTENSION_NUEVA = '1961-01-01', '1961-02-28'
+
+
+@lru_cache(maxsize=4)
+def _open_climatology(archivo: str, mtime: float) -> xr.Dataset:
+    # El mtime forma parte de la clave, así un archivo modificado no se lee desde la caché
+    return xr.open_dataset(archivo, engine='netcdf4', decode_timedelta=True)
+
+
+def open_climatology(archivo: str) -> xr.Dataset:
+    """
+    Abre (sin cargar) la climatología diaria. El archivo abierto se reutiliza en las siguientes llamadas del proceso.
+    """
+    return _open_climatology(archivo, os.path.getmtime(archivo))
+
+
+def get_climatology_window(archivo: str, variable: str, f1, f2) -> xr.DataArray:
+    """
+    Devuelve los días [f1, f2] de la climatología diaria. Las ventanas que cruzan el fin de año continúan
+    en enero/febrero de 1961: los índices se calculan sobre las fechas y solo se leen los días necesarios,
+    sin concatenar una copia de la climatología.
+    """
+    media0 = open_climatology(archivo)
+    fechas = media0.S.values
+
+    # Fechas del año extendido, y fila de la climatología que corresponde a cada una
+    filas_extension = np.flatnonzero((fechas >= np.datetime64(INICIO_EXTENSION)) & (fechas <= np.datetime64(FIN_EXTENSION)))
+    fechas_extension = pd.date_range(start=INICIO_EXTENSION_NUEVA, end=FIN_EXTENSION_NUEVA, freq='D').values
+    filas = np.concatenate([np.arange(len(fechas)), filas_extension])
+    fechas = np.concatenate([fechas, fechas_extension.astype(fechas.dtype)])
+
+    seleccion = (fechas >= np.datetime64(f1)) & (fechas <= np.datetime64(f2))
+    media = media0[variable].isel(S=filas[seleccion])
+    media = media.assign_coords(S=('S', fechas[seleccion], media0.S.attrs))
+    if ({'longitude', 'latitude'}).issubset(media.dims):
+        media = media.rename({'longitude': 'X','latitude': 'Y'})
+    if ({'lon', 'lat'}).issubset(media.dims):
+        media = media.rename({'lon': 'X','lat': 'Y'})
+
+    return media
+
+
+def get_climatology_weekly(archivo: str, variable: str, f1, f2, miercoles, agregacion: str = 'mean') -> xr.DataArray:
+    """
+    Devuelve la climatología de los días [f1, f2] agregada en las semanas 1, 2, 3y4 y 5 (agregacion: 'mean' o 'sum').
+    """
+    media = get_climatology_window(archivo, variable, f1, f2)
+    calendario = CalendarioSemanas.from_data(media, miercoles, hcast=1)
+    return calendario.aggregate(media, agregacion).squeeze()
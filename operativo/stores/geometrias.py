@@ -0,0 +1,103 @@
+
+import os
+import json
+import logging
+import numpy as np
+import shapely
+
+from functools import lru_cache
+from pathlib import Path
+
+from stores.archivos import escritura_atomica
+
+
+# Extensión de los mapas (ver PlantillaMapa y mapa_chequeo) y margen (grados) con el que se recortan las geometrías
+EXTENSION_MAPA = {'lat': [-57, -8], 'lon': [-82, -33]}
+MARGEN = 2.
+
+# Tolerancia (grados) de la simplificación: bastante menor al tamaño de un pixel de las figuras (~0.05°)
+TOLERANCIA = 0.01
+
+# Capas del mapa base: categoría, nombre y resolución en Natural Earth. Los límites de países se usan en la
+# resolución que cartopy elige para cpf.BORDERS con la extensión de los mapas.
+CAPAS = {
+    'costas': ('physical', 'coastline', '10m'),
+    'paises': ('cultural', 'admin_0_boundary_lines_land', '50m'),
+    'provincias': ('cultural', 'admin_1_states_provinces_lines', '10m'),
+}
+PAISES_PROVINCIAS = ['Argentina', 'Bolivia', 'Brazil', 'Chile', 'Paraguay', 'Peru', 'Uruguay']
+
+
+def get_geometrias_path() -> str:
+    return os.fspath(Path(__file__).parent.parent / 'setup' / 'geometrias_mapa.json')
+
+
+def get_recorte() -> shapely.Polygon:
+    return shapely.box(EXTENSION_MAPA['lon'][0] - MARGEN, EXTENSION_MAPA['lat'][0] - MARGEN,
+                       EXTENSION_MAPA['lon'][1] + MARGEN, EXTENSION_MAPA['lat'][1] + MARGEN)
+
+
+def recortar_geometrias(geometrias: list, recorte: shapely.Geometry, tolerancia: float = TOLERANCIA) -> np.ndarray:
+    """
+    Recorta las geometrías a la extensión de los mapas y las simplifica. Se descartan las que quedan vacías.
+    """
+    recortadas = shapely.simplify(shapely.intersection(np.asarray(geometrias, dtype=object), recorte), tolerancia,
+                                  preserve_topology=True)
+    return recortadas[~shapely.is_empty(recortadas)]
+
+
+def guardar_geometrias(capas: dict[str, np.ndarray], archivo: str):
+    datos = {'extension': EXTENSION_MAPA, 'margen': MARGEN, 'tolerancia': TOLERANCIA,
+             'capas': {capa: shapely.to_wkb(geometrias, hex=True).tolist() for capa, geometrias in capas.items()}}
+    with escritura_atomica(archivo) as temporal, open(temporal, 'w') as f:
+        json.dump(datos, f)
+
+
+def build_geometrias_mapa(archivo: str | None = None) -> str:
+    """
+    Extrae de Natural Earth (se descarga si cartopy no la tiene) las costas, los límites de países y los de
+    provincias de PAISES_PROVINCIAS, recortados a la extensión de los mapas y simplificados, y los guarda como
+    WKB (hex) en un JSON que se incluye en la imagen, para armar los mapas sin leer shapefiles ni acceder a la red.
+    """
+    from cartopy.io import shapereader
+
+    archivo = archivo or get_geometrias_path()
+    recorte = get_recorte()
+
+    capas = {}
+    for capa, (categoria, nombre, resolucion) in CAPAS.items():
+        shp_name = shapereader.natural_earth(resolution=resolucion, category=categoria, name=nombre)
+        geometrias = [registro.geometry for registro in shapereader.Reader(shp_name).records()
+                      if capa != 'provincias' or registro.attributes['ADM0_NAME'] in PAISES_PROVINCIAS]
+        capas[capa] = recortar_geometrias(geometrias, recorte)
+        logging.info(f'Capa {capa}: {len(capas[capa])} geometrías')
+
+    guardar_geometrias(capas, archivo)
+    return archivo
+
+
+@lru_cache(maxsize=2)
+def _leer_geometrias(archivo: str, mtime: float) -> dict:
+    # El mtime forma parte de la clave, así un archivo regenerado no se lee desde la caché
+    with open(archivo, 'r') as f:
+        datos = json.load(f)
+    datos['capas'] = {capa: list(shapely.from_wkb(geometrias)) for capa, geometrias in datos['capas'].items()}
+    return datos
+
+
+def get_geometrias_mapa() -> dict[str, list[shapely.Geometry]]:
+    """
+    Geometrías del mapa base por capa (ver CAPAS). Las geometrías se leen una sola vez por proceso.
+    El archivo se genera al construir la imagen (build_stores.py geometrias); fuera de la imagen, si no existe, se
+    genera acá (con acceso a la red, si cartopy no tiene Natural Earth). Si fue generado con otra extensión, margen
+    o tolerancia, es un error: se regenera con build_stores.py geometrias.
+    """
+    archivo = get_geometrias_path()
+    if not os.path.isfile(archivo):
+        logging.warning(f'No existen las geometrías del mapa base ({archivo}): se generan')
+        build_geometrias_mapa(archivo)
+    datos = _leer_geometrias(archivo, os.path.getmtime(archivo))
+    if (datos['extension'], datos['margen'], datos['tolerancia']) != (EXTENSION_MAPA, MARGEN, TOLERANCIA):
+        raise ValueError(f'Las geometrías del mapa base ({archivo}) fueron generadas con otra extensión, margen o '
+                         f'tolerancia. Se regeneran con: python extras/build_stores.py geometrias')
+    return datos['capas']
@@ -0,0 +1,74 @@
+
+import os
+import logging
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from pathlib import Path
+
+from stores.archivos import escritura_atomica
+
+
+def change_year(fechas, year: int = 1960) -> np.ndarray:
+    """
+    Cambia el año de un arreglo de fechas, conservando mes, día y hora (versión vectorizada).
+    """
+    fechas = pd.DatetimeIndex(fechas)
+    nuevas = pd.to_datetime(pd.DataFrame({'year': year, 'month': fechas.month, 'day': fechas.day}))
+    return (pd.DatetimeIndex(nuevas) + (fechas - fechas.normalize())).values
+
+
+def get_hindcast_store_path(archivo: str) -> str:
+    return os.fspath(Path(archivo).with_suffix('')) + '_mmdd.nc'
+
+
+def build_hindcast_store(archivo: str) -> str:
+    """
+    Reescribe el hindcast con las fechas de inicio indexadas por mes y día (coordenada mmdd = mes * 100 + día),
+    conservando las fechas de inicio en el año 1960 como coordenada S. Cada fecha de inicio se guarda en
+    un chunk propio, para poder leerla sin tocar el resto del archivo.
+    """
+    with xr.open_dataset(archivo, decode_timedelta=True) as hcst:
+        fechas = pd.DatetimeIndex(hcst.S.values)
+        mmdd = fechas.month * 100 + fechas.day
+        if mmdd.duplicated().any():
+            raise ValueError(f'El hindcast {archivo} tiene más de una fecha de inicio para el mismo mes y día')
+        if (fechas.year != 1960).any():
+            logging.warning('######## fechas distintas a 1960')
+
+        hcst = hcst.assign_coords(S=('S', change_year(fechas)), mmdd=('S', np.asarray(mmdd, dtype='int32')))
+        hcst = hcst.swap_dims({'S': 'mmdd'})
+
+        encoding = {}
+        for nombre, da in hcst.data_vars.items():
+            encoding[nombre] = {k: v for k, v in da.encoding.items()
+                                if k in ['dtype', '_FillValue', 'scale_factor', 'add_offset']}
+            da.encoding = {}
+            if 'mmdd' in da.dims:
+                encoding[nombre].update(zlib=True, complevel=4, shuffle=True,
+                                        chunksizes=tuple(1 if d == 'mmdd' else da.sizes[d] for d in da.dims))
+
+        # Se escribe en un archivo temporal y se renombra, para no dejar archivos incompletos
+        archivo_store = get_hindcast_store_path(archivo)
+        with escritura_atomica(archivo_store) as temporal:
+            hcst.to_netcdf(temporal, encoding=encoding)
+    logging.info(f'######## Hindcast indexado por fecha de inicio guardado en: {archivo_store}')
+
+    return archivo_store
+
+
+def open_hindcast_start(archivo: str, mes: int, dia: int, chunks: dict | None = None) -> xr.Dataset:
+    """
+    Lee del hindcast solo la fecha de inicio correspondiente a mes/día. La coordenada S conserva la fecha
+    de inicio en el año 1960. El archivo indexado se construye si no existe o si el hindcast es más reciente.
+    Con chunks, la lectura es diferida (dask) y el archivo queda abierto.
+    """
+    archivo_store = get_hindcast_store_path(archivo)
+    if not os.path.isfile(archivo_store) or os.path.getmtime(archivo) > os.path.getmtime(archivo_store):
+        build_hindcast_store(archivo)
+    if chunks is not None:
+        hcst = xr.open_dataset(archivo_store, decode_timedelta=True, chunks=chunks)
+        return hcst.sel(mmdd=int(mes) * 100 + int(dia)).drop_vars('mmdd')
+    with xr.open_dataset(archivo_store, decode_timedelta=True) as hcst:
+        return hcst.sel(mmdd=int(mes) * 100 + int(dia)).drop_vars('mmdd').load()
@@ -0,0 +1,260 @@
+
+import os
+import re
+import glob
+import logging
+import datetime as dt
+import netCDF4
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from pathlib import Path
+from functools import partial
+from typing import Callable
+
+from setup.config import GlobalConfig
+from stores.archivos import escritura_atomica
+from stores.productos import CATEGORIAS_PRODUCTO, ESCALA, FALTANTE, NOMBRE_VARIABLE, build_producto, get_encoding
+from stores.productos import abrir_producto, separar_categorias
+
+
+# Las fechas se guardan en horas desde 1970. Los chunks abarcan un año de inicializaciones semanales y bloques de
+# 16 x 16 puntos de grilla: la historia de un punto (o de una región chica) se lee de pocos chunks por categoría.
+DIM_INICIO = 'inicio'
+UNIDADES_FECHAS = 'hours since 1970-01-01 00:00:00'
+CHUNK_INICIO = 52
+CHUNK_GRILLA = 16
+
+# Nombres de los archivos de prob/ (ver stores/productos.py)
+PATRON_PRODUCTO = re.compile(r'^(?P<variable>[a-z]+)_(?P<modelo>.+)_(?P<fecha>\d{12})_probabilities\.nc$')
+PATRON_LEGADO = re.compile(r'^(?P<variable>[a-z]+)_(?:under|over)pctil\d{2}_(?P<modelo>.+)_(?P<fecha>\d{12})_probability\.nc$')
+
+
+def get_historico_path(variable: str, modelo: str) -> str:
+    carpeta = os.fspath(Path(GlobalConfig.Instance().app_config.carpeta_datos))
+    return carpeta + '/historico/' + variable + '_' + modelo + '_historico.nc'
+
+
+def get_journal_path(archivo: str) -> str:
+    return archivo + '.journal.npz'
+
+
+def _get_encoding_historico(historico: xr.DataArray) -> dict:
+    encoding = get_encoding(historico)
+    encoding[NOMBRE_VARIABLE]['chunksizes'] = (CHUNK_INICIO, 1, historico.sizes['semanas'],
+                                               min(CHUNK_GRILLA, historico.sizes['Y']), min(CHUNK_GRILLA, historico.sizes['X']))
+    for fechas in [DIM_INICIO, 'miercoles', 'S']:
+        encoding[fechas] = {'units': UNIDADES_FECHAS, 'calendar': 'standard', 'dtype': 'float64'}
+    return encoding
+
+
+def _crear_historico(archivo: str, producto: xr.DataArray, fecha_d: dt.datetime, miercoles: dt.datetime):
+    # El primer pronóstico define la grilla, las semanas y las categorías del histórico
+    historico = producto.expand_dims({DIM_INICIO: [pd.Timestamp(fecha_d)]}) \
+        .assign_coords(miercoles=(DIM_INICIO, [pd.Timestamp(miercoles)]))
+    historico['S'] = historico['S'].expand_dims({DIM_INICIO: 1})
+
+    os.makedirs(os.path.dirname(archivo), exist_ok=True)
+    with escritura_atomica(archivo) as temporal:
+        historico.to_dataset().to_netcdf(temporal, encoding=_get_encoding_historico(historico),
+                                         unlimited_dims=[DIM_INICIO])
+
+
+def _verificar_grilla(nc: netCDF4.Dataset, producto: xr.DataArray):
+    for dim in ['semanas', 'Y', 'X']:
+        if nc[dim].shape != producto[dim].shape or not np.allclose(nc[dim][:], producto[dim].values):
+            raise ValueError(f'La coordenada {dim} del pronóstico no coincide con la del histórico')
+    if list(nc['categoria'][:]) != list(producto['categoria'].values):
+        raise ValueError('Las categorías del pronóstico no coinciden con las del histórico')
+
+
+def _guardar_journal(nc: netCDF4.Dataset, archivo: str, posiciones: list[int]):
+    # Antes de modificar el histórico se guarda la cantidad de pronósticos y una copia de los que se van a reemplazar
+    longitud = len(nc.dimensions[DIM_INICIO])
+    existentes = sorted({i for i in posiciones if i < longitud})
+    journal = {'longitud': longitud, 'posiciones': np.array(existentes, dtype=int)}
+    for variable in [NOMBRE_VARIABLE, DIM_INICIO, 'miercoles', 'S']:
+        journal[variable] = np.array([nc[variable][i] for i in existentes])
+    with escritura_atomica(get_journal_path(archivo)) as temporal:
+        np.savez(temporal, **journal)
+
+
+def _recuperar_historico(archivo: str):
+    """
+    Deshace una modificación del histórico que no terminó (ver agregar_pronosticos): se restauran los pronósticos
+    reemplazados y se descartan los agregados. Solo se reescribe el archivo si había pronósticos agregados.
+    """
+    journal_path = get_journal_path(archivo)
+    if not os.path.isfile(journal_path):
+        return
+    logging.warning(f'El histórico {archivo} no se terminó de modificar: se restaura su estado anterior')
+    with np.load(journal_path) as journal:
+        longitud = int(journal['longitud'])
+        with netCDF4.Dataset(archivo, 'a') as nc:
+            nc.set_auto_maskandscale(False)
+            for j, i in enumerate(journal['posiciones']):
+                for variable in [NOMBRE_VARIABLE, DIM_INICIO, 'miercoles', 'S']:
+                    nc[variable][i] = journal[variable][j]
+            sobrantes = len(nc.dimensions[DIM_INICIO]) > longitud
+
+    if sobrantes:
+        # Una dimensión ilimitada no se puede acortar: se reescribe el archivo con los pronósticos anteriores
+        with xr.open_dataset(archivo) as ds:
+            historico = ds[NOMBRE_VARIABLE].isel({DIM_INICIO: slice(0, longitud)}).load()
+        with escritura_atomica(archivo) as temporal:
+            historico.to_dataset().to_netcdf(temporal, encoding=_get_encoding_historico(historico),
+                                             unlimited_dims=[DIM_INICIO])
+    os.remove(journal_path)
+
+
+def _escribir_pronostico(nc: netCDF4.Dataset, i: int, producto: xr.DataArray, fecha_d: dt.datetime,
+                         miercoles: dt.datetime):
+    # Se escriben los valores ya escalados, redondeados como en el archivo único
+    valores = producto.transpose('categoria', 'semanas', 'Y', 'X').values
+    nc[NOMBRE_VARIABLE][i] = np.where(np.isnan(valores), FALTANTE, np.round(valores / ESCALA)).astype('int16')
+    nc[DIM_INICIO][i] = netCDF4.date2num(fecha_d, UNIDADES_FECHAS, calendar='standard')
+    nc['miercoles'][i] = netCDF4.date2num(miercoles, UNIDADES_FECHAS, calendar='standard')
+    nc['S'][i] = netCDF4.date2num(pd.DatetimeIndex(producto['S'].values).to_pydatetime(), UNIDADES_FECHAS,
+                                  calendar='standard')
+
+
+def agregar_pronosticos(variable: str, modelo: str,
+                        pronosticos: list[tuple[dt.datetime, dt.datetime, Callable[[], dict[str, xr.DataArray]]]]) -> str:
+    """
+    Agrega pronósticos al histórico del modelo/variable, a lo largo de la dimensión inicio, con una sola apertura
+    del archivo. Cada pronóstico es (fecha de inicialización, miércoles, función que devuelve las probabilidades):
+    las probabilidades se leen de a una. Los pronósticos que ya están en el histórico (p.e. una recalibración)
+    se reemplazan.
+    El archivo se modifica en el lugar, sin copiarlo: antes se guarda un journal con la cantidad de pronósticos y
+    una copia de los que se reemplazan. Si la modificación falla o se interrumpe, el histórico vuelve a su estado
+    anterior (en el momento, o al agregar el próximo pronóstico).
+    """
+    archivo = get_historico_path(variable, modelo)
+    if not pronosticos:
+        return archivo
+    if not os.path.isfile(archivo):
+        fecha_d, miercoles, leer = pronosticos[0]
+        _crear_historico(archivo, build_producto(leer()), fecha_d, miercoles)
+        pronosticos = pronosticos[1:]
+        if not pronosticos:
+            return archivo
+
+    _recuperar_historico(archivo)
+    try:
+        with netCDF4.Dataset(archivo, 'a') as nc:
+            nc.set_auto_maskandscale(False)
+            inicios = list(nc[DIM_INICIO][:])
+            posiciones = []
+            for fecha_d, _, _ in pronosticos:
+                fecha = netCDF4.date2num(fecha_d, UNIDADES_FECHAS, calendar='standard')
+                coincidencias = np.flatnonzero(np.isclose(inicios, fecha))
+                if len(coincidencias) == 0:
+                    inicios.append(fecha)
+                posiciones.append(int(coincidencias[0]) if len(coincidencias) else len(inicios) - 1)
+
+            _guardar_journal(nc, archivo, posiciones)
+            for i, (fecha_d, miercoles, leer) in zip(posiciones, pronosticos):
+                producto = build_producto(leer())
+                _verificar_grilla(nc, producto)
+                _escribir_pronostico(nc, i, producto, fecha_d, miercoles)
+    except BaseException:
+        _recuperar_historico(archivo)
+        raise
+    os.remove(get_journal_path(archivo))
+
+    return archivo
+
+
+def agregar_al_historico(variable: str, modelo: str, probabilidades: dict[str, xr.DataArray], fecha_d: dt.datetime,
+                         miercoles: dt.datetime) -> str:
+    """
+    Agrega las probabilidades de un pronóstico al histórico del modelo/variable (ver agregar_pronosticos).
+    """
+    return agregar_pronosticos(variable, modelo, [(fecha_d, miercoles, lambda: probabilidades)])
+
+
+def abrir_historico(variable: str, modelo: str) -> xr.Dataset:
+    """
+    Histórico de un modelo/variable, sin cargar en memoria (ordenado por fecha de inicialización al consultarlo).
+    """
+    archivo = get_historico_path(variable, modelo)
+    if not os.path.isfile(archivo):
+        raise FileNotFoundError(f'No existe el histórico de {modelo} ({variable}): {archivo}')
+    return xr.open_dataset(archivo)
+
+
+def seleccionar_inicios(historico: xr.Dataset, desde: dt.datetime | None = None,
+                        hasta: dt.datetime | None = None) -> np.ndarray:
+    # Posiciones de los pronósticos entre desde y hasta, ordenadas por fecha (los pronósticos se agregan en el
+    # orden en que se calibran)
+    inicios = historico[DIM_INICIO].values
+    elegidos = np.ones(len(inicios), dtype=bool)
+    if desde is not None:
+        elegidos &= inicios >= np.datetime64(desde, 'ns')
+    if hasta is not None:
+        elegidos &= inicios <= np.datetime64(hasta, 'ns')
+    posiciones = np.flatnonzero(elegidos)
+    return posiciones[np.argsort(inicios[posiciones], kind='stable')]
+
+
+def _leer_prob(archivo: str) -> xr.DataArray:
+    with xr.open_dataset(archivo) as ds:
+        return ds[next(iter(ds.data_vars))].load()
+
+
+def _leer_producto(archivo: str) -> dict[str, xr.DataArray]:
+    return separar_categorias(abrir_producto(archivo))
+
+
+def _leer_legado(archivos: dict[str, str]) -> dict[str, xr.DataArray]:
+    return {c: _leer_prob(archivos[c]) for c in CATEGORIAS_PRODUCTO}
+
+
+def buscar_pronosticos(variable: str) -> dict[tuple[str, str], dict]:
+    """
+    Pronósticos guardados en prob/ para una variable, por modelo y fecha de inicialización: el miércoles, el archivo
+    único (producto) y los archivos por categoría (legado). Al importarlos se prefiere el archivo único.
+    """
+    carpeta = os.fspath(Path(GlobalConfig.Instance().app_config.carpeta_datos))
+    pronosticos = {}
+    for archivo in sorted(glob.glob(f'{carpeta}/operativo/prob/{variable}/*/**/*.nc', recursive=True)):
+        ruta = Path(archivo)
+        producto, legado = PATRON_PRODUCTO.match(ruta.name), PATRON_LEGADO.match(ruta.name)
+        coincidencia = producto or legado
+        if coincidencia is None or coincidencia['variable'] != variable:
+            continue
+        carpeta_mie = ruta.parent if producto else ruta.parent.parent
+        pronostico = pronosticos.setdefault((coincidencia['modelo'], coincidencia['fecha']), {
+            'miercoles': dt.datetime.strptime(carpeta_mie.name, '%Y%m%d%H%M'), 'producto': None, 'legado': {}})
+        if producto:
+            pronostico['producto'] = archivo
+        else:
+            pronostico['legado'][ruta.parent.name] = archivo
+    return pronosticos
+
+
+def importar_prob(variable: str, modelos: list[str] | None = None) -> int:
+    """
+    Agrega al histórico los pronósticos ya guardados en prob/ (ver buscar_pronosticos), en orden de fecha y con
+    una sola escritura del histórico de cada modelo (ver agregar_pronosticos). Los pronósticos por categoría deben
+    tener todas las categorías. Devuelve la cantidad de pronósticos agregados.
+    """
+    por_modelo = {}
+    for (modelo, fecha), pronostico in sorted(buscar_pronosticos(variable).items(), key=lambda p: p[0][1]):
+        if modelos is not None and modelo not in modelos:
+            continue
+        if pronostico['producto'] is not None:
+            leer = partial(_leer_producto, pronostico['producto'])
+        else:
+            faltantes = [c for c in CATEGORIAS_PRODUCTO if c not in pronostico['legado']]
+            if faltantes:
+                logging.warning(f'Pronóstico {modelo} {fecha} sin las categorías {faltantes}, no se agrega')
+                continue
+            leer = partial(_leer_legado, pronostico['legado'])
+        por_modelo.setdefault(modelo, []).append((dt.datetime.strptime(fecha, '%Y%m%d%H%M'), pronostico['miercoles'], leer))
+
+    for modelo, pronosticos in por_modelo.items():
+        agregar_pronosticos(variable, modelo, pronosticos)
+        logging.info(f'######## Histórico: agregados {len(pronosticos)} pronósticos de {modelo} {variable}')
+    return sum(len(pronosticos) for pronosticos in por_modelo.values())
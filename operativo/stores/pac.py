@@ -0,0 +1,92 @@
+
+import os
+import logging
+import xarray as xr
+
+from functools import lru_cache
+from pathlib import Path
+
+from setup.config import GlobalConfig
+from stores.archivos import escritura_atomica
+
+
+# Categorías y semanas para las que existen coeficientes PAC
+CATEGORIAS_PAC = ['20', '50-', '50+', '80']
+SEMANAS_PAC = [1, 2, 3]
+
+
+def get_pac_folder(variable: str, modelo: str) -> str:
+    carpeta = os.fspath(Path(GlobalConfig.Instance().app_config.carpeta_datos))
+    return carpeta + '/PAC/' + variable + '/' + modelo + '/'
+
+
+def get_pac_store_path(variable: str, modelo: str) -> str:
+    return get_pac_folder(variable, modelo) + variable + '_corr_factor.nc'
+
+
+def get_pac_source_files(variable: str, modelo: str, week: int, categoria: str) -> tuple[str, str, str]:
+    c_PAC = get_pac_folder(variable, modelo)
+    f1 = c_PAC + variable + '_PAC_semana' + str(week) + '_pctil' + categoria + '.nc'
+    f2 = c_PAC + variable + '_stdo_semana' + str(week) + '_pctil' + categoria + '.nc'
+    f3 = c_PAC + variable + '_stdp_semana' + str(week) + '_pctil' + categoria + '.nc'
+    return f1, f2, f3
+
+
+def build_pac_store(variable: str, modelo: str) -> str:
+    """
+    Reúne en un único archivo los factores de corrección PAC * (std_o / std_p) de todas las
+    semanas y categorías de un modelo/variable. Se guarda con chunks de un mapa por semana y categoría.
+    """
+    list_cat = []
+    for categoria in CATEGORIAS_PAC:
+        list_week = []
+        for week in SEMANAS_PAC:
+            f1, f2, f3 = get_pac_source_files(variable, modelo, week, categoria)
+            PAC = xr.open_dataset(f1, engine='netcdf4', decode_timedelta=True)['PAC']
+            std_o = xr.open_dataset(f2, engine='netcdf4', decode_timedelta=True)['std_o']
+            std_p = xr.open_dataset(f3, engine='netcdf4', decode_timedelta=True)['std_p']
+            with xr.set_options(keep_attrs=True):
+                corr_factor = PAC * (std_o / std_p)
+            list_week.append(corr_factor.load())
+        list_cat.append(xr.concat(list_week, dim=xr.DataArray(SEMANAS_PAC, dims='semanas', name='semanas')))
+    corr_factor = xr.concat(list_cat, dim=xr.DataArray(CATEGORIAS_PAC, dims='categoria', name='categoria'))
+    corr_factor = corr_factor.rename('corr_factor').transpose('categoria', 'semanas', ...)
+
+    # Se escribe en un archivo temporal y se renombra, para no dejar archivos incompletos
+    archivo = get_pac_store_path(variable, modelo)
+    encoding = {'corr_factor': {'zlib': True, 'complevel': 4, 'shuffle': True,
+                                'chunksizes': (1, 1) + corr_factor.shape[2:]}}
+    with escritura_atomica(archivo) as temporal:
+        corr_factor.to_netcdf(temporal, encoding=encoding)
+    logging.info(f'######## Factores de corrección PAC guardados en: {archivo}')
+
+    return archivo
+
+
+def pac_store_is_outdated(variable: str, modelo: str) -> bool:
+    archivo = get_pac_store_path(variable, modelo)
+    if not os.path.isfile(archivo):
+        return True
+    mtime = os.path.getmtime(archivo)
+    fuentes = [f for categoria in CATEGORIAS_PAC for week in SEMANAS_PAC
+               for f in get_pac_source_files(variable, modelo, week, categoria)]
+    return any(os.path.getmtime(f) > mtime for f in fuentes if os.path.isfile(f))
+
+
+@lru_cache(maxsize=16)
+def _load_pac_store(archivo: str, mtime: float) -> xr.DataArray:
+    # El mtime forma parte de la clave, así un archivo reconstruido no se lee desde la caché
+    with xr.open_dataset(archivo, engine='netcdf4', decode_timedelta=True) as ds:
+        return ds['corr_factor'].load()
+
+
+def get_pac_factors(variable: str, modelo: str) -> xr.DataArray:
+    """
+    Devuelve los factores de corrección PAC del modelo/variable, con dimensiones (categoria, semanas, Y, X).
+    El archivo consolidado se construye si no existe o si los archivos PAC son más recientes.
+    Los datos leídos se mantienen en memoria para las siguientes llamadas del proceso.
+    """
+    if pac_store_is_outdated(variable, modelo):
+        build_pac_store(variable, modelo)
+    archivo = get_pac_store_path(variable, modelo)
+    return _load_pac_store(archivo, os.path.getmtime(archivo))
@@ -0,0 +1,101 @@
+
+import os
+import logging
+import datetime as dt
+import numpy as np
+import xarray as xr
+
+from pathlib import Path
+
+from setup.config import GlobalConfig
+from stores.archivos import escritura_atomica
+
+
+# Las probabilidades (%) se guardan como enteros de 16 bits con dos decimales (error máximo 0.005%).
+# El faltante (p.e. el mar en precipitación) es el menor int16.
+ESCALA = 0.01
+FALTANTE = np.iinfo(np.int16).min
+NOMBRE_VARIABLE = 'prob'
+
+# Categorías de probabilidad de los archivos de salida
+CATEGORIAS_PRODUCTO = ['20-', '50-', '50+', '80+']
+
+
+def get_carpeta_prob(variable: str, miercoles: dt.datetime) -> str:
+    carpeta = os.fspath(Path(GlobalConfig.Instance().app_config.carpeta_datos))
+    return carpeta + '/operativo/prob/' + variable + '/' + miercoles.strftime('%Y%m%d%H%M') + '/'
+
+
+def get_producto_path(variable: str, modelo: str, miercoles: dt.datetime, fecha_d: dt.datetime) -> str:
+    return get_carpeta_prob(variable, miercoles) + variable + '_' + modelo + '_' + fecha_d.strftime('%Y%m%d%H%M') + \
+        '_probabilities.nc'
+
+
+def get_legado_path(variable: str, modelo: str, miercoles: dt.datetime, fecha_d: dt.datetime, percentil: str) -> str:
+    # Ruta de los archivos por categoría, anterior al archivo único (la usan los sistemas que consumen las salidas)
+    sentido = '_underpctil' if percentil.endswith('-') else '_overpctil'
+    return get_carpeta_prob(variable, miercoles) + percentil + '/' + variable + sentido + percentil[0:2] + '_' + \
+        modelo + '_' + fecha_d.strftime('%Y%m%d%H%M') + '_probability.nc'
+
+
+def build_producto(probabilidades: dict[str, xr.DataArray]) -> xr.DataArray:
+    """
+    Reúne las probabilidades de todas las categorías en un único DataArray, con la dimensión categoria primero.
+    """
+    categorias = list(probabilidades)
+    producto = xr.concat([probabilidades[c] for c in categorias],
+                         dim=xr.DataArray(categorias, dims='categoria', name='categoria'))
+    producto = producto.rename(NOMBRE_VARIABLE).transpose('categoria', 'semanas', ...)
+    producto.attrs.update({'long_name': 'Probabilidad calibrada de cada categoría', 'units': '%'})
+    return producto
+
+
+def get_encoding(producto: xr.DataArray) -> dict:
+    # Chunks de un mapa con todas las semanas por categoría: un mapa se lee de un solo chunk y la serie de
+    # un punto (todas las categorías y semanas) de un chunk por categoría
+    return {NOMBRE_VARIABLE: {'dtype': 'int16', 'scale_factor': ESCALA, '_FillValue': FALTANTE,
+                              'zlib': True, 'complevel': 4, 'shuffle': True,
+                              'chunksizes': (1,) + producto.shape[1:]}}
+
+
+def guardar_producto(probabilidades: dict[str, xr.DataArray], archivo: str, attrs: dict | None = None) -> str:
+    """
+    Guarda las probabilidades de todas las categorías en un único archivo comprimido (ver get_encoding).
+    """
+    producto = build_producto(probabilidades)
+    ds = producto.to_dataset()
+    ds.attrs.update(attrs or {})
+
+    # Se escribe en un archivo temporal y se renombra, para no dejar archivos incompletos
+    os.makedirs(os.path.dirname(archivo), exist_ok=True)
+    with escritura_atomica(archivo) as temporal:
+        ds.to_netcdf(temporal, encoding=get_encoding(producto))
+
+    return archivo
+
+
+def guardar_legado(probabilidades: dict[str, xr.DataArray], variable: str, modelo: str, miercoles: dt.datetime,
+                   fecha_d: dt.datetime) -> list[str]:
+    """
+    Guarda un archivo por categoría, sin comprimir ni escalar, en las rutas anteriores al archivo único.
+    """
+    archivos = []
+    for percentil, prob in probabilidades.items():
+        archivo = get_legado_path(variable, modelo, miercoles, fecha_d, percentil)
+        os.makedirs(os.path.dirname(archivo), exist_ok=True)
+        prob.to_netcdf(archivo)
+        archivos.append(archivo)
+    return archivos
+
+
+def abrir_producto(archivo: str) -> xr.DataArray:
+    """
+    Probabilidades (%) de todas las categorías de un archivo único, como float (los faltantes como NaN).
+    """
+    with xr.open_dataset(archivo) as ds:
+        return ds[NOMBRE_VARIABLE].load()
+
+
+def separar_categorias(producto: xr.DataArray) -> dict[str, xr.DataArray]:
+    # Un DataArray por categoría, como los de Calibracion.probabilidades
+    return {str(c): producto.sel(categoria=c, drop=True) for c in producto.categoria.values}
@@ -0,0 +1,136 @@
+
+import os
+import hashlib
+import logging
+import numpy as np
+import xarray as xr
+
+from pathlib import Path
+from scipy import sparse
+
+from setup.config import GlobalConfig
+from stores.archivos import escritura_atomica
+from controllers.metricas import etapa
+
+
+def _linear_weights(fuente: np.ndarray, destino: np.ndarray):
+    """
+    Vecinos y pesos de la interpolación lineal de los puntos 'destino' sobre la coordenada 'fuente',
+    que puede ser creciente o decreciente. Los puntos fuera de la coordenada fuente se marcan como no válidos.
+    """
+    orden = np.argsort(fuente)
+    f = fuente[orden]
+    i = np.clip(np.searchsorted(f, destino) - 1, 0, len(f) - 2)
+    w1 = (destino - f[i]) / (f[i + 1] - f[i])
+    valido = (destino >= f[0]) & (destino <= f[-1])
+    return orden[i], orden[i + 1], 1. - w1, w1, valido
+
+
+class Regridder(object):
+    """
+    Interpolación bilineal de una grilla regular (Y, X) a otra, mediante una matriz dispersa de pesos
+    (puntos destino x puntos fuente) que se aplica a todos los campos (semanas, días, etc.) a la vez.
+    """
+
+    def __init__(self, pesos: sparse.csr_matrix, fuente: tuple[np.ndarray, np.ndarray], destino: tuple[np.ndarray, np.ndarray]):
+        self.pesos: sparse.csr_matrix = pesos
+        self.fuente = fuente
+        self.destino = destino
+        # Puntos destino sin pesos, i.e. fuera de la grilla fuente
+        self.fuera = np.diff(pesos.indptr) == 0
+
+    @staticmethod
+    def grid_key(fuente: tuple[np.ndarray, np.ndarray], destino: tuple[np.ndarray, np.ndarray]) -> str:
+        h = hashlib.sha1()
+        for coord in fuente + destino:
+            h.update(np.ascontiguousarray(coord, dtype='float64').tobytes())
+            h.update(b'|')
+        return h.hexdigest()
+
+    @classmethod
+    def from_grids(cls, fuente: tuple[np.ndarray, np.ndarray], destino: tuple[np.ndarray, np.ndarray]) -> 'Regridder':
+        (y_f, x_f), (y_d, x_d) = fuente, destino
+        iy0, iy1, wy0, wy1, vy = _linear_weights(np.asarray(y_f, dtype='float64'), np.asarray(y_d, dtype='float64'))
+        ix0, ix1, wx0, wx1, vx = _linear_weights(np.asarray(x_f, dtype='float64'), np.asarray(x_d, dtype='float64'))
+
+        # Cuatro vecinos por punto destino (índices aplanados en orden Y, X)
+        filas, columnas, valores = [], [], []
+        destino_idx = np.arange(len(y_d) * len(x_d)).reshape(len(y_d), len(x_d))
+        valido = vy[:, None] & vx[None, :]
+        for iy, wy in [(iy0, wy0), (iy1, wy1)]:
+            for ix, wx in [(ix0, wx0), (ix1, wx1)]:
+                filas.append(destino_idx[valido])
+                columnas.append((iy[:, None] * len(x_f) + ix[None, :])[valido])
+                valores.append((wy[:, None] * wx[None, :])[valido])
+        pesos = sparse.csr_matrix((np.concatenate(valores), (np.concatenate(filas), np.concatenate(columnas))),
+                                  shape=(len(y_d) * len(x_d), len(y_f) * len(x_f)))
+        # Los pesos nulos no se guardan, así un valor faltante no se propaga a un punto que coincide con la grilla
+        pesos.eliminate_zeros()
+
+        return cls(pesos, (np.asarray(y_f), np.asarray(x_f)), (np.asarray(y_d), np.asarray(x_d)))
+
+    def save(self, archivo: str):
+        # Los pesos son comunes a todos los modelos y variables: se escriben en un temporal único (ver escritura_atomica)
+        with escritura_atomica(archivo) as temporal:
+            np.savez(temporal, data=self.pesos.data, indices=self.pesos.indices, indptr=self.pesos.indptr,
+                     shape=self.pesos.shape, y_f=self.fuente[0], x_f=self.fuente[1], y_d=self.destino[0],
+                     x_d=self.destino[1])
+
+    @classmethod
+    def load(cls, archivo: str) -> 'Regridder':
+        with np.load(archivo) as f:
+            pesos = sparse.csr_matrix((f['data'], f['indices'], f['indptr']), shape=tuple(f['shape']))
+            return cls(pesos, (f['y_f'], f['x_f']), (f['y_d'], f['x_d']))
+
+    def __call__(self, da: xr.DataArray) -> xr.DataArray:
+        """
+        Interpola da (con dimensiones Y, X y cualquier otra) a la grilla destino.
+        """
+        otras = [d for d in da.dims if d not in ('Y', 'X')]
+        datos = da.transpose(*otras, 'Y', 'X').values
+        datos = datos.reshape(-1, datos.shape[-2] * datos.shape[-1])
+
+        salida = np.asarray(self.pesos @ datos.T, dtype='float64').T
+        salida[:, self.fuera] = np.nan
+        salida = salida.reshape([da.sizes[d] for d in otras] + [len(self.destino[0]), len(self.destino[1])])
+
+        coords = {nombre: coord for nombre, coord in da.coords.items() if not {'Y', 'X'} & set(coord.dims)}
+        coords.update(Y=self.destino[0], X=self.destino[1])
+        regrillado = xr.DataArray(salida, dims=otras + ['Y', 'X'], coords=coords, name=da.name, attrs=da.attrs)
+        return regrillado.transpose(*da.dims)
+
+
+__regridders: dict[str, Regridder] = {}
+
+
+def get_regridder(fuente: xr.DataArray, destino: xr.DataArray) -> Regridder:
+    """
+    Devuelve el regridder de la grilla de 'fuente' a la de 'destino'. Los pesos se calculan una sola vez
+    por par de grillas y se guardan en la carpeta regrid/ de datos; además se mantienen en memoria.
+    """
+    grilla_f = (fuente.Y.values, fuente.X.values)
+    grilla_d = (destino.Y.values, destino.X.values)
+    clave = Regridder.grid_key(grilla_f, grilla_d)
+    if clave in __regridders:
+        return __regridders[clave]
+
+    carpeta = os.fspath(Path(GlobalConfig.Instance().app_config.carpeta_datos))
+    archivo = carpeta + '/regrid/bilinear_' + clave + '.npz'
+    if os.path.isfile(archivo):
+        regridder = Regridder.load(archivo)
+    else:
+        logging.info(f'######## Calculando pesos de interpolación: {archivo}')
+        regridder = Regridder.from_grids(grilla_f, grilla_d)
+        os.makedirs(os.path.dirname(archivo), exist_ok=True)
+        regridder.save(archivo)
+    __regridders[clave] = regridder
+
+    return regridder
+
+
+@etapa('regrid')
+def regrid_like(da: xr.DataArray, destino: xr.DataArray) -> xr.DataArray:
+    """
+    Equivalente a da.interp_like(destino) para las coordenadas X, Y (interpolación bilineal).
+    """
+    return get_regridder(da, destino)(da)
@@ -0,0 +1,49 @@
+
+import shutil
+import tempfile
+import unittest
+import datetime as dt
+import numpy as np
+
+from setup.config import GlobalConfig
+from benchmarks.sinteticos import generar_datos
+from benchmarks.medicion import Medicion, comparar_implementaciones, diferencias, buscar_regresiones
+
+
+class ItemTest(unittest.TestCase):
+
+    def setUp(self):
+        self.config = GlobalConfig.Instance().app_config
+        self.carpeta_original = self.config.carpeta_datos
+        self.carpeta = tempfile.mkdtemp()
+        self.config.carpeta_datos = self.carpeta
+
+    def tearDown(self):
+        self.config.carpeta_datos = self.carpeta_original
+        shutil.rmtree(self.carpeta)
+
+    def test_diferencias(self):
+        a = np.array([0., 0.5, np.nan, 1.])
+        self.assertEqual(diferencias([a], [a.copy()]), (0., 0))
+        b = np.array([0., 0.5 + 1e-12, 0.2, 1.])
+        max_diferencia, distintos = diferencias([a], [b], tolerancia=1e-9)
+        self.assertAlmostEqual(max_diferencia, 1e-12)
+        # Solo cuenta el NaN que falta en b
+        self.assertEqual(distintos, 1)
+
+    def test_regresiones(self):
+        referencia = {'GEPS8/pr/calc_prob': {'segundos': 1., 'memoria_mb': 10.}}
+        mediciones = [Medicion('calc_prob', 'GEPS8', 'pr', 1.2, 10.), Medicion('get_data', 'GEPS8', 'pr', 9., 9.)]
+        self.assertEqual(buscar_regresiones(mediciones, referencia), [])
+        mediciones = [Medicion('calc_prob', 'GEPS8', 'pr', 1.5, 13.)]
+        self.assertEqual(len(buscar_regresiones(mediciones, referencia)), 2)
+
+    def test_implementaciones(self):
+        miercoles = dt.datetime(2025, 8, 20)
+        archivos = generar_datos('GMAO-GEOS_V2p1', 'tas', miercoles, ny=6, nx=5)
+        self.assertEqual(len(archivos['climatologia']), 7)
+        comparaciones = comparar_implementaciones('GMAO-GEOS_V2p1', 'tas', miercoles)
+        self.assertEqual([c.nombre for c in comparaciones], ['contar_miembros', 'calc_prob', 'agregacion_semanal', 'regrid',
+                                                             'hindcast', 'climatologia', 'pac', 'calc_prob_corr_extr'])
+        for c in comparaciones:
+            self.assertEqual(c.distintos, 0, c.nombre)
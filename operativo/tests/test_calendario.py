@@ -0,0 +1,44 @@
+
+import unittest
+import datetime as dt
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from calendario import CalendarioSemanas
+
+
+class ItemTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        self.miercoles = dt.datetime(2025, 8, 20)
+        plazos = pd.to_timedelta(np.arange(45) + 0.5, unit='D')
+        self.fcst = xr.DataArray(rng.normal(20, 3, (1, 4, 45, 3, 2)).astype('float32'), dims=('S', 'M', 'L', 'Y', 'X'),
+                                 coords={'S': [self.miercoles - dt.timedelta(days=1)], 'M': np.arange(1, 5), 'L': plazos,
+                                         'Y': [-50., -40., -30.], 'X': [-70., -60.]},
+                                 name='tas', attrs={'units': 'degC'})
+        self.fcst[0, 1, 10:13, 0, 0] = np.nan
+        self.fcst[0, 2, 9:16, 1, 1] = np.nan  # semana 2 completa sin datos
+
+    def test_semanas(self):
+        calendario = CalendarioSemanas.from_data(self.fcst, self.miercoles, hcast=0)
+        # Jueves 21 (plazo 2) al miércoles 27: semana 1; luego 7 días de semana 2 y 14 de semanas 3y4
+        esperado = np.array([0.]*2 + [1.]*7 + [2.]*7 + [3.]*14 + [5.]*15)
+        np.testing.assert_array_equal(calendario.semanas, esperado)
+        self.assertEqual(calendario.fechas_iniciales, [dt.date(2025, 8, 21), dt.date(2025, 8, 28),
+                                                       dt.date(2025, 9, 4), dt.date(2025, 9, 18)])
+
+    def test_aggregate(self):
+        calendario = CalendarioSemanas.from_data(self.fcst, self.miercoles, hcast=0)
+        agrupado = calendario.assign_to(self.fcst).groupby('semanas')
+        for agregacion, esperado in [('mean', agrupado.mean(dim='L')), ('sum', agrupado.sum(dim='L'))]:
+            semanal = calendario.aggregate(self.fcst, agregacion)
+            self.assertEqual(semanal.dims, esperado.dims)
+            self.assertEqual(semanal.dtype, esperado.dtype)
+            self.assertEqual(semanal.attrs, esperado.attrs)
+            xr.testing.assert_allclose(semanal, esperado, rtol=1e-6)
+
+
+if __name__ == "__main__":
+    unittest.main()
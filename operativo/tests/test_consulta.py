@@ -0,0 +1,141 @@
+
+import datetime as dt
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+import shapely
+import xarray as xr
+
+from unittest import mock
+
+from benchmarks.sinteticos import generar_datos
+from consulta import celdas_puntos, celdas_poligono, tabla_probabilidades, historia_puntos, historia_poligono
+from consulta import consultar_puntos
+from etapas import Calibracion, PERCENTILES_SALIDA, calibrar, guardar_probabilidades
+from prob_funciones import DIM_CELDA
+from setup.config import GlobalConfig
+from stores.historico import agregar_al_historico
+
+
+class ItemTest(unittest.TestCase):
+
+    def setUp(self):
+        self.X = np.arange(-82., -32., 1.)
+        self.Y = np.arange(-57., -7., 1.)
+
+    def test_celdas_puntos(self):
+        celdas, indice = celdas_puntos(self.X, self.Y, [-58.4, -70.1, -58.3], [-34.6, -20.2, -34.8])
+        # Los dos primeros puntos caen en la misma celda
+        self.assertEqual(celdas['X'].dims, (DIM_CELDA,))
+        self.assertEqual(len(celdas['X']), 2)
+        np.testing.assert_array_equal(celdas['X'].values[indice], [-58., -70., -58.])
+        np.testing.assert_array_equal(celdas['Y'].values[indice], [-35., -20., -35.])
+        # Grilla con longitudes 0-360
+        celdas, indice = celdas_puntos(self.X + 360, self.Y, [-58.4], [-34.6])
+        np.testing.assert_array_equal(celdas['X'].values, [302.])
+        with self.assertRaises(ValueError):
+            celdas_puntos(self.X, self.Y, [-20.], [-34.6])
+
+    def test_celdas_poligono(self):
+        # Polígono que cubre 2 x 2 celdas completas y la mitad de otras dos
+        poligono = shapely.box(-60.5, -35.5, -58.5, -33.)
+        celdas, fracciones = celdas_poligono(self.X, self.Y, poligono)
+        self.assertEqual(len(fracciones), 6)
+        np.testing.assert_allclose(sorted(fracciones), [.5, .5, 1., 1., 1., 1.])
+        self.assertEqual(set(celdas['X'].values), {-60., -59.})
+        with self.assertRaises(ValueError):
+            celdas_poligono(self.X, self.Y, shapely.box(-20., -35., -19., -34.))
+
+    def test_tabla_probabilidades(self):
+        celdas = {'X': xr.DataArray([-60., -59.], dims=DIM_CELDA), 'Y': xr.DataArray([-35., -34.], dims=DIM_CELDA)}
+        fechas_v = [dt.date(2025, 8, 21), dt.date(2025, 8, 28), dt.date(2025, 9, 4), dt.date(2025, 9, 18)]
+        probabilidades = {}
+        for i, categoria in enumerate(PERCENTILES_SALIDA):
+            probabilidades[categoria] = xr.DataArray(np.arange(6.).reshape(3, 2) + 10 * i, dims=('semanas', DIM_CELDA),
+                                                     coords={'semanas': [1., 2., 3.], **celdas})
+        tabla = tabla_probabilidades(Calibracion(dt.datetime(2025, 8, 21), fechas_v, probabilidades))
+
+        self.assertEqual(len(tabla), 2 * 3 * len(PERCENTILES_SALIDA))
+        fila = tabla[(tabla.categoria == '50+') & (tabla.semana == '3y4') & (tabla.X == -59.)].iloc[0]
+        self.assertEqual(fila.probabilidad, 25.)
+        self.assertEqual(fila.Y, -34.)
+        self.assertEqual(fila.fecha_inicio, pd.Timestamp('2025-09-04'))
+        self.assertEqual(fila.fecha_fin, pd.Timestamp('2025-09-17'))
+
+    def test_historia(self):
+        config = GlobalConfig.Instance().app_config
+        carpeta_original, config.carpeta_datos = config.carpeta_datos, tempfile.mkdtemp()
+        try:
+            for i, miercoles in enumerate([dt.datetime(2025, 8, 20), dt.datetime(2025, 8, 13)]):
+                fecha_d = miercoles + dt.timedelta(days=1)
+                coords = {'semanas': [1., 2., 3.], 'S': ('semanas', pd.date_range(fecha_d, periods=3, freq='7D')),
+                          'Y': self.Y, 'X': self.X}
+                probabilidades = {}
+                for j, categoria in enumerate(PERCENTILES_SALIDA):
+                    prob = xr.DataArray(np.full((3, len(self.Y), len(self.X)), 10. * j + i), dims=('semanas', 'Y', 'X'),
+                                        coords=coords)
+                    prob.loc[{'X': -59., 'Y': -35.}] = np.nan
+                    probabilidades[categoria] = prob
+                agregar_al_historico('pr', 'GEPS8', probabilidades, fecha_d, miercoles)
+
+            puntos = pd.DataFrame({'nombre': ['A', 'B'], 'lon': [-58.4, -70.1], 'lat': [-34.6, -20.2]})
+            tabla = historia_puntos('ECCC-GEPS8', 'pr', puntos, categorias=['80+'])
+            self.assertEqual(len(tabla), 2 * 2 * 3)
+            serie = tabla[(tabla.nombre == 'A') & (tabla.semana == '3y4')]
+            # Ordenada por fecha de inicialización, aunque se agregó primero la última
+            self.assertEqual(list(serie.inicio), [pd.Timestamp('2025-08-14'), pd.Timestamp('2025-08-21')])
+            np.testing.assert_allclose(serie.probabilidad, [31., 30.])
+            self.assertEqual(serie.fecha_fin.iloc[0], pd.Timestamp('2025-09-10'))
+
+            # La celda sin dato no se considera en el promedio del polígono
+            tabla = historia_poligono('ECCC-GEPS8', 'pr', shapely.box(-60.5, -35.5, -58.5, -33.),
+                                      desde=dt.datetime(2025, 8, 20))
+            self.assertEqual(len(tabla), len(PERCENTILES_SALIDA) * 3)
+            np.testing.assert_allclose(tabla[tabla.categoria == '50-'].probabilidad, 10.)
+            self.assertTrue((tabla.celdas == 5).all())
+        finally:
+            shutil.rmtree(config.carpeta_datos)
+            config.carpeta_datos = carpeta_original
+
+    def test_consultar_puntos(self):
+        config = GlobalConfig.Instance().app_config
+        carpeta_original, config.carpeta_datos = config.carpeta_datos, tempfile.mkdtemp()
+        legado, historico = config.salidas.legado, config.salidas.historico
+        try:
+            miercoles = dt.datetime(2025, 8, 20)
+            generar_datos('ECCC-GEPS8', 'pr', miercoles, ny=11, nx=9)
+            grilla = calibrar('ECCC-GEPS8', 'pr', miercoles)
+            puntos = pd.DataFrame({'nombre': ['A', 'B'], 'lon': [-82., -63.6], 'lat': [-57., -37.4]})
+            celdas, indice = celdas_puntos(grilla.probabilidades['20-'].X.values, grilla.probabilidades['20-'].Y.values,
+                                           puntos['lon'], puntos['lat'])
+
+            # Sin el producto publicado, se calibran solo las celdas consultadas (en estas celdas no hay
+            # probabilidades fuera de rango, así que coinciden con la calibración de la grilla)
+            esperado = tabla_probabilidades(Calibracion(grilla.fecha_d, grilla.fechas_v,
+                                                        {c: p.sel(celdas) for c, p in grilla.probabilidades.items()}))
+            esperado = puntos.assign(celda=indice).merge(esperado, on='celda').drop(columns='celda')
+            with self.assertLogs(level='WARNING'):
+                tabla = consultar_puntos('ECCC-GEPS8', 'pr', miercoles, puntos)
+            self.assertEqual(len(tabla), 2 * 3 * len(PERCENTILES_SALIDA))
+            pd.testing.assert_frame_equal(tabla.drop(columns='probabilidad'), esperado.drop(columns='probabilidad'))
+            np.testing.assert_allclose(tabla.probabilidad, esperado.probabilidad, rtol=0, atol=1e-12)
+
+            # Con el producto publicado, se leen de él las celdas (sin calibrar)
+            config.salidas.legado, config.salidas.historico = False, False
+            guardar_probabilidades('ECCC-GEPS8', 'pr', miercoles, grilla)
+            with mock.patch('consulta.calibrar') as calibrar_mock:
+                tabla_producto = consultar_puntos('ECCC-GEPS8', 'pr', miercoles, puntos)
+            calibrar_mock.assert_not_called()
+            pd.testing.assert_frame_equal(tabla_producto.drop(columns='probabilidad'), tabla.drop(columns='probabilidad'),
+                                          check_dtype=False)
+            np.testing.assert_allclose(tabla_producto.probabilidad, tabla.probabilidad, rtol=0, atol=0.005)
+        finally:
+            config.salidas.legado, config.salidas.historico = legado, historico
+            shutil.rmtree(config.carpeta_datos)
+            config.carpeta_datos = carpeta_original
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,161 @@
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+from controllers.downloads import DownloadManager
+from errors.downloads import RemoteFileNotFound, InvalidRemoteFile
+
+
+class RangeHandler(SimpleHTTPRequestHandler):
+    """ Servidor de archivos con soporte de HTTP Range, que puede cortar a la mitad una transferencia. """
+    cortes: set[str] = set()
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        nombre = os.path.basename(self.path)
+        rango = self.headers.get('Range')
+        if rango is None and nombre not in self.cortes:
+            return super().do_GET()
+
+        with open(self.translate_path(self.path), 'rb') as f:
+            datos = f.read()
+        inicio = int(rango.removeprefix('bytes=').rstrip('-')) if rango else 0
+        if rango and inicio >= len(datos):
+            # Como Apache, el error 416 es una página HTML
+            self.send_error(416, 'Requested Range Not Satisfiable')
+            return
+        if rango:
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {inicio}-{len(datos) - 1}/{len(datos)}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/x-netcdf')
+        self.send_header('Content-Length', str(len(datos) - inicio))
+        self.end_headers()
+        cuerpo = datos[inicio:]
+        if nombre in self.cortes:
+            self.cortes.discard(nombre)
+            self.wfile.write(cuerpo[:len(cuerpo) // 2])
+            self.close_connection = True
+        else:
+            self.wfile.write(cuerpo)
+
+
+def contenido_netcdf(size: int) -> bytes:
+    return b'CDF\x01' + os.urandom(size)
+
+
+class ItemTest(unittest.TestCase):
+
+    def setUp(self):
+        self.origen = tempfile.mkdtemp()
+        self.destino = tempfile.mkdtemp()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), partial(RangeHandler, directory=self.origen))
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        self.manager = DownloadManager.Instance()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.origen)
+        shutil.rmtree(self.destino)
+
+    def test_download_many(self):
+        contenidos = {f'data{i}.nc': contenido_netcdf(100_000 + i) for i in range(5)}
+        for nombre, contenido in contenidos.items():
+            with open(f'{self.origen}/{nombre}', 'wb') as f:
+                f.write(contenido)
+
+        descargas = [(f'{self.url}/{nombre}', f'{self.destino}/{nombre}') for nombre in contenidos]
+        resultados = self.manager.download_many(descargas)
+        self.assertEqual([r.path for r in resultados], [out_file for _, out_file in descargas])
+        self.assertTrue(all(r.refreshed for r in resultados))
+        for nombre, contenido in contenidos.items():
+            with open(f'{self.destino}/{nombre}', 'rb') as f:
+                self.assertEqual(f.read(), contenido)
+
+    def test_download_revalidation(self):
+        origen, destino = f'{self.origen}/data.nc', f'{self.destino}/data.nc'
+        with open(origen, 'wb') as f:
+            f.write(contenido_netcdf(50_000))
+        os.utime(origen, (1_700_000_000, 1_700_000_000))
+
+        self.assertTrue(self.manager.download(f'{self.url}/data.nc', destino).refreshed)
+        self.assertTrue(os.path.isfile(self.manager.meta_path(destino)))
+        # Sin cambios en el servidor: la respuesta es 304 y no se transfiere el archivo
+        self.assertFalse(self.manager.download(f'{self.url}/data.nc', destino).refreshed)
+        # Archivo modificado en el servidor
+        with open(origen, 'wb') as f:
+            f.write(contenido_netcdf(50_000))
+        os.utime(origen, (1_800_000_000, 1_800_000_000))
+        resultado = self.manager.download(f'{self.url}/data.nc', destino)
+        self.assertTrue(resultado.refreshed)
+        self.assertEqual(self.manager.file_sha256(destino), self.manager.file_sha256(origen))
+
+    def test_download_resume(self):
+        contenido = contenido_netcdf(3_000_000)
+        with open(f'{self.origen}/corte.nc', 'wb') as f:
+            f.write(contenido)
+        RangeHandler.cortes.add('corte.nc')
+
+        destino = f'{self.destino}/corte.nc'
+        self.assertTrue(self.manager.download(f'{self.url}/corte.nc', destino).refreshed)
+        self.assertNotIn('corte.nc', RangeHandler.cortes)
+        with open(destino, 'rb') as f:
+            self.assertEqual(f.read(), contenido)
+        self.assertEqual(sorted(os.listdir(self.destino)), ['corte.nc', 'corte.nc.meta.json'])
+
+    def test_download_resume_complete(self):
+        contenido = contenido_netcdf(100_000)
+        with open(f'{self.origen}/completo.nc', 'wb') as f:
+            f.write(contenido)
+        # Una transferencia previa llegó al final del archivo pero no se renombró
+        destino = f'{self.destino}/completo.nc'
+        with open(destino + '.part', 'wb') as f:
+            f.write(contenido)
+        self.manager.write_meta(destino + '.part', {'url': f'{self.url}/completo.nc', 'etag': None,
+                                                    'last_modified': None})
+        self.assertTrue(self.manager.download(f'{self.url}/completo.nc', destino).refreshed)
+        with open(destino, 'rb') as f:
+            self.assertEqual(f.read(), contenido)
+        self.assertEqual(sorted(os.listdir(self.destino)), ['completo.nc', 'completo.nc.meta.json'])
+
+    def test_write_meta_concurrente(self):
+        destino = f'{self.destino}/data.nc'
+        with open(destino, 'wb') as f:
+            f.write(contenido_netcdf(1_000))
+        metas = [{'url': f'{self.url}/data.nc', 'etag': str(i), 'last_modified': None} for i in range(20)]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            # result() propaga los errores de cada escritura
+            for futuro in [executor.submit(self.manager.write_meta, destino, meta) for meta in metas]:
+                futuro.result()
+        # Queda completo uno de los metadatos escritos, sin temporales
+        self.assertIn(self.manager.read_meta(destino), metas)
+        self.assertEqual(sorted(os.listdir(self.destino)), ['data.nc', 'data.nc.meta.json'])
+
+    def test_download_invalid(self):
+        with open(f'{self.origen}/error.nc', 'wb') as f:
+            f.write(b'Internal error')
+        with self.assertRaises(InvalidRemoteFile):
+            self.manager.download(f'{self.url}/error.nc', f'{self.destino}/error.nc')
+        # No queda ningún archivo parcial o inválido
+        self.assertEqual(os.listdir(self.destino), [])
+
+    def test_download_not_found(self):
+        with self.assertRaises(RemoteFileNotFound) as e:
+            self.manager.download_many([(f'{self.url}/faltante.nc', f'{self.destino}/faltante.nc')])
+        self.assertEqual(e.exception.url, f'{self.url}/faltante.nc')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+
+import os
+import shutil
+import tempfile
+import unittest
+import datetime as dt
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from setup.config import GlobalConfig
+from benchmarks.sinteticos import generar_datos
+from etapas import Calibracion, PERCENTILES_SALIDA, calibrar, guardar_probabilidades
+from stores.historico import abrir_historico
+
+
+class ItemTest(unittest.TestCase):
+
+    def setUp(self):
+        self.config = GlobalConfig.Instance().app_config
+        self.carpeta_original = self.config.carpeta_datos
+        self.carpeta = tempfile.mkdtemp()
+        self.config.carpeta_datos = self.carpeta
+        self.miercoles = dt.datetime(2025, 8, 20)
+
+    def tearDown(self):
+        self.config.carpeta_datos = self.carpeta_original
+        shutil.rmtree(self.carpeta)
+
+    def test_calibrar_chunks(self):
+        # La calibración por bloques (dask) coincide con la calibración en memoria, también con bloques incompletos
+        for nombre_modelo, variable in [('ECCC-GEPS8', 'pr'), ('NCEP-CFSv2', 'tas')]:
+            generar_datos(nombre_modelo, variable, self.miercoles, ny=11, nx=9)
+            en_memoria = calibrar(nombre_modelo, variable, self.miercoles)
+            por_bloques = calibrar(nombre_modelo, variable, self.miercoles, 4)
+            self.assertEqual(en_memoria.fecha_d, por_bloques.fecha_d)
+            self.assertEqual(en_memoria.fechas_v, por_bloques.fechas_v)
+            self.assertEqual(list(en_memoria.probabilidades), list(por_bloques.probabilidades))
+            for categoria, prob in en_memoria.probabilidades.items():
+                self.assertTrue(np.isfinite(prob.values).any())
+                self.assertIsInstance(por_bloques.probabilidades[categoria].data, np.ndarray)
+                np.testing.assert_allclose(por_bloques.probabilidades[categoria].values, prob.values,
+                                           rtol=0, atol=1e-12, err_msg=f'{nombre_modelo} {variable} {categoria}')
+
+    def test_guardar_probabilidades_historico(self):
+        salidas = self.config.salidas
+        legado, historico = salidas.legado, salidas.historico
+        salidas.legado, salidas.historico = False, True
+        try:
+            def calibracion(miercoles, X):
+                fecha_d = miercoles + dt.timedelta(days=1)
+                coords = {'semanas': [1., 2., 3.], 'S': ('semanas', pd.date_range(fecha_d, periods=3, freq='7D')),
+                          'Y': [-35., -34.], 'X': X}
+                return Calibracion(fecha_d, [], {c: xr.DataArray(np.full((3, 2, len(X)), 10.), dims=('semanas', 'Y', 'X'),
+                                                                 coords=coords) for c in PERCENTILES_SALIDA})
+
+            archivos = guardar_probabilidades('ECCC-GEPS8', 'pr', self.miercoles, calibracion(self.miercoles, [-60., -59.]))
+            self.assertEqual(len(archivos), 2)
+
+            # Un pronóstico que no se puede agregar al histórico (otra grilla) se guarda igual
+            miercoles = self.miercoles + dt.timedelta(days=7)
+            with self.assertLogs(level='ERROR'):
+                archivos = guardar_probabilidades('ECCC-GEPS8', 'pr', miercoles, calibracion(miercoles, [-60., -58.]))
+            self.assertEqual(len(archivos), 1)
+            self.assertTrue(os.path.isfile(archivos[0]))
+            with abrir_historico('pr', 'GEPS8') as historico:
+                self.assertEqual(historico.sizes['inicio'], 1)
+        finally:
+            salidas.legado, salidas.historico = legado, historico
+
+
+if __name__ == "__main__":
+    unittest.main()
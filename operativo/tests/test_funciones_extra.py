@@ -1,10 +1,19 @@
 
+import os
+import shutil
+import tempfile
 import unittest
 import datetime as dt
+import numpy as np
+import matplotlib
 
 from calendar import Day
+from unittest import mock
 
-from funciones_extra import get_date_for_weekday
+matplotlib.use('Agg')
+
+import funciones_extra
+from funciones_extra import get_date_for_weekday, get_fecha_publicacion, get_nombre_figura, PlantillaMapa
 
 
 class ItemTest(unittest.TestCase):
@@ -20,6 +29,37 @@ class ItemTest(unittest.TestCase):
         self.assertEqual(self.sunday, get_date_for_weekday(self.wednesday, Day.SUNDAY),
                          'Error al definir domingo previo')
 
+    def test_get_fecha_publicacion(self):
+        self.assertEqual(self.sunday, get_fecha_publicacion('RSMAS-CCSM4', self.wednesday))
+        self.assertEqual(self.wednesday, get_fecha_publicacion('NCEP-CFSv2', self.wednesday))
+        self.assertEqual(self.wednesday, get_fecha_publicacion('EMC-GEFSv12_CPC', self.wednesday))
+        self.assertEqual(dt.datetime(2025, 8, 19), get_fecha_publicacion('GMAO-GEOS_V2p1', self.wednesday))
+        self.assertEqual(dt.datetime(2025, 8, 21), get_fecha_publicacion('ECCC-GEPS8', self.wednesday))
+        with self.assertRaises(ValueError):
+            get_fecha_publicacion('ECMWF-S2S', self.wednesday)
+
+    def test_plantilla_mapa(self):
+        carpeta = tempfile.mkdtemp() + '/'
+        x, y = np.linspace(-82, -33, 18), np.linspace(-57, -8, 20)
+        rng = np.random.default_rng(0)
+        try:
+            with mock.patch.object(funciones_extra, 'get_geometrias_mapa',
+                                   return_value={'costas': [], 'paises': [], 'provincias': []}):
+                plantilla = PlantillaMapa('tas', '80+', x, y)
+            malla = plantilla.malla
+            for week in [1, 2, 3]:
+                f1 = self.wednesday + dt.timedelta(days=7 * week)
+                plantilla.graficar(rng.uniform(-5, 105, (20, 18)), week, f1, f1 + dt.timedelta(days=6),
+                                   get_nombre_figura(carpeta, week, 'GEPS8'))
+            # Se reutiliza la misma malla; solo cambian sus valores y el título
+            self.assertIs(plantilla.malla, malla)
+            self.assertTrue(plantilla.titulo_semana.get_text().startswith('Semanas 3 y 4; '))
+            plantilla.cerrar()
+            archivos = sorted(os.listdir(carpeta))
+            self.assertEqual(archivos, [f'pronostico_corregido_semana_{s}_GEPS8.jpg' for s in ['1', '2', '3y4']])
+        finally:
+            shutil.rmtree(carpeta)
+
 
 if __name__ == "__main__":
     unittest.main()
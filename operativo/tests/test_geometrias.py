@@ -0,0 +1,67 @@
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import shapely
+
+from unittest import mock
+
+from stores import geometrias
+from stores.geometrias import get_recorte, recortar_geometrias, guardar_geometrias, get_geometrias_mapa
+
+
+class ItemTest(unittest.TestCase):
+
+    def setUp(self):
+        self.carpeta = tempfile.mkdtemp()
+        self.archivo = f'{self.carpeta}/geometrias_mapa.json'
+
+    def tearDown(self):
+        shutil.rmtree(self.carpeta)
+
+    def test_recortar_geometrias(self):
+        # Línea densa que cruza la extensión de los mapas, y una geometría fuera de ella
+        x = np.linspace(-120, 0, 12001)
+        linea = shapely.LineString(np.column_stack([x, np.full_like(x, -30.)]))
+        afuera = shapely.Point(10., 40.)
+        recortadas = recortar_geometrias([linea, afuera], get_recorte())
+        self.assertEqual(len(recortadas), 1)
+        self.assertEqual(shapely.get_num_coordinates(recortadas[0]), 2)
+        np.testing.assert_allclose(recortadas[0].bounds, [-84., -30., -31., -30.])
+
+    def test_geometrias_mapa(self):
+        capas = {'costas': np.array([shapely.LineString([(-60, -40), (-55, -35)])]),
+                 'paises': np.array([shapely.LineString([(-70, -20), (-65, -22)])]),
+                 'provincias': np.array([], dtype=object)}
+        guardar_geometrias(capas, self.archivo)
+
+        with mock.patch.object(geometrias, 'get_geometrias_path', return_value=self.archivo), \
+                mock.patch.object(geometrias, 'build_geometrias_mapa') as build:
+            leidas = get_geometrias_mapa()
+            self.assertEqual(set(leidas), set(capas))
+            self.assertTrue(shapely.equals(leidas['costas'][0], capas['costas'][0]))
+            self.assertEqual(leidas['provincias'], [])
+            # Se reutilizan las geometrías ya leídas
+            self.assertIs(get_geometrias_mapa(), leidas)
+
+            build.assert_not_called()
+
+            # Las geometrías de otra extensión (o tolerancia) son un error
+            with mock.patch.object(geometrias, 'TOLERANCIA', 0.05):
+                with self.assertRaisesRegex(ValueError, 'build_stores.py geometrias'):
+                    get_geometrias_mapa()
+
+            # Si no existen, se generan
+            os.remove(self.archivo)
+            build.side_effect = lambda archivo: guardar_geometrias(capas, archivo)
+            with self.assertLogs(level='WARNING'):
+                leidas = get_geometrias_mapa()
+            build.assert_called_once_with(self.archivo)
+            self.assertTrue(shapely.equals(leidas['paises'][0], capas['paises'][0]))
+        self.assertEqual(os.listdir(self.carpeta), ['geometrias_mapa.json'])
+
+
+if __name__ == "__main__":
+    unittest.main()
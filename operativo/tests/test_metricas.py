@@ -0,0 +1,119 @@
+
+import os
+import json
+import sys
+import shutil
+import tempfile
+import textwrap
+import threading
+import subprocess
+import unittest
+import numpy as np
+
+from setup.config import GlobalConfig
+from controllers.script import ScriptControl
+from controllers.metricas import Metricas, contar, etapa, formato_prometheus, resumen_breve
+from etapas import inicializar_figuras
+
+
+@etapa('decorada')
+def reservar(n):
+    return np.ones(n).sum()
+
+
+class ItemTest(unittest.TestCase):
+
+    def setUp(self):
+        self.metricas = Metricas('prueba')
+        self.metricas.iniciar()
+
+    def tearDown(self):
+        self.metricas.detener()
+
+    def test_etapas(self):
+        with etapa('externa'):
+            for _ in range(2):
+                reservar(10_000_000)  # 80 MB
+            with etapa('interna'):
+                hilos = [threading.Thread(target=contar, args=('bytes_descargados', 100)) for _ in range(4)]
+                _ = [h.start() for h in hilos]
+                _ = [h.join() for h in hilos]
+        resumen = self.metricas.resumen()
+        etapas = {e['nombre']: e for e in resumen['etapas']}
+        self.assertEqual(list(etapas), ['externa', 'decorada', 'interna'])
+        self.assertEqual(etapas['decorada']['padre'], 'externa')
+        self.assertEqual(etapas['decorada']['llamadas'], 2)
+        self.assertGreaterEqual(etapas['externa']['segundos'], etapas['decorada']['segundos'])
+        # El pico de la etapa interna se mide desde su comienzo, sin la memoria ya liberada de las anteriores
+        self.assertGreater(etapas['decorada']['rss_max_bytes'], 70 * 1024 ** 2)
+        self.assertLess(etapas['interna']['rss_max_bytes'], etapas['decorada']['rss_max_bytes'])
+        self.assertEqual(etapas['externa']['rss_max_bytes'], etapas['decorada']['rss_max_bytes'])
+        # Los contadores se suman en la etapa y en las que la contienen
+        self.assertEqual(etapas['interna']['bytes_descargados'], 400)
+        self.assertEqual(etapas['externa']['bytes_descargados'], 400)
+        self.assertIn('descarga_bytes_por_segundo', etapas['interna'])
+        self.assertEqual(set(resumen_breve(resumen)['etapas']), set(etapas))
+
+        texto = formato_prometheus(resumen)
+        self.assertIn('operativo_etapa_llamadas{script="prueba",etapa="decorada"} 2', texto)
+        self.assertIn('# TYPE operativo_script_rss_max_bytes gauge', texto)
+
+    def test_sin_metricas(self):
+        # Sin métricas activas las etapas no miden nada
+        self.metricas.detener()
+        self.assertEqual(reservar(10), 10)
+        with etapa('otra'):
+            contar('bytes_descargados', 1)
+        self.assertEqual(self.metricas.etapas, {})
+
+    def test_inicializar_figuras(self):
+        # Los procesos de un pool no miden las etapas con las métricas heredadas del proceso principal
+        inicializar_figuras()
+        self.assertEqual(reservar(10), 10)
+        self.assertEqual(self.metricas.etapas, {})
+
+    def test_script_control_salida(self):
+        # Un script que termina con sys.exit (sin end_script_execution) también guarda sus métricas
+        carpeta = tempfile.mkdtemp()
+        codigo = textwrap.dedent(f"""
+            import sys
+            from setup.config import GlobalConfig
+            from controllers.script import ScriptControl
+            from controllers.metricas import etapa
+            GlobalConfig.Instance().app_config.metricas.carpeta = {carpeta!r}
+            script = ScriptControl('test--salida', single_instance=False)
+            script.start_script()
+            with etapa('descarga'):
+                pass
+            sys.exit(75)
+        """)
+        try:
+            salida = subprocess.run([sys.executable, '-c', codigo], capture_output=True)
+            self.assertEqual(salida.returncode, 75)
+            with open(os.path.join(carpeta, 'test--salida.jsonl'), 'r') as f:
+                registros = [json.loads(linea) for linea in f]
+            self.assertEqual([e['nombre'] for e in registros[0]['etapas']], ['descarga'])
+            self.assertEqual(sorted(os.listdir(carpeta)), ['test--salida.jsonl', 'test--salida.prom'])
+        finally:
+            shutil.rmtree(carpeta)
+
+    def test_script_control(self):
+        config = GlobalConfig.Instance().app_config
+        carpeta_original, carpeta = config.metricas.carpeta, tempfile.mkdtemp()
+        config.metricas.carpeta = carpeta
+        try:
+            for _ in range(2):
+                script = ScriptControl('test--metricas', single_instance=False)
+                script.start_script()
+                with etapa('descarga'):
+                    contar('bytes_descargados', 1024)
+                script.end_script_execution()
+            with open(os.path.join(carpeta, 'test--metricas.jsonl'), 'r') as f:
+                registros = [json.loads(linea) for linea in f]
+            self.assertEqual(len(registros), 2)
+            self.assertEqual(registros[-1]['etapas'][0]['bytes_descargados'], 1024)
+            with open(os.path.join(carpeta, 'test--metricas.prom'), 'r') as f:
+                self.assertIn('operativo_etapa_bytes_descargados{script="test--metricas",etapa="descarga"} 1024', f.read())
+        finally:
+            config.metricas.carpeta = carpeta_original
+            shutil.rmtree(carpeta)
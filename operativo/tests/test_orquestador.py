@@ -0,0 +1,41 @@
+
+import unittest
+import datetime as dt
+
+from run_orquestador import Nodo, construir_grafo, ejecutar_grafo
+
+
+def sumar(a, *entradas):
+    return a + sum(entradas)
+
+
+def fallar():
+    raise RuntimeError('Etapa con error')
+
+
+class ItemTest(unittest.TestCase):
+
+    def test_ejecutar_grafo(self):
+        a = Nodo('a', sumar, (1,), memoria=1.)
+        b = Nodo('b', sumar, (10,), memoria=1., entradas=[a])
+        c = Nodo('c', sumar, (100,), memoria=5., entradas=[a, b])  # mayor al presupuesto: corre sola
+        # f espera a c, pero no recibe su resultado
+        f = Nodo('f', sumar, (1000,), [c])
+        d = Nodo('d', fallar, (), [a])
+        e = Nodo('e', sumar, (0,), entradas=[d])
+        resultados, fallidas = ejecutar_grafo([e, f, d, c, b, a], procesos=2, memoria=2., variables=[])
+        self.assertEqual(resultados, {'a': 1, 'b': 11, 'c': 112, 'f': 1000})
+        self.assertEqual(fallidas, {'d', 'e'})
+
+    def test_construir_grafo(self):
+        nodos = {n.clave: n for n in construir_grafo(['ECCC-GEPS8'], ['pr'], dt.datetime(2025, 8, 20), False, True)}
+        descarga, calibracion = nodos['ECCC-GEPS8/pr/descarga'], nodos['ECCC-GEPS8/pr/calibracion']
+        # La calibración espera a la descarga sin recibir su resultado; la escritura y las figuras reciben la calibración
+        self.assertEqual((calibracion.dependencias, calibracion.entradas), ([descarga], []))
+        for etapa in ['escritura', 'figuras']:
+            nodo = nodos[f'ECCC-GEPS8/pr/{etapa}']
+            self.assertEqual((nodo.dependencias, nodo.entradas), ([calibracion], [calibracion]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+
+import shutil
+import tempfile
+import unittest
+import datetime as dt
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from calendario import CalendarioSemanas
+from prob_funciones import calc_prob, calc_prob_corr_extr, get_prono_data_CFS, valores_fuera_de_rango
+from benchmarks.referencias import calc_prob_replicado, calc_prob_corr_extr_iterativo
+
+
+class ItemTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = rng = np.random.default_rng(42)
+        semanas = np.array([1., 2., 3., 5.])
+        coords = {'semanas': semanas, 'Y': np.linspace(-57, -8, 6), 'X': np.linspace(-82, -33, 5)}
+        fechas = pd.date_range('2025-08-21', periods=4, freq='7D')
+        self.fcst_m = xr.DataArray(rng.normal(20, 3, (11, 4, 6, 5)), dims=('M', 'semanas', 'Y', 'X'),
+                                   coords={'M': np.arange(1, 12), **coords})
+        self.fcst_m[:, :, 0, 0] = np.nan
+        self.hcst_m = xr.DataArray(rng.normal(19, 1, (4, 6, 5)).astype('float32'), dims=('semanas', 'Y', 'X'),
+                                   coords=coords)
+        self.media_m = xr.DataArray(rng.normal(16, 1, (4, 6, 5)), dims=('semanas', 'Y', 'X'), coords=coords)
+        self.pctil_m = xr.DataArray(rng.normal(17, 1, (4, 6, 5)), dims=('semanas', 'Y', 'X'),
+                                    coords={**coords, 'S': ('semanas', fechas)})
+        # Un empate exacto con el umbral no debe contarse ni por encima ni por debajo
+        self.pctil_m[0, 1, 1] = float(self.fcst_m[0, 0, 1, 1] - self.hcst_m[0, 1, 1] + self.media_m[0, 1, 1])
+
+    def test_calc_prob_broadcast(self):
+        p_bajo, p_sobre = calc_prob_replicado(self.fcst_m, self.hcst_m, self.media_m, self.pctil_m)
+        for pctil in [20, 50, 80]:
+            p1, p2 = calc_prob(self.fcst_m, self.hcst_m, self.media_m, self.pctil_m, pctil)
+            esperado = p_sobre if pctil == 80 else p_bajo
+            np.testing.assert_array_equal(p1.transpose(*esperado.dims).values, esperado.values)
+            self.assertEqual(p1.name, 'prob')
+            self.assertIn('S', p1.coords)
+            if pctil == 50:
+                np.testing.assert_array_equal(p2.transpose(*p_sobre.dims).values, p_sobre.values)
+
+    def test_calc_prob_chunks(self):
+        bloques = {'Y': 4, 'X': 2}
+        for pctil in [20, 50, 80]:
+            esperado1, esperado2 = calc_prob(self.fcst_m, self.hcst_m, self.media_m, self.pctil_m, pctil)
+            p1, p2 = calc_prob(self.fcst_m.chunk(bloques), self.hcst_m.chunk(bloques), self.media_m, self.pctil_m, pctil)
+            self.assertIsNotNone(p1.chunks)
+            xr.testing.assert_identical(p1.compute(), esperado1)
+            if pctil == 50:
+                xr.testing.assert_identical(p2.compute(), esperado2)
+
+        # Agregación semanal de un pronóstico diario leído por bloques
+        plazos = pd.to_timedelta(np.arange(35) + 0.5, unit='D')
+        diario = xr.DataArray(self.rng.normal(20, 3, (1, 35, 6, 5)), dims=('S', 'L', 'Y', 'X'),
+                              coords={'S': [pd.Timestamp('2025-08-20')], 'L': plazos,
+                                      'Y': self.fcst_m.Y, 'X': self.fcst_m.X})
+        calendario = CalendarioSemanas.from_data(diario, dt.datetime(2025, 8, 20))
+        xr.testing.assert_identical(calendario.aggregate(diario.chunk(bloques)).compute(), calendario.aggregate(diario))
+
+    def test_calc_prob_corr_extr(self):
+        coords = {'semanas': [1., 2., 3.], 'Y': np.linspace(-57, -8, 6), 'X': np.linspace(-82, -33, 5)}
+        base = xr.DataArray(self.rng.uniform(0, 100, (3, 6, 5)), dims=('semanas', 'Y', 'X'), coords=coords,
+                            name='prob_corr', attrs={'standard_name': 'Probabilidad bajo percentil 20'})
+        # Todas las combinaciones de valores negativos / mayores a 100 en p1 y p2, con y sin NaN
+        for caso in range(32):
+            p1, p2 = base.copy(), (100 - base).copy()
+            if caso & 1:
+                p1[0, 0, :2] = [-12.5, -0.5]
+            if caso & 2:
+                p1[1, 2, 3] = 131.
+            if caso & 4:
+                p2[2, 1, :2] = [-3., -40.]
+            if caso & 8:
+                p2[0, 0, 0] = 100.5
+                p2[1, 5, 4] = 250.
+            if caso & 16:
+                p1[2, 3, 3] = np.nan
+                p2[0, 4, 1] = np.nan
+            esperado1, esperado2 = calc_prob_corr_extr_iterativo(p1, p2)
+            p1_o, p2_o = calc_prob_corr_extr(p1, p2)
+            xr.testing.assert_identical(p1_o, esperado1)
+            xr.testing.assert_identical(p2_o, esperado2)
+
+    def test_calc_prob_corr_extr_valores(self):
+        p1 = xr.DataArray([-10., 50., 120., np.nan])
+        p2 = xr.DataArray([40., -20., 30., 80.])
+        p1_o, p2_o = calc_prob_corr_extr(p1, p2)
+        np.testing.assert_array_equal(p1_o.values, [1., 39.5, 99., 1.])
+        np.testing.assert_array_equal(p2_o.values, [40., 1., 40.5, 80.])
+
+    def test_calc_prob_corr_extr_fuera_rango(self):
+        # Una celda corregida sola no tiene la corrección de la grilla, salvo que se pasen sus valores fuera de rango
+        p1, p2 = xr.DataArray([-10., 50., 120.]), xr.DataArray([40., 30., 30.])
+        fuera_rango = valores_fuera_de_rango(p1, p2)
+        self.assertEqual(fuera_rango, (True, True, False, False))
+        _, p2_o = calc_prob_corr_extr(p1, p2)
+        self.assertEqual(float(p2_o[0]), 40.)
+        _, p2_celda = calc_prob_corr_extr(p1[:1], p2[:1])
+        self.assertEqual(float(p2_celda[0]), 34.5)
+        p1_celda, p2_celda = calc_prob_corr_extr(p1[:1], p2[:1], fuera_rango)
+        self.assertEqual((float(p1_celda[0]), float(p2_celda[0])), (1., 40.))
+
+    def test_get_prono_data_CFS(self):
+        carpeta = tempfile.mkdtemp()
+        miercoles = dt.datetime(2025, 8, 20)
+        plazos = pd.to_timedelta(np.arange(45) + 0.5, unit='D')
+        coords = {'Y': np.linspace(-57, -8, 3), 'X': np.linspace(-82, -33, 2)}
+        try:
+            for lag in range(3):
+                inicio = miercoles - dt.timedelta(days=lag)
+                # El valor de cada plazo es el día (desde el miércoles guía) al que corresponde
+                valores = np.broadcast_to((np.arange(45) - lag)[None, None, :, None, None], (1, 4, 45, 3, 2))
+                pr = xr.DataArray(valores / 86400., dims=('S', 'M', 'L', 'Y', 'X'), name='pr', attrs={'units': 'kg m-2 s-1'},
+                                  coords={'S': [inicio], 'M': np.arange(1, 5), 'L': plazos, **coords})
+                pr.to_dataset().to_netcdf(f'{carpeta}/pr_CFSv2_{inicio:%Y%m%d%H%M}_forecast.nc')
+
+            fcst_m, fechas_o, fechas_v = get_prono_data_CFS(carpeta + '/', 'pr', miercoles)
+
+            # Una inicialización con otra grilla no se puede agregar al ensamble
+            pr = pr.assign_coords(X=pr.X + 1.)
+            pr.to_dataset().to_netcdf(f'{carpeta}/pr_CFSv2_{inicio:%Y%m%d%H%M}_forecast.nc')
+            with self.assertRaisesRegex(ValueError, 'coordenada X'):
+                get_prono_data_CFS(carpeta + '/', 'pr', miercoles)
+        finally:
+            shutil.rmtree(carpeta)
+
+        np.testing.assert_array_equal(fcst_m.M.values, np.arange(1, 13))
+        self.assertEqual(pd.Timestamp(fechas_v[0]), pd.Timestamp(miercoles + dt.timedelta(days=1)))
+        # Todos los miembros quedan alineados en los mismos días de pronóstico
+        for semana, dias in zip([1., 2., 3., 5.], [range(1, 8), range(8, 15), range(15, 29), range(29, 30)]):
+            np.testing.assert_allclose(fcst_m.sel(semanas=semana).values, sum(dias))
+
+
+if __name__ == "__main__":
+    unittest.main()
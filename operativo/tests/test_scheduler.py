@@ -0,0 +1,46 @@
+
+import os
+import shutil
+import tempfile
+import unittest
+import datetime as dt
+import subprocess
+
+from unittest import mock
+
+import run_scheduler
+from run_scheduler import EstadoSemanal, calibrar_modelo, pronostico_publicado
+from errors.forecasts import FcstNotYetPublished
+
+
+class ItemTest(unittest.TestCase):
+
+    def setUp(self):
+        self.carpeta = tempfile.mkdtemp()
+        self.miercoles = dt.datetime(2025, 8, 20)
+
+    def tearDown(self):
+        shutil.rmtree(self.carpeta)
+
+    def test_publicado(self):
+        manager = mock.Mock()
+        with mock.patch.object(run_scheduler.DownloadManager, 'Instance', return_value=manager):
+            # Falta una de las inicializaciones del ensamble de CFSv2
+            manager.exists.side_effect = lambda url: '16%20Aug' not in url
+            self.assertFalse(pronostico_publicado('NCEP-CFSv2', 'pr', self.miercoles))
+            self.assertEqual(manager.exists.call_count, 5)
+            manager.exists.side_effect = lambda url: True
+            self.assertTrue(pronostico_publicado('NCEP-CFSv2', 'pr', self.miercoles))
+
+    def test_no_publicado(self):
+        estado = EstadoSemanal(os.path.join(self.carpeta, 'planificador.json'))
+        codigos = {'pr': 0, 'tas': FcstNotYetPublished.exit_code}
+        with mock.patch.object(run_scheduler.subprocess, 'run',
+                               side_effect=lambda comando, **kwargs: subprocess.CompletedProcess(comando, codigos[comando[-1]])):
+            calibrar_modelo('ECCC-GEPS8', ['pr', 'tas'], self.miercoles, estado)
+        # La variable sin publicar queda pendiente
+        self.assertEqual(estado.realizadas('2025-08-20'), {'ECCC-GEPS8/pr'})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,286 @@
+
+import os
+import shutil
+import tempfile
+import unittest
+import datetime as dt
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from pathlib import Path
+from unittest import mock
+
+from setup.config import GlobalConfig
+from stores.archivos import escritura_atomica
+from stores.cache import RunCache
+from stores.climatology import get_climatology_window
+from stores.hindcast import open_hindcast_start, get_hindcast_store_path
+from stores.pac import CATEGORIAS_PAC, SEMANAS_PAC, get_pac_factors, get_pac_folder
+from stores.historico import abrir_historico, agregar_al_historico, agregar_pronosticos, get_historico_path, get_journal_path
+from stores.historico import importar_prob, seleccionar_inicios
+from stores.productos import abrir_producto, guardar_producto, guardar_legado, separar_categorias
+from stores.productos import ESCALA, get_legado_path, get_producto_path
+from stores.regrid import regrid_like
+
+
+class ItemTest(unittest.TestCase):
+
+    def setUp(self):
+        self.config = GlobalConfig.Instance().app_config
+        self.carpeta_original = self.config.carpeta_datos
+        self.carpeta = tempfile.mkdtemp()
+        self.config.carpeta_datos = self.carpeta
+        self.rng = np.random.default_rng(0)
+        self.coords = {'Y': np.linspace(-57, -8, 4), 'X': np.linspace(-82, -33, 3)}
+
+    def tearDown(self):
+        self.config.carpeta_datos = self.carpeta_original
+        shutil.rmtree(self.carpeta)
+
+    def write_pac_files(self, variable, modelo):
+        c_PAC = get_pac_folder(variable, modelo)
+        os.makedirs(c_PAC, exist_ok=True)
+        esperado = {}
+        for categoria in CATEGORIAS_PAC:
+            for week in SEMANAS_PAC:
+                campos = {}
+                for nombre, archivo in [('PAC', 'PAC'), ('std_o', 'stdo'), ('std_p', 'stdp')]:
+                    campos[nombre] = xr.DataArray(self.rng.uniform(-0.5, 2, (4, 3)), dims=('Y', 'X'),
+                                                  coords=self.coords, name=nombre)
+                    campos[nombre].to_dataset().to_netcdf(
+                        f'{c_PAC}{variable}_{archivo}_semana{week}_pctil{categoria}.nc')
+                esperado[(categoria, week)] = campos['PAC'] * (campos['std_o'] / campos['std_p'])
+        return esperado
+
+    def test_pac_store(self):
+        esperado = self.write_pac_files('tas', 'GEPS8')
+        factores = get_pac_factors('tas', 'GEPS8')
+        self.assertEqual(factores.dims, ('categoria', 'semanas', 'Y', 'X'))
+        for (categoria, week), corr_factor in esperado.items():
+            np.testing.assert_array_equal(factores.sel(categoria=categoria, semanas=week).values,
+                                          corr_factor.values)
+        # Una segunda llamada reutiliza los datos ya leídos
+        self.assertIs(get_pac_factors('tas', 'GEPS8'), factores)
+
+    def test_hindcast_store(self):
+        archivo = f'{self.carpeta}/tas_GEPS8_datos.nc'
+        fechas = pd.date_range('1999-01-01', '1999-12-31', freq='D')
+        hcst = xr.DataArray(self.rng.normal(290, 2, (len(fechas), 5, 4, 3)).astype('float32'),
+                            dims=('S', 'L', 'Y', 'X'), name='tas',
+                            coords={'S': fechas, 'L': pd.to_timedelta(np.arange(5) + 0.5, unit='D'), **self.coords})
+        hcst.to_dataset().to_netcdf(archivo)
+
+        inicio = open_hindcast_start(archivo, 8, 21)
+        self.assertTrue(os.path.isfile(get_hindcast_store_path(archivo)))
+        self.assertEqual(pd.Timestamp(inicio.S.values), pd.Timestamp('1960-08-21'))
+        np.testing.assert_array_equal(inicio.tas.values, hcst.sel(S='1999-08-21').values)
+        self.assertEqual(inicio.tas.dims, ('L', 'Y', 'X'))
+
+    def test_climatology_window(self):
+        archivo = f'{self.carpeta}/tmeanClimSmooth.nc'
+        fechas = pd.date_range('1960-01-01', '1960-12-31', freq='D')
+        media = xr.DataArray(self.rng.normal(15, 5, (len(fechas), 4, 3)), dims=('S', 'latitude', 'longitude'),
+                             coords={'S': fechas, 'latitude': self.coords['Y'], 'longitude': self.coords['X']},
+                             name='tmean')
+        media.to_dataset().to_netcdf(archivo)
+
+        ventana = get_climatology_window(archivo, 'tmean', '1960-12-20', '1961-01-30')
+        self.assertEqual(ventana.dims, ('S', 'Y', 'X'))
+        np.testing.assert_array_equal(ventana.S.values, pd.date_range('1960-12-20', '1961-01-30', freq='D').values)
+        np.testing.assert_array_equal(ventana.sel(S=slice('1960-12-20', '1960-12-31')).values,
+                                      media.sel(S=slice('1960-12-20', '1960-12-31')).values)
+        np.testing.assert_array_equal(ventana.sel(S=slice('1961-01-01', '1961-01-30')).values,
+                                      media.sel(S=slice('1960-01-01', '1960-01-30')).values)
+
+    def test_escritura_atomica(self):
+        archivo = os.path.join(self.carpeta, 'pesos.npz')
+        # Dos escrituras simultáneas del mismo archivo usan temporales distintos
+        with escritura_atomica(archivo) as temporal1, escritura_atomica(archivo) as temporal2:
+            self.assertNotEqual(temporal1, temporal2)
+            self.assertTrue(temporal1.endswith('.npz'))
+            np.savez(temporal1, a=np.arange(3))
+            np.savez(temporal2, a=np.arange(3))
+        with np.load(archivo) as f:
+            np.testing.assert_array_equal(f['a'], np.arange(3))
+        # Si la escritura falla no queda el temporal y no se modifica el archivo
+        with self.assertRaises(RuntimeError), escritura_atomica(archivo) as temporal:
+            with open(temporal, 'w') as f:
+                f.write('incompleto')
+            raise RuntimeError()
+        self.assertEqual(os.listdir(self.carpeta), ['pesos.npz'])
+
+    def test_regrid_like(self):
+        # Grilla fuente con latitudes decrecientes y con un valor faltante
+        fuente = xr.DataArray(self.rng.normal(15, 5, (2, 12, 10)), dims=('semanas', 'Y', 'X'), name='tmean',
+                              coords={'semanas': [1., 2.], 'Y': np.arange(-5., -61., -5.), 'X': np.arange(-85., -35., 5.)},
+                              attrs={'units': 'degC'})
+        fuente[0, 4, 4] = np.nan
+        destino = xr.DataArray(np.zeros((7, 6)), dims=('Y', 'X'),
+                               coords={'Y': np.linspace(-57, -8, 7), 'X': np.linspace(-88, -33, 6)})
+
+        esperado = fuente.interp_like(destino)
+        regrillado = regrid_like(fuente, destino)
+        self.assertEqual(regrillado.dims, esperado.dims)
+        self.assertEqual(regrillado.attrs, esperado.attrs)
+        np.testing.assert_allclose(regrillado.values, esperado.values, rtol=1e-12)
+        # Los pesos quedan guardados y se reutilizan
+        self.assertEqual(len(os.listdir(f'{self.carpeta}/regrid')), 1)
+        xr.testing.assert_identical(regrid_like(fuente, destino), regrillado)
+
+    def make_probabilidades(self, fecha_d):
+        semanas = {'semanas': [1., 2., 3.], 'S': ('semanas', pd.date_range(fecha_d, periods=3, freq='7D'))}
+        probabilidades = {}
+        for percentil in ['20-', '50-', '50+', '80+']:
+            prob = xr.DataArray(self.rng.uniform(0, 100, (3, 4, 3)), dims=('semanas', 'Y', 'X'), name='prob_corr',
+                                coords={**semanas, **self.coords})
+            prob[0, 1, 1] = np.nan
+            probabilidades[percentil] = prob
+        return probabilidades
+
+    def test_producto(self):
+        miercoles, fecha_d = dt.datetime(2025, 8, 20), dt.datetime(2025, 8, 21)
+        probabilidades = self.make_probabilidades(fecha_d)
+
+        archivo = guardar_producto(probabilidades, get_producto_path('tas', 'GEPS8', miercoles, fecha_d))
+        self.assertTrue(archivo.endswith('/operativo/prob/tas/202508200000/tas_GEPS8_202508210000_probabilities.nc'))
+        with xr.open_dataset(archivo, mask_and_scale=False) as ds:
+            self.assertEqual(ds['prob'].dtype, np.int16)
+            self.assertEqual(ds['prob'].encoding['chunksizes'], (1, 3, 4, 3))
+            self.assertTrue(ds['prob'].encoding['zlib'])
+
+        # Los valores se recuperan con dos decimales, y los faltantes como NaN
+        producto = abrir_producto(archivo)
+        self.assertEqual(producto.dims, ('categoria', 'semanas', 'Y', 'X'))
+        for percentil, prob in separar_categorias(producto).items():
+            np.testing.assert_allclose(prob.values, probabilidades[percentil].values, atol=ESCALA / 2, equal_nan=True)
+            np.testing.assert_array_equal(prob.S.values, probabilidades[percentil].S.values)
+
+        # Los archivos por categoría conservan las rutas y los valores originales
+        legado = guardar_legado(probabilidades, 'tas', 'GEPS8', miercoles, fecha_d)
+        self.assertEqual(legado[0], get_legado_path('tas', 'GEPS8', miercoles, fecha_d, '20-'))
+        self.assertTrue(legado[0].endswith('/202508200000/20-/tas_underpctil20_GEPS8_202508210000_probability.nc'))
+        self.assertTrue(legado[3].endswith('/202508200000/80+/tas_overpctil80_GEPS8_202508210000_probability.nc'))
+        with xr.open_dataset(legado[0]) as ds:
+            xr.testing.assert_identical(ds['prob_corr'].load(), probabilidades['20-'])
+
+    def test_historico(self):
+        miercoles = [dt.datetime(2025, 8, 6), dt.datetime(2025, 8, 13), dt.datetime(2025, 8, 20)]
+        fechas = [m + dt.timedelta(days=1) for m in miercoles]
+        esperado = {f: self.make_probabilidades(f) for f in fechas}
+
+        # Pronósticos previos: uno como archivo único y otro como archivos por categoría
+        guardar_producto(esperado[fechas[1]], get_producto_path('tas', 'GEPS8', miercoles[1], fechas[1]))
+        guardar_legado(esperado[fechas[0]], 'tas', 'GEPS8', miercoles[0], fechas[0])
+        self.assertEqual(importar_prob('tas'), 2)
+
+        # Se agrega un pronóstico nuevo y se recalibra uno anterior (se reemplaza)
+        agregar_al_historico('tas', 'GEPS8', esperado[fechas[2]], fechas[2], miercoles[2])
+        esperado[fechas[0]] = self.make_probabilidades(fechas[0])
+        agregar_al_historico('tas', 'GEPS8', esperado[fechas[0]], fechas[0], miercoles[0])
+
+        with abrir_historico('tas', 'GEPS8') as historico:
+            self.assertEqual(historico.sizes['inicio'], 3)
+            posiciones = seleccionar_inicios(historico)
+            np.testing.assert_array_equal(historico.inicio.values[posiciones], pd.DatetimeIndex(fechas).values)
+            self.assertEqual(historico.prob.encoding['chunksizes'], (52, 1, 3, 4, 3))
+            for fecha, m in zip(fechas, miercoles):
+                pronostico = historico.prob.sel(inicio=fecha)
+                self.assertEqual(pd.Timestamp(pronostico.miercoles.values), m)
+                np.testing.assert_array_equal(pronostico.S.values, esperado[fecha]['20-'].S.values)
+                for percentil, prob in esperado[fecha].items():
+                    np.testing.assert_allclose(pronostico.sel(categoria=percentil).values, prob.values,
+                                               atol=ESCALA / 2, equal_nan=True)
+            np.testing.assert_array_equal(seleccionar_inicios(historico, desde=fechas[1]), posiciones[1:])
+
+        # Otra grilla no se puede agregar, y el histórico queda como estaba (sin archivos temporales)
+        archivo = get_historico_path('tas', 'GEPS8')
+        with open(archivo, 'rb') as f:
+            contenido = f.read()
+        otra = {c: p.assign_coords(X=p.X + 1) for c, p in esperado[fechas[2]].items()}
+        with self.assertRaises(ValueError):
+            agregar_al_historico('tas', 'GEPS8', otra, fechas[2], miercoles[2])
+        with open(archivo, 'rb') as f:
+            self.assertEqual(f.read(), contenido)
+        self.assertEqual(os.listdir(os.path.dirname(archivo)), [os.path.basename(archivo)])
+
+    def test_historico_interrumpido(self):
+        miercoles = [dt.datetime(2025, 8, 6), dt.datetime(2025, 8, 13), dt.datetime(2025, 8, 20)]
+        fechas = [m + dt.timedelta(days=1) for m in miercoles]
+        esperado = {f: self.make_probabilidades(f) for f in fechas[:2]}
+        agregar_pronosticos('tas', 'GEPS8', [(f, m, lambda f=f: esperado[f]) for f, m in zip(fechas[:2], miercoles)])
+        archivo = get_historico_path('tas', 'GEPS8')
+
+        def leer_interrumpido():
+            raise KeyboardInterrupt
+
+        # Se reemplaza un pronóstico y se agrega otro, pero la lectura del segundo se interrumpe: con el proceso
+        # terminado, queda el journal y el histórico se restaura al agregar el próximo pronóstico
+        lote = [(fechas[0], miercoles[0], lambda: self.make_probabilidades(fechas[0])),
+                (fechas[2], miercoles[2], leer_interrumpido)]
+        with mock.patch('stores.historico._recuperar_historico'), self.assertRaises(KeyboardInterrupt):
+            agregar_pronosticos('tas', 'GEPS8', lote)
+        self.assertTrue(os.path.isfile(get_journal_path(archivo)))
+        with self.assertLogs(level='WARNING'):
+            agregar_al_historico('tas', 'GEPS8', esperado[fechas[1]], fechas[1], miercoles[1])
+        self.assertFalse(os.path.isfile(get_journal_path(archivo)))
+
+        # Sin el proceso terminado, el histórico se restaura en el momento (también si se agregaron pronósticos)
+        lote = [(fechas[2], miercoles[2], lambda: self.make_probabilidades(fechas[2])),
+                (fechas[0], miercoles[0], leer_interrumpido)]
+        with self.assertRaises(KeyboardInterrupt):
+            agregar_pronosticos('tas', 'GEPS8', lote)
+
+        with abrir_historico('tas', 'GEPS8') as historico:
+            self.assertEqual(historico.sizes['inicio'], 2)
+            self.assertEqual(historico.prob.encoding['chunksizes'], (52, 1, 3, 4, 3))
+            for fecha in fechas[:2]:
+                for percentil, prob in esperado[fecha].items():
+                    np.testing.assert_allclose(historico.prob.sel(inicio=fecha, categoria=percentil).values, prob.values,
+                                               atol=ESCALA / 2, equal_nan=True)
+        self.assertEqual(os.listdir(os.path.dirname(archivo)), [os.path.basename(archivo)])
+
+    def test_run_cache(self):
+        entrada = f'{self.carpeta}/pronostico.nc'
+        with open(entrada, 'w') as f:
+            f.write('datos')
+        cache = RunCache(max_bytes=10 ** 6)
+        entradas = {'pronostico': [entrada], 'pac': [f'{self.carpeta}/no_existe.nc']}
+        clave = cache.clave(entradas, {'corregir': True})
+        self.assertEqual(cache.clave(entradas, {'corregir': True}), clave)
+        self.assertNotEqual(cache.clave(entradas, {'corregir': False}), clave)
+        self.assertIsNone(cache.get(clave))
+
+        fecha_d = dt.datetime(2025, 8, 21)
+        fechas_v = [dt.date(2025, 8, 21), dt.date(2025, 8, 28), dt.date(2025, 9, 4), dt.date(2025, 9, 18)]
+        probabilidades = self.make_probabilidades(fecha_d)
+        cache.put(clave, fecha_d, fechas_v, probabilidades)
+        fecha_cache, fechas_cache, prob_cache = cache.get(clave)
+        self.assertEqual((fecha_cache, fechas_cache), (fecha_d, fechas_v))
+        self.assertEqual(list(prob_cache), list(probabilidades))
+        for percentil, prob in probabilidades.items():
+            xr.testing.assert_identical(prob_cache[percentil], prob)
+
+        # Las figuras se reutilizan mientras existan
+        figura = f'{self.carpeta}/figura.jpg'
+        cache.put_figuras(clave, [figura])
+        self.assertIsNone(cache.get_figuras(clave))
+        open(figura, 'w').close()
+        self.assertEqual(cache.get_figuras(clave), [figura])
+
+        # Si cambia el contenido de la descarga (sha256 del .meta.json) cambia la clave
+        with open(entrada + '.meta.json', 'w') as f:
+            f.write('{"sha256": "abc"}')
+        otra = cache.clave(entradas, {'corregir': True})
+        self.assertNotEqual(otra, clave)
+
+        # Se eliminan las entradas usadas hace más tiempo
+        cache.max_bytes = sum(f.stat().st_size for f in Path(cache.carpeta, clave).iterdir()) + 1
+        os.utime(f'{cache.carpeta}/{clave}', (0, 0))
+        cache.put(otra, fecha_d, fechas_v, probabilidades)
+        self.assertIsNone(cache.get(clave))
+        self.assertIsNotNone(cache.get(otra))
+
+
+if __name__ == "__main__":
+    unittest.main()